@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 import json
@@ -8,8 +9,8 @@ import re
 import io
 from collections import Counter
 
-from fastapi import FastAPI, File, HTTPException, UploadFile, status
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, File, HTTPException, Query, Request, UploadFile, status
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -20,6 +21,12 @@ if str(REPO_ROOT) not in sys.path:
     sys.path.append(str(REPO_ROOT))
 
 from data_layer.pipeline import run_all_stages
+from data_layer.jobs import FINISHED_STATES, Job, JobManager
+from data_layer import cpu_budget, feature_store, features, metrics as pipeline_metrics, micro_batch, proba_store, scoring
+from data_layer.progress import PROGRESS_BUS, write_json_atomic
+from data_layer.run_cache import RunCache, new_hasher, replace_tree
+from data_layer.stage_worker import STAGE_WORKER_ENABLED, get_stage_worker_pool
+from database.import_artifacts_to_db import import_all_artifacts_to_db
 import threading
 import time
 
@@ -41,25 +48,118 @@ TARGET_FILENAME = "data.csv"
 CHUNK_SIZE = 4 * 1024 * 1024
 DEFAULT_MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "100"))
 MAX_UPLOAD_BYTES = DEFAULT_MAX_UPLOAD_MB * 1024 * 1024
+SSE_KEEPALIVE_SEC = 15
+SSE_RETRY_MS = 3000
+# 單次 POST /score 最多的客戶列數與發票明細列數
+SCORE_MAX_ROWS = int(os.environ.get("SCORE_MAX_ROWS", "10000"))
+SCORE_MAX_INVOICE_LINES = int(os.environ.get("SCORE_MAX_INVOICE_LINES", "200000"))
+# GET /features 單頁最多幾位客戶
+FEATURES_MAX_ROWS = int(os.environ.get("FEATURES_MAX_ROWS", "10000"))
+PREDICTIONS_MAX_ROWS = int(os.environ.get("PREDICTIONS_MAX_ROWS", "10000"))
 
 app.mount("/artifacts", StaticFiles(directory=ARTIFACTS_DIR), name="artifacts")
 
+# snapshots that retained jobs still read (job.artifacts_dir points into the cache) are never evicted
+RUN_CACHE = RunCache(in_use=lambda: [job.artifacts_dir for job in JOBS.list()])
+
+# Serialises copies into the live artifacts folder served by /artifacts and /report/latest
+_PUBLISH_LOCK = threading.Lock()
+
+
+def _run_job(job: Job):
+    return run_all_stages(
+        stop_on_error=False,
+        upload_file=job.upload_file,
+        artifacts_dir=job.artifacts_dir,
+        job_id=job.job_id,
+        cancel_event=job.cancel_event,
+    )
+
+
+def _reimport_background():
+    """Keep the database in step with artifacts restored from the run cache."""
+    try:
+        import_all_artifacts_to_db(str(ARTIFACTS_DIR))
+    except Exception as exc:
+        print(f"Warning: re-import of cached artifacts failed: {exc}")
+
+
+def _restore_cached_run(digest: str) -> bool:
+    with _PUBLISH_LOCK:
+        return RUN_CACHE.restore(digest, ARTIFACTS_DIR)
+
+
+def _on_job_finished(job: Job, status: str):
+    """Publish a successful job as the latest report and hand its artifacts to the run cache.
+
+    Runs before ``status`` is applied to the job, so nobody sees ``done`` until
+    the live artifacts and ``job.artifacts_dir`` point at this run.
+    """
+    outcome = job.result or {}
+    if status != "done":
+        _write_status("cancelled" if status == "cancelled" else "failed", message=job.error, success=False)
+        return
+
+    with _PUBLISH_LOCK:
+        # replace, not merge: files an older run wrote but this one does not must not be served as current
+        replace_tree(job.artifacts_dir, ARTIFACTS_DIR)
+        digest = job.meta.get("content_sha256")
+        entry = None
+        if digest:
+            try:
+                entry = RUN_CACHE.store(
+                    digest,
+                    job.artifacts_dir,
+                    meta={
+                        "job_id": job.job_id,
+                        "original_filename": job.meta.get("original_filename"),
+                        "size": job.meta.get("size"),
+                        "preview_periods": job.meta.get("preview_periods", []),
+                        "total_duration_sec": outcome.get("total_duration_sec"),
+                    },
+                    move=True,
+                )
+            except Exception as exc:
+                print(f"Warning: failed to cache pipeline run: {exc}")
+        if entry is not None:
+            job.artifacts_dir = Path(entry["path"])
+        elif RUN_CACHE.enabled:
+            RUN_CACHE.set_current(None)
+    _write_status("done", message="Pipeline completed successfully", success=True)
+
+
+JOBS = JobManager(_run_job, on_finished=_on_job_finished)
+
+
+@app.on_event("startup")
+def _warm_stage_workers():
+    # start the preloading workers now so the first upload does not wait on imports
+    if STAGE_WORKER_ENABLED:
+        get_stage_worker_pool().warm()
+    # POST /score 的模型在每個 worker 行程只載入一次；啟動時先載入，第一個請求不必等
+    try:
+        scoring.get_scorer(ARTIFACTS_DIR).warm()
+    except Exception as exc:
+        print(f"Info: no model bundle to preload for /score: {exc}")
+
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    # (ここは変更なしですが、文脈のために省略せず記載します)
+async def upload_file(file: UploadFile = File(...), priority: int = 0):
     if file is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="未收到檔案")
 
     try:
-        UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+        job = JOBS.create(priority=priority, meta={"original_filename": file.filename})
     except OSError as exc:
         raise HTTPException(status_code=500, detail="建立 uploads 資料夾失敗") from exc
 
-    destination = UPLOADS_DIR / TARGET_FILENAME
+    destination = job.upload_file
+    partial = destination.with_name(f"{destination.name}.part")
 
+    hasher = new_hasher()
     try:
         bytes_written = 0
-        with destination.open("wb") as buffer:
+        with partial.open("wb") as buffer:
             while True:
                 chunk = await file.read(CHUNK_SIZE)
                 if not chunk:
@@ -67,11 +167,66 @@ async def upload_file(file: UploadFile = File(...)):
                 bytes_written += len(chunk)
                 if bytes_written > MAX_UPLOAD_BYTES:
                     raise HTTPException(status_code=413, detail=f"檔案超過 {DEFAULT_MAX_UPLOAD_MB}MB 限制")
+                hasher.update(chunk)
                 buffer.write(chunk)
+    except HTTPException:
+        JOBS.discard(job)
+        raise
     except Exception as exc:
-        destination.unlink(missing_ok=True)
+        JOBS.discard(job)
         raise HTTPException(status_code=500, detail="寫入檔案失敗") from exc
-    
+
+    digest = hasher.hexdigest()
+    job.meta.update({"content_sha256": digest, "size": bytes_written})
+
+    # The same file is already queued or running: follow that job instead of starting another
+    active = JOBS.find_active(lambda j: j.meta.get("content_sha256") == digest)
+    if active is not None:
+        JOBS.discard(job)
+        return {
+            "message": "上傳成功",
+            "saved_as": TARGET_FILENAME,
+            "job_id": active.job_id,
+            "status": active.status,
+            "queue_position": JOBS.queue_position(active.job_id),
+            "content_sha256": digest,
+            "preview_periods": active.meta.get("preview_periods", []),
+            "pipeline_started": False,
+            "cache_hit": False,
+        }
+
+    # Identical upload already processed: serve the stored artifacts instead of rerunning
+    cached = RUN_CACHE.lookup(digest)
+    if cached is not None:
+        restored = True
+        if not RUN_CACHE.is_current(digest):
+            restored = await run_in_threadpool(_restore_cached_run, digest)
+            if restored:
+                threading.Thread(target=_reimport_background, daemon=True).start()
+        if restored:
+            partial.unlink(missing_ok=True)
+            job.artifacts_dir = Path(cached["path"])
+            job.meta["preview_periods"] = cached.get("preview_periods", [])
+            JOBS.complete(
+                job,
+                status="done",
+                result={"stages": [], "cache_hit": True, "primary_stages_ok": True, "source_job_id": cached.get("job_id")},
+            )
+            _write_status("done", message="Reused cached pipeline run", success=True)
+            return {
+                "message": "上傳成功",
+                "saved_as": TARGET_FILENAME,
+                "job_id": job.job_id,
+                "status": job.status,
+                "queue_position": None,
+                "content_sha256": digest,
+                "preview_periods": job.meta["preview_periods"],
+                "pipeline_started": False,
+                "cache_hit": True,
+            }
+
+    os.replace(partial, destination)
+
     # After saving the uploaded CSV, compute preview periods from the uploaded file
     preview_periods = []
     try:
@@ -94,50 +249,144 @@ async def upload_file(file: UploadFile = File(...)):
                     preview_periods = sorted(df_upload["_period"].dropna().unique().tolist(), reverse=True)
     except Exception as e:
         print(f"Warning: failed to compute preview periods from uploaded file: {e}")
+    job.meta["preview_periods"] = preview_periods
 
-    # Persist pipeline status so frontend can poll reliably and wait until completion
-    status_path = ARTIFACTS_DIR / "pipeline_status.json"
-
-    def _write_status(state: str, message: str | None = None, success: bool | None = None):
-        try:
-            ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
-            payload = {
-                "status": state,
-                "message": message,
-                "success": success,
-                "timestamp": time.time()
-            }
-            with open(status_path, "w", encoding="utf-8") as sf:
-                json.dump(payload, sf)
-        except Exception as e:
-            print(f"Warning: failed to write pipeline status: {e}")
-
-    # mark pipeline as started
-    _write_status("running", message="Pipeline started", success=None)
-
-    # Start the heavy pipeline in background thread so upload can return quickly
-    def _run_pipeline_background():
-        try:
-            run_all_stages(stop_on_error=False)
-            _write_status("done", message="Pipeline completed successfully", success=True)
-        except Exception as exc:
-            print(f"Background pipeline failed: {exc}")
-            _write_status("failed", message=str(exc), success=False)
-
-    threading.Thread(target=_run_pipeline_background, daemon=True).start()
+    # Queue the heavy pipeline; the bounded worker pool picks it up so upload can return quickly
+    _write_status("running", message="Pipeline queued", success=None)
+    JOBS.submit(job)
 
     return {
         "message": "上傳成功",
         "saved_as": TARGET_FILENAME,
+        "job_id": job.job_id,
+        "status": job.status,
+        "queue_position": JOBS.queue_position(job.job_id),
+        "content_sha256": digest,
         "preview_periods": preview_periods,
         "pipeline_started": True,
+        "cache_hit": False,
     }
 
 
+def _write_status(state: str, message: str | None = None, success: bool | None = None):
+    """Publish the live pipeline status and persist it as a snapshot for /pipeline/status."""
+    status_path = ARTIFACTS_DIR / "pipeline_status.json"
+    try:
+        ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
+        payload = {
+            "status": state,
+            "message": message,
+            "success": success,
+            "timestamp": time.time()
+        }
+        PROGRESS_BUS.publish(None, "status", payload)
+        write_json_atomic(status_path, payload)
+    except Exception as e:
+        print(f"Warning: failed to write pipeline status: {e}")
+
+
+def _read_json(path: Path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Warning: failed to read {path.name}: {e}")
+        return None
+
+
+def _job_or_404(job_id: str) -> Job:
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+def _job_status_payload(job: Job) -> dict:
+    """Job record merged with the stage-level progress the pipeline writes for that job."""
+    payload = job.as_dict()
+    payload["queue_position"] = JOBS.queue_position(job.job_id)
+    progress = None
+    status_path = job.artifacts_dir / "pipeline_status.json"
+    if job.status == "running":
+        latest = PROGRESS_BUS.latest_status(job.job_id)
+        if latest is not None:
+            progress = latest["data"]
+        elif status_path.exists():
+            progress = _read_json(status_path)
+    if progress:
+        for key in ("current_stage", "percent", "estimated_total_sec", "estimated_remaining_sec"):
+            payload[key] = progress.get(key)
+        payload["message"] = progress.get("message")
+    elif job.status == "done":
+        payload["percent"] = 100
+        payload["message"] = "Pipeline completed successfully"
+    else:
+        payload["message"] = job.error
+    payload["logs"] = f"/jobs/{job.job_id}/logs"
+    return payload
+
+
+@app.get("/jobs")
+def list_jobs():
+    jobs = [_job_status_payload(job) for job in JOBS.list()]
+    return JSONResponse(
+        content={"jobs": jobs, "max_concurrent": JOBS.max_concurrent, "running": JOBS.running_count()},
+        media_type="application/json; charset=utf-8",
+    )
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = _job_or_404(job_id)
+    return JSONResponse(content=_job_status_payload(job), media_type="application/json; charset=utf-8")
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = _job_or_404(job_id)
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return JSONResponse(content=job.as_dict(include_result=True), media_type="application/json; charset=utf-8")
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """Cancel a queued job, or kill the running stage of a running job and stop its pipeline."""
+    job = _job_or_404(job_id)
+    if job.finished:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is already {job.status}")
+    JOBS.cancel(job_id)
+    if job.status == "cancelled":
+        _write_status("cancelled", message=job.error, success=False)
+    return JSONResponse(content=_job_status_payload(job), media_type="application/json; charset=utf-8")
+
+
+@app.get("/jobs/{job_id}/logs")
+def job_logs(job_id: str):
+    job = _job_or_404(job_id)
+    log_path = job.artifacts_dir / "pipeline_logs.txt"
+    if not log_path.exists():
+        return PlainTextResponse("")
+    return PlainTextResponse(log_path.read_text(encoding="utf-8", errors="replace"))
+
+
+@app.get("/jobs/{job_id}/artifacts/{file_path:path}")
+def job_artifact(job_id: str, file_path: str):
+    job = _job_or_404(job_id)
+    root = job.artifacts_dir.resolve()
+    target = (root / file_path).resolve()
+    if root not in target.parents or not target.is_file():
+        raise HTTPException(status_code=404, detail="artifact not found")
+    return FileResponse(target)
+
+
 @app.get("/pipeline/status")
 def pipeline_status():
-    """Return current pipeline status written to artifacts/pipeline_status.json.
-    If not present, return status 'idle'."""
+    """Return the status of the most recently submitted job.
+    Falls back to artifacts/pipeline_status.json, or 'idle' when nothing ran yet."""
+    job = JOBS.latest()
+    if job is not None:
+        return JSONResponse(content=_job_status_payload(job), media_type="application/json; charset=utf-8")
     status_path = ARTIFACTS_DIR / "pipeline_status.json"
     if not status_path.exists():
         return JSONResponse(content={"status": "idle"}, media_type="application/json; charset=utf-8")
@@ -148,6 +397,85 @@ def pipeline_status():
     except Exception as e:
         print(f"Warning: failed to read pipeline status file: {e}")
         return JSONResponse(content={"status": "unknown", "message": str(e)}, media_type="application/json; charset=utf-8")
+
+
+@app.get("/pipeline/metrics")
+def pipeline_metrics_history(limit: int = 20):
+    """Per-stage CPU, memory, I/O and artifact measurements of recent runs plus per-stage aggregates."""
+    runs = pipeline_metrics.load_history()
+    return JSONResponse(
+        content={
+            "runs": runs[-limit:][::-1] if limit > 0 else [],
+            "stages": pipeline_metrics.summarize(runs),
+            "total_runs": len(runs),
+            # how the CPU budget is split right now (per-stage plans are stored with each run)
+            "cpu_budget": dict(
+                cpu_budget.describe(), stages={name: cpu_budget.stage_plan(name) for name in cpu_budget.STAGE_PARALLELISM}
+            ),
+        },
+        media_type="application/json; charset=utf-8",
+    )
+
+
+def _sse_message(event_type: str, data: dict, event_id: int | None = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/pipeline/events")
+async def pipeline_events(request: Request, job_id: str | None = None):
+    """Server-Sent Events stream of job, status, stage and log events.
+
+    ``job_id`` limits the stream to one job (defaults to the latest job); a
+    reconnecting client's ``Last-Event-ID`` replays the events it missed.
+    """
+    if job_id is None:
+        latest = JOBS.latest()
+        job_id = latest.job_id if latest is not None else None
+    job = _job_or_404(job_id) if job_id is not None else None
+
+    last_event_id = request.headers.get("last-event-id")
+    try:
+        after_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        after_id = None
+    sub = PROGRESS_BUS.subscribe(job_id, after_id=after_id)
+
+    async def stream():
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            if after_id is None:
+                # current state first, then live updates
+                if job is not None:
+                    yield _sse_message("job", _job_status_payload(job))
+                    if job.finished:
+                        return
+                else:
+                    latest_status = PROGRESS_BUS.latest_status(None)
+                    yield _sse_message("status", latest_status["data"] if latest_status else {"status": "idle"})
+            while True:
+                if await request.is_disconnected():
+                    break
+                event = await sub.get(timeout=SSE_KEEPALIVE_SEC)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                data = dict(event["data"], channel=event["channel"], timestamp=event["timestamp"])
+                yield _sse_message(event["type"], data, event["id"])
+                if job is not None and event["type"] == "job" and data.get("status") in FINISHED_STATES:
+                    break  # the job is over; the client closes or reconnects for a new one
+        finally:
+            PROGRESS_BUS.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 # ... (冒頭のimportなどはそのまま) ...
 
 # 趨勢計算用輔助函數
@@ -295,17 +623,33 @@ SEGMENT_NAMES = {
     7: "Standard",               # 標準層 (その他)
 }
 
+def _load_features(artifacts_dir: Path, split: str) -> feature_store.FeatureMatrix:
+    """Read a run's feature store; older artifacts without one are built once while no publish can swap the folder."""
+    try:
+        return feature_store.load(artifacts_dir, split, build_missing=False)
+    except FileNotFoundError:
+        with _PUBLISH_LOCK:
+            return feature_store.load(artifacts_dir, split)
+
+
+def _stage4_customers() -> pd.DataFrame | None:
+    """Stage 4 training customers from the feature store (built once from the CSV for older artifacts)."""
+    try:
+        return _load_features(ARTIFACTS_DIR, "train").frame()
+    except FileNotFoundError:
+        return None
+
+
 # --- Stage 4 集計 (リピート日数とSilhouetteの読み込みロジックを整理) ---
 def analyze_stage4_segments(period: str | None = None):
     import json # JSONを扱うために関数内でimport
     
-    csv_path = ARTIFACTS_DIR / "stage4_selected_customers_train.csv"
     trans_path = ARTIFACTS_DIR / "stage2_df_cleaned.csv"
     
-    if not csv_path.exists():
+    df = _stage4_customers()
+    if df is None:
         return None     
 
-    df = pd.read_csv(csv_path)
     # If period filter provided, reduce to customers active in that period
     if period:
         try:
@@ -787,12 +1131,11 @@ def download_stage4_segment(cluster_id: int, period: str | None = None):
     """Return a CSV file containing all customers assigned to the given segment/cluster id.
     Optionally filter by `period` (format 'YYYY-MM' or 'YYYY').
     """
-    csv_path = ARTIFACTS_DIR / "stage4_selected_customers_train.csv"
     trans_path = ARTIFACTS_DIR / "stage2_df_cleaned.csv"
-    if not csv_path.exists():
+    df = _stage4_customers()
+    if df is None:
         raise HTTPException(status_code=404, detail="stage4 customers file not found")
     try:
-        df = pd.read_csv(csv_path)
         # Normalize cluster column name (accept 'cluster' or 'Cluster')
         if 'cluster' not in df.columns and 'Cluster' in df.columns:
             df.rename(columns={'Cluster': 'cluster'}, inplace=True)
@@ -838,4 +1181,204 @@ def download_stage4_segment(cluster_id: int, period: str | None = None):
         raise
     except Exception as e:
         print(f"Error preparing stage4 CSV: {e}")
-        raise HTTPException(status_code=500, detail="Failed to prepare CSV")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to prepare CSV")
+
+
+def _score_rows(payload: dict) -> pd.DataFrame:
+    """Customer feature rows of a /score request: given aggregates plus aggregates of raw invoice lines."""
+    customers = payload.get("customers") or []
+    invoices = payload.get("invoices") or []
+    if not isinstance(customers, list) or not isinstance(invoices, list):
+        raise ValueError("'customers' and 'invoices' must be lists")
+    if len(customers) > SCORE_MAX_ROWS or len(invoices) > SCORE_MAX_INVOICE_LINES:
+        raise ValueError(f"at most {SCORE_MAX_ROWS} customers and {SCORE_MAX_INVOICE_LINES} invoice lines per request")
+    frames = []
+    if customers:
+        rows = pd.DataFrame(customers)
+        # 沒給 CustomerID 的列補上 row-<i>，不會與發票算出的真實 CustomerID 撞在一起
+        synthesized = pd.Series([f"row-{i}" for i in range(len(rows))], index=rows.index)
+        rows["CustomerID"] = rows["CustomerID"].where(rows["CustomerID"].notna(), synthesized) if "CustomerID" in rows.columns else synthesized
+        frames.append(rows)
+    if invoices:
+        frames.append(scoring.get_scorer(ARTIFACTS_DIR).features_from_invoices(pd.DataFrame(invoices)))
+    if not frames:
+        raise ValueError("request needs 'customers' (feature rows) or 'invoices' (invoice lines)")
+    rows = pd.concat(frames, ignore_index=True)
+    rows["CustomerID"] = rows["CustomerID"].astype(str)
+    return rows
+
+
+@app.post("/score")
+async def score_customers(payload: dict):
+    """Segment probabilities of every Stage 5 model and the voting ensemble for a batch of customers.
+
+    Body: ``customers`` — rows with ``mean`` and ``categ_0..categ_4`` (Stage 6
+    features), and/or ``invoices`` — raw lines (``CustomerID``, ``InvoiceNo``,
+    ``Description``, ``Quantity``, ``UnitPrice``) aggregated with the Stage 4/6
+    rules; optional ``models`` limits the output (default: all, incl. ``VOTE``).
+    ``VOTE`` comes from the distilled surrogate when Stage 5 found it faithful
+    enough; ``exact: true`` forces the full RF+GB+KNN ensemble.
+    """
+    started = time.perf_counter()
+    scorer = scoring.get_scorer(ARTIFACTS_DIR)
+    try:
+        rows = await run_in_threadpool(_score_rows, payload)
+        # 同時到達的請求在 micro-batcher 裡湊成一批、只做一次向量化預測；
+        # 等批次時只 await future，不佔住 threadpool 的執行緒
+        future = await run_in_threadpool(
+            micro_batch.get_batcher(scorer).submit, rows, payload.get("models"), bool(payload.get("exact", False))
+        )
+        result = await asyncio.wrap_future(future)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+    except (ValueError, KeyError, TypeError) as exc:
+        raise HTTPException(status_code=422, detail=str(exc)) from exc
+
+    content = await run_in_threadpool(_score_response, rows, result)
+    content["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return JSONResponse(content=content, media_type="application/json; charset=utf-8")
+
+
+def _score_response(rows: pd.DataFrame, result: dict) -> dict:
+    """Expand one scored batch into the per-customer /score response."""
+    classes = result["classes"]
+    models = result["models"]
+    segment_model = "VOTE" if "VOTE" in models else next(iter(models))
+    # 整批算完後才逐客戶展開成回應
+    feature_rows = rows[features.FEATURE_COLUMNS].astype(float).to_dict("records")
+    preds = {name: m["pred"].astype(int).tolist() for name, m in models.items()}
+    probas = {name: np.round(m["proba"], 6).tolist() for name, m in models.items()}
+    customers = []
+    for i, customer_id in enumerate(rows["CustomerID"]):
+        segment = preds[segment_model][i]
+        customers.append({
+            "CustomerID": customer_id,
+            "features": feature_rows[i],
+            "segment": segment,
+            "segment_name": SEGMENT_NAMES.get(segment, f"Cluster {segment}"),
+            "predictions": {name: p[i] for name, p in preds.items()},
+            "probabilities": {name: p[i] for name, p in probas.items()},
+        })
+    return {
+        "classes": [int(c) for c in classes],
+        "models": {name: m["label"] for name, m in models.items()},
+        "segment_model": segment_model,
+        "surrogate": result["surrogate"],
+        "customers": customers,
+        "bundle": result["bundle"],
+    }
+
+
+@app.get("/score/metrics")
+def score_metrics():
+    """Micro-batching queue depth, batch sizes and request latency percentiles of POST /score."""
+    return JSONResponse(
+        content=micro_batch.get_batcher(scoring.get_scorer(ARTIFACTS_DIR)).stats(),
+        media_type="application/json; charset=utf-8",
+    )
+
+
+def _features_payload(artifacts_dir: Path, split: str, customer_id: list[str] | None, offset: int, limit: int) -> dict:
+    """One page (or the requested customers) of a run's ``train``/``test`` customer features."""
+    if split not in feature_store.SPLITS:
+        raise HTTPException(status_code=404, detail=f"unknown split {split!r}; expected one of {list(feature_store.SPLITS)}")
+    try:
+        store = _load_features(artifacts_dir, split)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    limit = max(0, min(limit, FEATURES_MAX_ROWS))
+    if customer_id:
+        rows = store.rows(customer_id[:FEATURES_MAX_ROWS])
+    else:
+        rows = store.frame(start=max(0, offset), stop=max(0, offset) + limit)
+    return {
+        "run_id": store.run_id,
+        "split": split,
+        "rows": len(store),
+        "index": feature_store.INDEX_COLUMN,
+        "columns": store.column_names,
+        "customers": json.loads(rows.to_json(orient="records")),
+    }
+
+
+@app.get("/features/{split}")
+def customer_features(split: str, customer_id: list[str] | None = Query(None), offset: int = 0, limit: int = 100):
+    """Customer feature rows of the live run (Stage 4 ``train`` aggregates or ``test``-period features)."""
+    return JSONResponse(
+        content=_features_payload(ARTIFACTS_DIR, split, customer_id, offset, limit),
+        media_type="application/json; charset=utf-8",
+    )
+
+
+@app.get("/jobs/{job_id}/features/{split}")
+def job_customer_features(job_id: str, split: str, customer_id: list[str] | None = Query(None), offset: int = 0, limit: int = 100):
+    """Customer feature rows of one pipeline run, addressed by its job id."""
+    job = _job_or_404(job_id)
+    return JSONResponse(
+        content=_features_payload(job.artifacts_dir, split, customer_id, offset, limit),
+        media_type="application/json; charset=utf-8",
+    )
+
+
+def _predictions_payload(
+    artifacts_dir: Path, stage: str, model: list[str] | None, customer_id: list[str] | None, offset: int, limit: int
+) -> dict:
+    """Per-model probabilities and predictions of Stage 5/6 test customers (one page or the requested ids)."""
+    if stage not in proba_store.STAGES:
+        raise HTTPException(status_code=404, detail=f"unknown stage {stage!r}; expected one of {list(proba_store.STAGES)}")
+    try:
+        store = proba_store.load(artifacts_dir, stage)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    models = model or store.models
+    unknown = [m for m in models if m not in store.models]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"unknown models: {unknown}; available: {store.models}")
+    if customer_id:
+        rows = store.positions(customer_id[:PREDICTIONS_MAX_ROWS])
+    else:
+        start = max(0, offset)
+        rows = np.arange(start, min(len(store), start + max(0, min(limit, PREDICTIONS_MAX_ROWS))))
+    index = store.index[rows].tolist()
+    y_true = store.y_true[rows].tolist() if store.y_true is not None else [None] * len(rows)
+    # float32 先轉成最短的十進位表示，JSON 不會出現 0.15000000596046448 這種尾數
+    per_model = {m: (store.proba(m)[rows].astype(str).astype(float).tolist(), store.pred(m)[rows].tolist()) for m in models}
+    return {
+        "run_id": store.run_id,
+        "stage": stage,
+        "rows": len(store),
+        "index": store.index_name,
+        "classes": store.classes,
+        "models": models,
+        "customers": [
+            {
+                store.index_name: index[i],
+                "y_true": y_true[i],
+                "predictions": {m: {"y_pred": pred[i], "proba": proba[i]} for m, (proba, pred) in per_model.items()},
+            }
+            for i in range(len(index))
+        ],
+    }
+
+
+@app.get("/predictions/{stage}")
+def customer_predictions(
+    stage: str, model: list[str] | None = Query(None), customer_id: list[str] | None = Query(None), offset: int = 0, limit: int = 100
+):
+    """Stage 5 (``stage5``) or Stage 6 (``stage6``) test-set probabilities of the live run."""
+    return JSONResponse(
+        content=_predictions_payload(ARTIFACTS_DIR, stage, model, customer_id, offset, limit),
+        media_type="application/json; charset=utf-8",
+    )
+
+
+@app.get("/jobs/{job_id}/predictions/{stage}")
+def job_customer_predictions(
+    job_id: str, stage: str, model: list[str] | None = Query(None), customer_id: list[str] | None = Query(None), offset: int = 0, limit: int = 100
+):
+    """Stage 5/6 test-set probabilities of one pipeline run, addressed by its job id."""
+    job = _job_or_404(job_id)
+    return JSONResponse(
+        content=_predictions_payload(job.artifacts_dir, stage, model, customer_id, offset, limit),
+        media_type="application/json; charset=utf-8",
+    )
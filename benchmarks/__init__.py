@@ -0,0 +1 @@
+"""Synthetic data generator and end-to-end pipeline benchmarks."""
@@ -0,0 +1,243 @@
+"""End-to-end pipeline benchmark on synthetic datasets.
+
+For every requested size a synthetic CSV is generated (and cached), Stage 1–7
+(optionally Stage 8) run through ``run_all_stages`` and the report endpoints
+are called against the produced artifacts. Wall time, CPU and peak RSS per
+step are compared with ``baselines.json``; a step that is slower / larger than
+its baseline by more than ``--threshold`` is reported as a regression and the
+command exits with status 1.
+
+    python -m benchmarks.run --sizes 100k,1m
+    python -m benchmarks.run --sizes 100k --update-baseline
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from data_layer import metrics
+from data_layer.pipeline import run_all_stages
+from data_layer.progress import write_json_atomic
+
+from .synthetic import SyntheticSpec, parse_rows, write_csv
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASELINE_FILE = BENCH_DIR / "baselines.json"
+DATA_DIR = BENCH_DIR / "data"
+DEFAULT_SIZES = "100k,1m"
+DEFAULT_THRESHOLD = 0.25
+# Absolute slack so sub-second steps and allocator noise don't flag regressions
+MIN_DURATION_DELTA_SEC = 0.5
+MIN_RSS_DELTA_MB = 64.0
+
+# Report endpoints exercised after the pipeline (handlers are called directly on the run's artifacts)
+REPORT_CALLS: List[tuple] = [
+    ("GET /report/latest", lambda server: server.get_latest_report()),
+    ("GET /report/latest?period=2011-11", lambda server: server.get_latest_report(period="2011-11")),
+    ("GET /stage3/cluster/0/download", lambda server: server.download_stage3_cluster(0)),
+    ("GET /stage4/segment/0/download", lambda server: server.download_stage4_segment(0)),
+]
+
+
+def _label(rows: int) -> str:
+    for factor, suffix in ((1_000_000, "m"), (1_000, "k")):
+        if rows % factor == 0:
+            return f"{rows // factor}{suffix}"
+    return str(rows)
+
+
+def ensure_dataset(rows: int, seed: int = 0, data_dir: Path = DATA_DIR) -> Path:
+    """Synthetic CSV for ``rows``/``seed``, generated once and reused by later runs."""
+    path = data_dir / f"synthetic_{_label(rows)}_seed{seed}.csv"
+    if not path.exists():
+        started = time.perf_counter()
+        write_csv(path, SyntheticSpec(rows=rows, seed=seed))
+        print(f"[bench] generated {path.name} in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+def _step(status: str, duration: float, usage: Optional[Dict]) -> Dict:
+    usage = usage or {}
+    cpu = (usage.get("cpu_user_sec") or 0.0) + (usage.get("cpu_system_sec") or 0.0)
+    return {
+        "status": status,
+        "duration_sec": round(duration, 3),
+        "cpu_sec": round(cpu, 3),
+        "peak_rss_mb": usage.get("peak_rss_mb"),
+    }
+
+
+def run_pipeline(csv_path: Path, artifacts_dir: Path, import_to_db: bool) -> Dict[str, Dict]:
+    result = run_all_stages(
+        stop_on_error=True, upload_file=csv_path, artifacts_dir=artifacts_dir, import_to_db=import_to_db
+    )
+    steps = {}
+    for res in result["stages"]:
+        steps[res["stage"]] = _step(res.get("status"), res.get("duration_sec") or 0.0, res.get("metrics"))
+        if res.get("status") != "ok":
+            print(f"[bench] {res['stage']} {res.get('status')}: {(res.get('error') or res.get('stderr') or '')[-300:]}")
+    return steps
+
+
+def run_reports(artifacts_dir: Path) -> Dict[str, Dict]:
+    from backend import server
+
+    steps = {}
+    previous = server.ARTIFACTS_DIR
+    server.ARTIFACTS_DIR = artifacts_dir
+    try:
+        for name, call in REPORT_CALLS:
+            usage = metrics.ThreadUsage()
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                with usage:
+                    call(server)
+            except Exception as exc:  # pylint: disable=broad-except
+                status = "error"
+                print(f"[bench] {name} failed: {exc}")
+            steps[name] = _step(status, time.perf_counter() - started, usage.result)
+    finally:
+        server.ARTIFACTS_DIR = previous
+    return steps
+
+
+def _merge_repeats(repeats: List[Dict[str, Dict]]) -> Dict[str, Dict]:
+    """Median duration/CPU and max RSS over repeated runs; a step counts as ok only if it always was."""
+    merged = {}
+    for name in repeats[0]:
+        runs = [r[name] for r in repeats if name in r]
+        rss = [r["peak_rss_mb"] for r in runs if r.get("peak_rss_mb") is not None]
+        merged[name] = {
+            "status": "ok" if all(r["status"] == "ok" for r in runs) else "error",
+            "duration_sec": round(statistics.median(r["duration_sec"] for r in runs), 3),
+            "cpu_sec": round(statistics.median(r["cpu_sec"] for r in runs), 3),
+            "peak_rss_mb": max(rss) if rss else None,
+        }
+    return merged
+
+
+def benchmark_size(rows: int, *, seed: int, repeat: int, import_to_db: bool, work_dir: Path) -> Dict[str, Dict]:
+    csv_path = ensure_dataset(rows, seed)
+    repeats = []
+    for i in range(repeat):
+        artifacts_dir = Path(tempfile.mkdtemp(prefix=f"bench_{_label(rows)}_{i}_", dir=work_dir))
+        steps = run_pipeline(csv_path, artifacts_dir, import_to_db)
+        steps.update(run_reports(artifacts_dir))
+        repeats.append(steps)
+    return _merge_repeats(repeats)
+
+
+def compare(current: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[Dict]:
+    """Steps whose duration or peak RSS exceed the baseline by more than ``threshold`` (relative)."""
+    regressions = []
+    for name, base in baseline.items():
+        cur = current.get(name)
+        if cur is None:
+            continue
+        if cur["status"] != "ok" and base.get("status") == "ok":
+            regressions.append({"step": name, "metric": "status", "baseline": "ok", "current": cur["status"]})
+            continue
+        for key, slack in (("duration_sec", MIN_DURATION_DELTA_SEC), ("peak_rss_mb", MIN_RSS_DELTA_MB)):
+            b, c = base.get(key), cur.get(key)
+            if b is None or c is None:
+                continue
+            if c > b * (1 + threshold) and c - b > slack:
+                regressions.append(
+                    {"step": name, "metric": key, "baseline": b, "current": c, "change_pct": round(100 * (c / b - 1), 1)}
+                )
+    return regressions
+
+
+def load_baselines(path: Path = BASELINE_FILE) -> Dict:
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _print_table(label: str, steps: Dict[str, Dict], baseline: Dict[str, Dict]) -> None:
+    print(f"\n== {label} rows ==")
+    print(f"{'step':36} {'status':8} {'sec':>9} {'base':>9} {'cpu':>9} {'rss MB':>8}")
+    for name, step in steps.items():
+        base = (baseline.get(name) or {}).get("duration_sec")
+        print(
+            f"{name:36} {step['status']:8} {step['duration_sec']:9.2f} "
+            f"{base if base is not None else '-':>9} {step['cpu_sec']:9.2f} {step['peak_rss_mb'] or 0:8.0f}"
+        )
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the RFM pipeline on synthetic data.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Comma separated row counts (default: {DEFAULT_SIZES}).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per size; the median is reported.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed relative slowdown.")
+    parser.add_argument("--with-db", action="store_true", help="Also run Stage 8 (needs DATA_DB_URL).")
+    parser.add_argument("--baseline", default=str(BASELINE_FILE))
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the new baseline.")
+    parser.add_argument("--output", default=None, help="Write the full results as JSON.")
+    return parser.parse_args(args)
+
+
+def main(cli_args: List[str]) -> int:
+    args = parse_args(cli_args)
+    # Measure full training every time: no model reuse or narrowed searches carried over from earlier runs
+    for name in ("STAGE5_DRIFT_GATE", "STAGE5_SEARCH_MEMORY"):
+        os.environ.setdefault(name, "0")
+    baseline_path = Path(args.baseline)
+    baselines = load_baselines(baseline_path)
+    work_dir = Path(tempfile.mkdtemp(prefix="rfm_bench_"))
+
+    results: Dict[str, Dict] = {}
+    regressions: Dict[str, List[Dict]] = {}
+    for text in args.sizes.split(","):
+        rows = parse_rows(text)
+        label = _label(rows)
+        steps = benchmark_size(
+            rows, seed=args.seed, repeat=max(1, args.repeat), import_to_db=args.with_db, work_dir=work_dir
+        )
+        results[label] = steps
+        base = (baselines.get("datasets") or {}).get(label, {})
+        _print_table(label, steps, base)
+        if base:
+            found = compare(steps, base, args.threshold)
+            if found:
+                regressions[label] = found
+
+    report = {
+        "timestamp": time.time(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "threshold": args.threshold,
+        "datasets": results,
+        "regressions": regressions,
+    }
+    if args.output:
+        write_json_atomic(Path(args.output), report)
+    if args.update_baseline:
+        datasets = dict(baselines.get("datasets") or {})
+        datasets.update(results)
+        write_json_atomic(baseline_path, {"cpu_count": os.cpu_count(), "seed": args.seed, "datasets": datasets})
+        print(f"\n[bench] baseline updated: {baseline_path}")
+
+    if regressions:
+        print("\n[bench] performance regressions:")
+        for label, items in regressions.items():
+            for item in items:
+                print(f"  {label} {item['step']} {item['metric']}: {item['baseline']} -> {item['current']}")
+        return 1
+    print("\n[bench] no regressions" if baselines else "\n[bench] no baseline to compare against")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
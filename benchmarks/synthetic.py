@@ -0,0 +1,206 @@
+"""Synthetic Online-Retail style invoices for benchmarking the pipeline.
+
+The output has the same columns and formats as ``uploads/data.csv``:
+power-law customer and SKU popularity, multi-line invoices, customer-level
+countries, ``C``-prefixed cancellations that reverse earlier purchases,
+rows without CustomerID and exact duplicates (both dropped by Stage 1).
+Dates span 2010-12-01 – 2011-12-09 so Stage 4's 2011-10-01 split has data on
+both sides.
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["InvoiceNo", "StockCode", "Description", "Quantity", "InvoiceDate", "UnitPrice", "CustomerID", "Country"]
+
+_START = pd.Timestamp("2010-12-01")
+_DAYS = 374
+# Relative invoice volume per calendar month (Dec..Dec), busier towards Q4 like the real data
+_MONTH_WEIGHTS = np.array([1.0, 0.8, 0.7, 0.9, 0.8, 0.9, 0.9, 0.9, 1.0, 1.3, 1.5, 1.8, 0.6])
+
+_COUNTRIES = ["United Kingdom", "Germany", "France", "EIRE", "Spain", "Netherlands", "Belgium", "Switzerland",
+              "Portugal", "Australia", "Norway", "Italy"]
+_COUNTRY_P = np.array([0.88, 0.025, 0.022, 0.018, 0.01, 0.01, 0.008, 0.007, 0.006, 0.005, 0.005, 0.004])
+
+_ADJECTIVES = ["RED", "WHITE", "PINK", "BLUE", "GREEN", "VINTAGE", "RETRO", "SMALL", "LARGE", "GLASS", "METAL",
+               "WOODEN", "HANGING", "PAPER", "FELT", "CERAMIC", "SET OF 3", "JUMBO", "MINI", "HEART"]
+_NOUNS = ["HEART", "BOX", "BAG", "CANDLE", "MUG", "LANTERN", "CLOCK", "TIN", "CARD", "LIGHT", "DOLL", "CAKE CASES",
+          "BOTTLE", "FRAME", "SIGN", "BUNTING", "NAPKINS", "TEA SET", "CUSHION COVER", "ORNAMENT", "PURSE",
+          "NOTEBOOK", "DOORMAT", "PLATE", "BOWL", "JAR", "HOLDER", "WREATH", "GARLAND", "STICKERS"]
+
+
+@dataclass
+class SyntheticSpec:
+    rows: int
+    seed: int = 0
+    customers: Optional[int] = None   # default scales like the real data (~1 customer per 90 lines)
+    products: Optional[int] = None    # default grows sub-linearly with rows
+    zipf_customers: float = 0.8
+    zipf_products: float = 1.05
+    lines_per_invoice: float = 20.0
+    cancel_rate: float = 0.02
+    missing_customer_rate: float = 0.05
+    duplicate_rate: float = 0.01
+
+    def n_customers(self) -> int:
+        return self.customers or max(50, self.rows // 90)
+
+    def n_products(self) -> int:
+        return self.products or int(min(200_000, max(100, 4000 * (self.rows / 400_000) ** 0.5)))
+
+
+def parse_rows(text: str) -> int:
+    """``"100k"`` / ``"2.5m"`` / ``"50M"`` / ``"40000"`` → row count."""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kKmM]?)\s*", text)
+    if not match:
+        raise ValueError(f"invalid row count: {text!r}")
+    factor = {"": 1, "k": 1_000, "m": 1_000_000}[match.group(2).lower()]
+    return int(float(match.group(1)) * factor)
+
+
+def _zipf_weights(n: int, exponent: float, rng: np.random.Generator) -> np.ndarray:
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    rng.shuffle(weights)  # popularity is not correlated with id order
+    return weights / weights.sum()
+
+
+class _Catalog:
+    """Customers and SKUs shared by every chunk of one dataset."""
+
+    def __init__(self, spec: SyntheticSpec):
+        rng = np.random.default_rng(spec.seed)
+        n_cust, n_prod = spec.n_customers(), spec.n_products()
+        self.customer_ids = 12346 + np.arange(n_cust)
+        self.customer_p = _zipf_weights(n_cust, spec.zipf_customers, rng)
+        self.customer_country = rng.choice(len(_COUNTRIES), n_cust, p=_COUNTRY_P / _COUNTRY_P.sum())
+
+        self.stock_codes = np.array([f"{10002 + i}" for i in range(n_prod)])
+        adj = rng.integers(0, len(_ADJECTIVES), (n_prod, 2))
+        noun = rng.integers(0, len(_NOUNS), n_prod)
+        # the SKU code keeps descriptions unique once the vocabulary runs out
+        self.descriptions = np.array(
+            [f"{_ADJECTIVES[a]} {_ADJECTIVES[b]} {_NOUNS[n]} {i}" if i >= 600 else f"{_ADJECTIVES[a]} {_ADJECTIVES[b]} {_NOUNS[n]}"
+             for i, ((a, b), n) in enumerate(zip(adj, noun))]
+        )
+        self.prices = np.round(np.clip(rng.lognormal(0.9, 0.9, n_prod), 0.1, 300), 2)
+        self.product_p = _zipf_weights(n_prod, spec.zipf_products, rng)
+
+        day_month = (_START + pd.to_timedelta(np.arange(_DAYS), unit="D")).month.values
+        month_idx = (day_month % 12)  # Dec 2010 -> 0 ... Nov -> 11
+        month_idx[-9:] = 12           # Dec 2011
+        day_p = _MONTH_WEIGHTS[month_idx] * np.where(
+            (_START + pd.to_timedelta(np.arange(_DAYS), unit="D")).dayofweek.values == 5, 0.0, 1.0
+        )  # the shop never sells on Saturdays
+        self.day_p = day_p / day_p.sum()
+
+
+def _generate_chunk(spec: SyntheticSpec, catalog: _Catalog, rows: int, chunk_index: int, invoice_base: int) -> pd.DataFrame:
+    rng = np.random.default_rng([spec.seed, chunk_index + 1])
+    n_cancel = int(rows * spec.cancel_rate)
+    n_dup = int(rows * spec.duplicate_rate)
+    n_lines = max(1, rows - n_cancel - n_dup)
+
+    # invoices: customer, timestamp and size; lines inherit them
+    n_invoices = max(1, int(n_lines / spec.lines_per_invoice))
+    sizes = rng.geometric(1.0 / spec.lines_per_invoice, n_invoices)
+    sizes = np.maximum(1, np.round(sizes * (n_lines / sizes.sum()))).astype(np.int64)
+    sizes[-1] += n_lines - sizes.sum()
+    if sizes[-1] < 1:  # rounding overshoot: fall back to a flat split
+        sizes = np.full(n_invoices, n_lines // n_invoices, dtype=np.int64)
+        sizes[: n_lines - sizes.sum()] += 1
+    inv_customer = rng.choice(len(catalog.customer_ids), n_invoices, p=catalog.customer_p)
+    inv_minutes = rng.choice(_DAYS, n_invoices, p=catalog.day_p) * 1440 + rng.integers(8 * 60, 20 * 60, n_invoices)
+    line_invoice = np.repeat(np.arange(n_invoices), sizes)
+
+    product = rng.choice(len(catalog.stock_codes), n_lines, p=catalog.product_p)
+    quantity = np.minimum(rng.geometric(0.12, n_lines), 480)
+    customer = inv_customer[line_invoice]
+    minutes = inv_minutes[line_invoice]
+    invoice_no = (invoice_base + line_invoice).astype(str)
+
+    # cancellations reverse (part of) an earlier purchase of the same customer and SKU
+    src = rng.integers(0, n_lines, n_cancel)
+    c_qty = -np.maximum(1, (quantity[src] * rng.uniform(0.2, 1.0, n_cancel)).astype(np.int64))
+    c_minutes = np.minimum(minutes[src] + rng.integers(60, 30 * 1440, n_cancel), _DAYS * 1440 - 1)
+    c_invoice = np.char.add("C", (invoice_base + n_invoices + np.arange(n_cancel)).astype(str))
+
+    frame = pd.DataFrame(
+        {
+            "InvoiceNo": np.concatenate([invoice_no, c_invoice]),
+            "product": np.concatenate([product, product[src]]),
+            "Quantity": np.concatenate([quantity, c_qty]),
+            "minutes": np.concatenate([minutes, c_minutes]),
+            "customer": np.concatenate([customer, customer[src]]),
+        }
+    )
+    if n_dup:
+        frame = pd.concat([frame, frame.iloc[rng.integers(0, len(frame), n_dup)]], ignore_index=True)
+    frame.sort_values("minutes", kind="stable", inplace=True)
+
+    out = pd.DataFrame(
+        {
+            "InvoiceNo": frame["InvoiceNo"].values,
+            "StockCode": catalog.stock_codes[frame["product"].values],
+            "Description": catalog.descriptions[frame["product"].values],
+            "Quantity": frame["Quantity"].values,
+            "InvoiceDate": (_START + pd.to_timedelta(frame["minutes"].values, unit="m")).strftime("%m/%d/%Y %H:%M"),
+            "UnitPrice": catalog.prices[frame["product"].values],
+            "CustomerID": catalog.customer_ids[frame["customer"].values].astype(float),
+            "Country": np.array(_COUNTRIES)[catalog.customer_country[frame["customer"].values]],
+        },
+        columns=COLUMNS,
+    )
+    missing = rng.random(len(out)) < spec.missing_customer_rate
+    out.loc[missing, "CustomerID"] = np.nan
+    return out
+
+
+def write_csv(path: Path, spec: SyntheticSpec, chunk_rows: int = 1_000_000) -> Path:
+    """Write ``spec.rows`` synthetic lines to ``path`` chunk by chunk (memory stays flat for 50M rows)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    catalog = _Catalog(spec)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    written = 0
+    chunk_index = 0
+    invoice_base = 536365
+    with open(tmp_path, "w", encoding="ISO-8859-1", newline="") as f:
+        while written < spec.rows:
+            rows = min(chunk_rows, spec.rows - written)
+            chunk = _generate_chunk(spec, catalog, rows, chunk_index, invoice_base)
+            chunk.to_csv(f, index=False, header=chunk_index == 0)
+            written += rows
+            chunk_index += 1
+            invoice_base += rows + 1  # invoice numbers never collide across chunks
+    tmp_path.replace(path)
+    return path
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a synthetic transactions CSV.")
+    parser.add_argument("rows", help="Number of rows, e.g. 100k, 1m, 50m.")
+    parser.add_argument("output", help="Destination CSV path.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--customers", type=int, default=None)
+    parser.add_argument("--products", type=int, default=None)
+    return parser.parse_args(args)
+
+
+def main(cli_args: List[str]) -> None:
+    args = parse_args(cli_args)
+    spec = SyntheticSpec(rows=parse_rows(args.rows), seed=args.seed, customers=args.customers, products=args.products)
+    path = write_csv(Path(args.output), spec)
+    print(f"已產生 {spec.rows} 筆資料：{path}（{spec.n_customers()} 顧客 / {spec.n_products()} 商品）")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import math
+import os
+from typing import Dict, Optional, Tuple
+
+# Cores the service may use in total (0 = detect from cgroup quota / CPU affinity)
+RFM_CPU_CORES = float(os.environ.get("RFM_CPU_CORES", "0") or 0)
+# Pipelines that may run at once share the cores evenly
+PIPELINE_MAX_CONCURRENT = max(1, int(os.environ.get("PIPELINE_MAX_CONCURRENT", "1")))
+
+# How each stage turns its cores into parallelism:
+#   "processes" — n_jobs = cores parallel workers (joblib processes, or Stage 6's per-model
+#                 thread pool), one BLAS/OpenMP thread each
+#   "threads"   — a single process whose BLAS/OpenMP pools (KMeans, numpy, SHAP) use the cores
+STAGE_PARALLELISM: Dict[str, str] = {
+    "Stage 2": "threads",
+    "Stage 3": "threads",
+    "Stage 4": "threads",
+    "Stage 5": "processes",
+    "Stage 6": "processes",
+    "Stage 7": "threads",
+}
+
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def _cgroup_quota() -> Optional[float]:
+    """CPU quota of this container in cores (cgroup v2 ``cpu.max`` or v1 CFS files), None if unlimited."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r", encoding="ascii") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r", encoding="ascii") as f:
+            quota_us = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r", encoding="ascii") as f:
+            period_us = int(f.read())
+        if quota_us > 0 and period_us > 0:
+            return quota_us / period_us
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def detect_cpus() -> Tuple[float, str]:
+    """Usable cores and where the number came from (``cgroup``, ``affinity`` or ``cpu_count``)."""
+    candidates = [(float(os.cpu_count() or 1), "cpu_count")]
+    if hasattr(os, "sched_getaffinity"):
+        candidates.append((float(len(os.sched_getaffinity(0))), "affinity"))
+    quota = _cgroup_quota()
+    if quota is not None:
+        candidates.append((quota, "cgroup"))
+    return min(candidates, key=lambda c: c[0])
+
+
+def total_cores() -> int:
+    if RFM_CPU_CORES > 0:
+        return max(1, int(RFM_CPU_CORES))
+    cores, _ = detect_cpus()
+    # a 2.5-core quota runs 2 busy workers without throttling, 3 would be
+    return max(1, math.floor(cores))
+
+
+def pipeline_cores() -> int:
+    """Cores one pipeline may use when ``PIPELINE_MAX_CONCURRENT`` pipelines run side by side."""
+    return max(1, total_cores() // PIPELINE_MAX_CONCURRENT)
+
+
+def stage_plan(stage_name: str, cores: Optional[int] = None) -> Dict:
+    """Processes × threads for one stage, never exceeding ``cores`` busy threads."""
+    cores = cores or pipeline_cores()
+    mode = STAGE_PARALLELISM.get(stage_name, "threads")
+    processes, threads = (cores, 1) if mode == "processes" else (1, cores)
+    return {"cores": cores, "mode": mode, "processes": processes, "threads_per_process": threads}
+
+
+def stage_env(plan: Dict) -> Dict[str, str]:
+    """Environment for a stage script: ``RFM_N_JOBS`` for joblib, thread caps for BLAS/OpenMP.
+
+    ``LOKY_MAX_CPU_COUNT`` makes any remaining ``n_jobs=-1`` resolve to the plan
+    instead of every host CPU; loky workers get ``cores // n_jobs`` BLAS threads.
+    """
+    env = {
+        "RFM_N_JOBS": str(plan["processes"]),
+        "RFM_THREADS": str(plan["threads_per_process"]),
+        "LOKY_MAX_CPU_COUNT": str(plan["cores"]),
+    }
+    env.update({name: str(plan["threads_per_process"]) for name in _THREAD_ENV_VARS})
+    return env
+
+
+def describe() -> Dict:
+    """Budget summary stored with each run's metrics."""
+    detected, source = detect_cpus()
+    return {
+        "total_cores": total_cores(),
+        "detected_cores": round(detected, 2),
+        "source": "RFM_CPU_CORES" if RFM_CPU_CORES > 0 else source,
+        "max_concurrent_pipelines": PIPELINE_MAX_CONCURRENT,
+        "pipeline_cores": pipeline_cores(),
+    }
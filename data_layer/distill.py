@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+from sklearn.tree import DecisionTreeRegressor
+
+# 蒸餾開關、線上評分採用代理模型的最低一致率、訓練時加的抖動樣本
+DISTILL_ENABLED = os.environ.get("STAGE5_DISTILL", "1").strip().lower() not in ("0", "false", "no")
+DISTILL_MIN_FIDELITY = float(os.environ.get("STAGE5_DISTILL_MIN_FIDELITY", "0.97"))
+DISTILL_COPIES = max(0, int(os.environ.get("STAGE5_DISTILL_COPIES", "10")))
+DISTILL_NOISE = float(os.environ.get("STAGE5_DISTILL_NOISE", "0.3"))  # 特徵標準差的倍數
+DISTILL_DEPTHS = (6, 8, 10, 12, 14, 16)
+# 比最佳一致率低不到這個值的最淺深度即可
+DISTILL_DEPTH_SLACK = 0.005
+
+SURROGATE_NAME = "VOTE_DISTILLED"
+
+
+class DistilledClassifier(object):
+    """One multi-output regression tree that reproduces a teacher's soft probabilities.
+
+    Leaves hold averages of teacher probability vectors, so rows stay on the
+    simplex; ``predict`` is the argmax, like the teacher's soft vote.
+    """
+
+    def __init__(self, tree: DecisionTreeRegressor, classes: Sequence):
+        self.tree = tree
+        self.classes_ = np.asarray(classes)
+
+    @property
+    def n_features_in_(self) -> int:
+        return self.tree.n_features_in_
+
+    def predict_proba(self, X) -> np.ndarray:
+        proba = np.clip(self.tree.predict(np.asarray(X, dtype=float)), 0.0, None)
+        if proba.ndim == 1:
+            proba = proba[:, None]
+        total = proba.sum(axis=1, keepdims=True)
+        total[total == 0] = 1.0
+        return proba / total
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def _jitter(X: np.ndarray, copies: int, noise: float, seed: int) -> np.ndarray:
+    """``copies`` noisy copies of ``X`` (Gaussian, ``noise`` × feature std, clipped to the observed range)."""
+    if copies <= 0 or noise <= 0:
+        return X[:0]
+    rng = np.random.default_rng(seed)
+    lo, hi = X.min(axis=0), X.max(axis=0)
+    scale = X.std(axis=0) * noise
+    out = np.repeat(X, copies, axis=0) + rng.normal(size=(len(X) * copies, X.shape[1])) * scale
+    return np.clip(out, lo, hi)
+
+
+def _per_row_ms(fn, X: np.ndarray, repeat: int = 5) -> float:
+    fn(X)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(X)
+    return (time.perf_counter() - started) / repeat / len(X) * 1000
+
+
+def distill(
+    teacher,
+    X_train,
+    X_test,
+    copies: int = DISTILL_COPIES,
+    noise: float = DISTILL_NOISE,
+    depths: Sequence[int] = DISTILL_DEPTHS,
+    min_fidelity: float = DISTILL_MIN_FIDELITY,
+    random_state: int = 42,
+) -> Tuple[DistilledClassifier, Dict]:
+    """Fit a surrogate on ``teacher.predict_proba`` over the training rows plus jittered copies.
+
+    The depth is chosen on a separate jittered validation set (shallowest depth
+    within ``DISTILL_DEPTH_SLACK`` of the best agreement); fidelity — argmax
+    agreement with the teacher — is reported on ``X_test``.
+    """
+    X_train = np.asarray(X_train, dtype=float)
+    X_test = np.asarray(X_test, dtype=float)
+    classes = np.asarray(teacher.classes_)
+    started = time.perf_counter()
+
+    X_fit = np.vstack([X_train, _jitter(X_train, copies, noise, random_state)])
+    X_val = _jitter(X_train, 1, noise, random_state + 1)
+    if not len(X_val):
+        X_val = X_train
+    y_fit = teacher.predict_proba(X_fit)
+    val_pred = teacher.predict_proba(X_val).argmax(axis=1)
+
+    fitted = []
+    for depth in depths:
+        tree = DecisionTreeRegressor(max_depth=depth, min_samples_leaf=2, random_state=random_state)
+        tree.fit(X_fit, y_fit)
+        agreement = float(np.mean(tree.predict(X_val).argmax(axis=1) == val_pred))
+        fitted.append((depth, tree, agreement))
+    best_agreement = max(a for _, _, a in fitted)
+    depth, tree, val_agreement = next(f for f in fitted if f[2] >= best_agreement - DISTILL_DEPTH_SLACK)
+    surrogate = DistilledClassifier(tree, classes)
+
+    teacher_proba = teacher.predict_proba(X_test)
+    proba = surrogate.predict_proba(X_test)
+    fidelity = float(np.mean(proba.argmax(axis=1) == teacher_proba.argmax(axis=1)))
+    teacher_ms = _per_row_ms(teacher.predict_proba, X_test)
+    surrogate_ms = _per_row_ms(surrogate.predict_proba, X_test)
+    report = {
+        "model": "DecisionTreeRegressor (multi-output)",
+        "max_depth": depth,
+        "n_leaves": int(tree.get_n_leaves()),
+        "train_rows": int(len(X_fit)),
+        "validation_agreement": round(val_agreement, 4),
+        "fidelity": round(fidelity, 4),
+        "mean_abs_proba_diff": round(float(np.abs(proba - teacher_proba).mean()), 6),
+        "min_fidelity": min_fidelity,
+        "use_for_scoring": fidelity >= min_fidelity,
+        "teacher_ms_per_1k_rows": round(teacher_ms * 1000, 3),
+        "surrogate_ms_per_1k_rows": round(surrogate_ms * 1000, 3),
+        "speedup": round(teacher_ms / surrogate_ms, 1) if surrogate_ms > 0 else None,
+        "duration_sec": round(time.perf_counter() - started, 3),
+    }
+    return surrogate, report
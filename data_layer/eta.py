@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import metrics
+
+# Fallback seconds per stage when no history exists yet (measured on the ~400k-row sample dataset)
+DEFAULT_STAGE_SECONDS: Dict[str, float] = {
+    "Stage 1": 5,
+    "Stage 2": 8,
+    "Stage 3": 12,
+    "Stage 4": 15,
+    "Stage 5": 18,
+    "Stage 6": 10,
+    "Stage 7": 12,
+    "Stage 8 - Import to DB": 6,
+}
+_DEFAULT_REFERENCE = {"bytes": 45_000_000.0, "rows": 400_000.0}
+
+# Successful runs of a stage needed before the regression is trusted over ratio scaling
+ETA_MIN_SAMPLES = int(os.environ.get("ETA_MIN_SAMPLES", "5"))
+# Ridge penalty on the standardised log-features (keeps the fit sane when a feature barely varies)
+ETA_RIDGE_ALPHA = float(os.environ.get("ETA_RIDGE_ALPHA", "0.1"))
+
+# Feature sets: before Stage 1 only the upload size is known, afterwards the cleaned data shape
+START_FEATURES = ("bytes", "cores")
+DATA_FEATURES = ("rows", "customers", "products", "cores")
+
+Sample = Tuple[Dict[str, float], float]
+
+
+def run_features(run: Dict) -> Dict[str, float]:
+    """Scale features of one metrics-history run (see ``pipeline._record_run_metrics``)."""
+    features = dict(run.get("input") or {})
+    features["cores"] = run.get("cpu_count")
+    return {k: float(v) for k, v in features.items() if isinstance(v, (int, float)) and v > 0}
+
+
+def _samples_by_stage(runs: Iterable[Dict]) -> Dict[str, List[Sample]]:
+    samples: Dict[str, List[Sample]] = {}
+    for run in runs:
+        features = run_features(run)
+        for stage in run.get("stages", []):
+            duration = stage.get("duration_sec")
+            if stage.get("status") == "ok" and duration and duration > 0:
+                samples.setdefault(stage["stage"], []).append((features, float(duration)))
+    return samples
+
+
+class _LogLinearFit:
+    """``log(duration) = b0 + sum(b_i * log(feature_i))`` fitted by ridge least squares."""
+
+    def __init__(self, keys: Sequence[str], samples: List[Sample], alpha: float):
+        self.keys = tuple(keys)
+        X = np.log(np.array([[f[k] for k in self.keys] for f, _ in samples], dtype=float))
+        y = np.log(np.array([d for _, d in samples], dtype=float))
+        self.mean = X.mean(axis=0)
+        self.scale = X.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        Z = (X - self.mean) / self.scale
+        self.intercept = float(y.mean())
+        yc = y - self.intercept
+        gram = Z.T @ Z + alpha * np.eye(len(self.keys))
+        self.coef = np.linalg.solve(gram, Z.T @ yc)
+        resid = yc - Z @ self.coef
+        self.rmse_log = float(np.sqrt(np.mean(resid ** 2)))
+
+    def predict(self, features: Dict[str, float]) -> float:
+        z = (np.log([features[k] for k in self.keys]) - self.mean) / self.scale
+        return float(math.exp(self.intercept + float(z @ self.coef)))
+
+
+class EtaModel:
+    """Per-stage duration predictions learned from the metrics history.
+
+    Each stage gets a log-linear model over whichever scale features the
+    caller knows (upload bytes before Stage 1; rows, customers, products and
+    cores after it). With fewer than ``ETA_MIN_SAMPLES`` comparable runs the
+    median seconds-per-unit of past runs is scaled linearly, and with no
+    history at all ``DEFAULT_STAGE_SECONDS`` is used.
+    """
+
+    def __init__(self, runs: Optional[List[Dict]] = None):
+        self._samples = _samples_by_stage(runs if runs is not None else metrics.load_history())
+        self._fits: Dict[Tuple[str, Tuple[str, ...]], Optional[_LogLinearFit]] = {}
+
+    @classmethod
+    def from_history(cls) -> "EtaModel":
+        return cls(metrics.load_history())
+
+    def _fit(self, stage: str, keys: Tuple[str, ...]) -> Optional[_LogLinearFit]:
+        cache_key = (stage, keys)
+        if cache_key not in self._fits:
+            samples = [s for s in self._samples.get(stage, []) if all(k in s[0] for k in keys)]
+            fit = None
+            if len(samples) >= max(ETA_MIN_SAMPLES, len(keys) + 2):
+                try:
+                    fit = _LogLinearFit(keys, samples, ETA_RIDGE_ALPHA)
+                except (np.linalg.LinAlgError, ValueError):
+                    fit = None
+            self._fits[cache_key] = fit
+        return self._fits[cache_key]
+
+    def predict(self, stage: str, features: Dict[str, float]) -> Tuple[float, str]:
+        """Predicted seconds for ``stage`` and how it was derived (``model``/``scaled``/``default``)."""
+        keys = tuple(sorted(k for k in features if features[k] and features[k] > 0))
+        if keys:
+            fit = self._fit(stage, keys)
+            if fit is not None:
+                return max(0.1, fit.predict(features)), "model"
+
+        size_key = next((k for k in ("rows", "bytes") if features.get(k)), None)
+        if size_key is not None:
+            ratios = [d / f[size_key] for f, d in self._samples.get(stage, []) if f.get(size_key)]
+            if ratios:
+                return max(0.1, float(np.median(ratios)) * features[size_key]), "scaled"
+
+        default = float(DEFAULT_STAGE_SECONDS.get(stage, 0))
+        if size_key is not None:
+            default *= features[size_key] / _DEFAULT_REFERENCE[size_key]
+        return default, "default"
+
+
+class RunProgress:
+    """Tracks one pipeline run and turns stage predictions into percent/remaining time.
+
+    Finished stages count with their real duration; the running stage with
+    ``max(predicted, elapsed)``; pending stages with their prediction scaled
+    by how far this run has been off so far (clamped to 0.5x–2x), so a machine
+    that is consistently slower than the history converges during the run.
+    """
+
+    def __init__(self, stages: Sequence[str], model: EtaModel, features: Dict[str, float]):
+        self.stages = list(stages)
+        self.model = model
+        self.started = time.time()
+        self.actual: Dict[str, float] = {}
+        self.predicted: Dict[str, float] = {}
+        self.basis: Dict[str, str] = {}
+        self._failed: set = set()
+        self.current: Optional[str] = None
+        self._current_started = 0.0
+        self.update_features(features)
+
+    def update_features(self, features: Dict[str, float]) -> None:
+        """Re-predict the stages that have not finished (e.g. once Stage 1 knows the data shape)."""
+        self.features = dict(features)
+        for stage in self.stages:
+            if stage not in self.actual:
+                self.predicted[stage], self.basis[stage] = self.model.predict(stage, self.features)
+
+    def start_stage(self, stage: str) -> None:
+        self.current = stage
+        self._current_started = time.time()
+
+    def finish_stage(self, stage: str, duration_sec: float, ok: bool = True) -> None:
+        self.actual[stage] = float(duration_sec or 0.0)
+        if not ok:
+            self._failed.add(stage)  # a failing stage exits early and says nothing about speed
+        if self.current == stage:
+            self.current = None
+
+    def skip_remaining(self) -> None:
+        """Drop unfinished stages from the estimate (run stopped early)."""
+        self.stages = [s for s in self.stages if s in self.actual]
+        self.current = None
+
+    def _drift(self) -> float:
+        done = [
+            s for s in self.actual
+            if s not in self._failed and self.basis.get(s) != "default" and self.predicted.get(s)
+        ]
+        predicted = sum(self.predicted[s] for s in done)
+        if predicted <= 0:
+            return 1.0
+        return min(2.0, max(0.5, sum(self.actual[s] for s in done) / predicted))
+
+    def snapshot(self) -> Dict[str, float]:
+        """Keyword arguments for ``_write_pipeline_status`` (elapsed vs. elapsed + remaining)."""
+        now = time.time()
+        drift = self._drift()
+        remaining = 0.0
+        for stage in self.stages:
+            if stage in self.actual:
+                continue
+            predicted = self.predicted.get(stage, 0.0) * drift
+            if stage == self.current:
+                remaining += max(0.0, predicted - (now - self._current_started))
+            else:
+                remaining += predicted
+        elapsed = now - self.started
+        return {"completed_est_sec": elapsed, "total_est_sec": elapsed + remaining}
+
+    def estimate_for(self, stage: str) -> Optional[Dict]:
+        if stage not in self.predicted:
+            return None
+        return {"estimated_sec": round(self.predicted[stage], 3), "estimate_basis": self.basis[stage]}
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from . import features
+from .progress import write_json_atomic
+
+STORE_VERSION = 1
+STORE_DIR = "features"
+MANIFEST_FILE = "manifest.json"
+INDEX_COLUMN = "CustomerID"
+# 每個 split 由哪個 Stage 4 產出重建（舊 artifacts 沒有 feature store 時）
+SOURCE_FILES: Dict[str, str] = {
+    "train": "stage4_selected_customers_train.csv",
+    "test": "stage4_set_test.csv",
+}
+SPLITS = tuple(SOURCE_FILES)
+
+_CACHE_MAX = 8
+_CACHE: Dict[tuple, "FeatureMatrix"] = {}
+_CACHE_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+
+
+def current_run_id() -> str:
+    """``RFM_RUN_ID`` (the pipeline passes the job id), or a fresh id in the same format."""
+    return os.environ.get("RFM_RUN_ID") or f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class FeatureMatrix:
+    """One split of the customer feature store: typed columns keyed by ``CustomerID``.
+
+    Each column is one typed ``.npy`` file, read once per process (not mapped:
+    publishing a job swaps the live folder out with ``replace_tree`` and deletes
+    the old one), so Stage 5/6/7 and the server no longer re-read and regroup
+    the Stage 4 CSVs.
+    """
+
+    def __init__(self, manifest: Dict, columns: Dict[str, np.ndarray]):
+        self.manifest = manifest
+        self.columns = columns
+        self._positions: Optional[pd.Index] = None
+
+    @property
+    def run_id(self) -> Optional[str]:
+        return self.manifest.get("run_id")
+
+    @property
+    def split(self) -> str:
+        return self.manifest["split"]
+
+    @property
+    def column_names(self) -> List[str]:
+        return [c["name"] for c in self.manifest["columns"]]
+
+    @property
+    def index(self) -> np.ndarray:
+        return self.columns[INDEX_COLUMN]
+
+    def __len__(self) -> int:
+        return int(self.manifest["rows"])
+
+    def frame(self, columns: Optional[Sequence[str]] = None, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+        """``CustomerID`` plus ``columns`` (default: all) of rows ``start:stop`` as an in-memory DataFrame."""
+        names = [INDEX_COLUMN] + [c for c in (columns or self.column_names) if c != INDEX_COLUMN]
+        return pd.DataFrame({name: self.columns[name][start:stop] for name in names})
+
+    def matrix(self, columns: Sequence[str] = features.FEATURE_COLUMNS) -> np.ndarray:
+        """Float matrix of ``columns`` in the given order (classifier input by default)."""
+        return np.column_stack([np.asarray(self.columns[c], dtype=float) for c in columns])
+
+    def rows(self, customer_ids: Sequence, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Rows of ``customer_ids`` in request order; unknown ids are left out."""
+        if self._positions is None:
+            self._positions = pd.Index(np.asarray(self.index))
+        ids = pd.Series(list(customer_ids), dtype=object)
+        if self.index.dtype.kind in "iu":
+            ids = pd.to_numeric(ids, errors="coerce")
+        else:
+            ids = ids.astype(str)
+        positions = self._positions.get_indexer(ids)
+        positions = positions[positions >= 0]
+        names = [INDEX_COLUMN] + [c for c in (columns or self.column_names) if c != INDEX_COLUMN]
+        return pd.DataFrame({name: np.asarray(self.columns[name])[positions] for name in names})
+
+
+def _store_path(artifacts_dir: Path, split: str) -> Path:
+    if split not in SPLITS:
+        raise ValueError(f"unknown split {split!r}; expected one of {SPLITS}")
+    return Path(artifacts_dir) / STORE_DIR / split
+
+
+def _source_stat(artifacts_dir: Path, split: str) -> Optional[Dict]:
+    path = Path(artifacts_dir) / SOURCE_FILES[split]
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return {"file": SOURCE_FILES[split], "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _column_array(values: pd.Series) -> np.ndarray:
+    arr = values.to_numpy()
+    if arr.dtype.kind in "biuf":
+        return np.ascontiguousarray(arr)
+    return values.astype(str).to_numpy(dtype=str)  # 文字欄位存成定長 unicode，不需要 pickle
+
+
+def write(artifacts_dir: Path, split: str, frame: pd.DataFrame, run_id: Optional[str] = None) -> Dict:
+    """Persist one split (one ``CustomerID`` row per customer) and return its manifest.
+
+    The files are written to a temporary folder that replaces the previous split
+    in one rename; the manifest records the run id and the Stage 4 file the
+    split was derived from, so readers can tell when it is stale.
+    """
+    target = _store_path(artifacts_dir, split)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    frame = frame.reset_index(drop=True)
+    frame[INDEX_COLUMN] = features.customer_ids(frame[INDEX_COLUMN])
+    if frame[INDEX_COLUMN].duplicated().any():
+        raise ValueError(f"{split} features have duplicate {INDEX_COLUMN} values")
+
+    tmp = target.parent / f".{split}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    columns = []
+    for i, name in enumerate([INDEX_COLUMN] + [c for c in frame.columns if c != INDEX_COLUMN]):
+        arr = _column_array(frame[name])
+        file = f"{i:03d}.npy"
+        np.save(tmp / file, arr, allow_pickle=False)
+        columns.append({"name": str(name), "dtype": arr.dtype.str, "file": file})
+    manifest = {
+        "version": STORE_VERSION,
+        "split": split,
+        "run_id": run_id or current_run_id(),
+        "created_at": time.time(),
+        "rows": int(len(frame)),
+        "index": INDEX_COLUMN,
+        "columns": columns[1:],
+        "index_column": columns[0],
+        "source": _source_stat(artifacts_dir, split),
+    }
+    write_json_atomic(tmp / MANIFEST_FILE, manifest)
+
+    old = target.parent / f".{split}.{os.getpid()}.{threading.get_ident()}.old"
+    if target.exists():
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+
+def write_splits(artifacts_dir: Path, frames: Dict[str, pd.DataFrame], run_id: Optional[str] = None) -> Dict[str, Dict]:
+    """``write`` several splits under one run id."""
+    run_id = run_id or current_run_id()
+    return {split: write(artifacts_dir, split, frame, run_id=run_id) for split, frame in frames.items()}
+
+
+def build(artifacts_dir: Path, split: str, run_id: Optional[str] = None) -> Dict:
+    """Derive ``split`` from its Stage 4 CSV (artifacts written before the store existed)."""
+    path = Path(artifacts_dir) / SOURCE_FILES[split]
+    if not path.exists():
+        raise FileNotFoundError(f"missing {SOURCE_FILES[split]} in {artifacts_dir}; run Stage 4 first")
+    source = pd.read_csv(path)
+    frame = features.test_customer_features(source) if split == "test" else source
+    return write(artifacts_dir, split, frame, run_id=run_id)
+
+
+def load_manifest(artifacts_dir: Path, split: str) -> Optional[Dict]:
+    try:
+        with open(_store_path(artifacts_dir, split) / MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _stale_reason(artifacts_dir: Path, split: str, manifest: Optional[Dict], run_id: Optional[str]) -> Optional[str]:
+    if manifest is None:
+        return "missing"
+    if int(manifest.get("version", 0)) != STORE_VERSION:
+        return f"version {manifest.get('version')}"
+    if run_id and manifest.get("run_id") != run_id:
+        return f"built by run {manifest.get('run_id')}"
+    source = _source_stat(artifacts_dir, split)
+    recorded = manifest.get("source")
+    if source is not None and recorded is not None and (
+        source["size"] != recorded.get("size") or source["mtime_ns"] != recorded.get("mtime_ns")
+    ):
+        return f"{source['file']} changed"
+    return None
+
+
+def _open(directory: Path, manifest: Dict) -> FeatureMatrix:
+    columns = {}
+    for spec in [manifest["index_column"]] + list(manifest["columns"]):
+        arr = np.load(directory / spec["file"], allow_pickle=False)
+        if len(arr) != manifest["rows"]:
+            raise ValueError(f"feature store column {spec['name']} in {directory} does not match its manifest")
+        columns[spec["name"]] = arr
+    return FeatureMatrix(manifest, columns)
+
+
+def load(artifacts_dir: Path, split: str, run_id: Optional[str] = None, build_missing: bool = True) -> FeatureMatrix:
+    """The ``split`` features of the run in ``artifacts_dir`` (cached per process).
+
+    ``run_id`` additionally requires the store to come from that run. A missing
+    or stale split is rebuilt from the Stage 4 CSV once (``build_missing``), or
+    ``FileNotFoundError`` is raised.
+    """
+    directory = _store_path(artifacts_dir, split)
+    manifest = load_manifest(artifacts_dir, split)
+    reason = _stale_reason(artifacts_dir, split, manifest, run_id)
+    if reason is not None:
+        if not build_missing:
+            raise FileNotFoundError(f"no usable {split} feature store in {artifacts_dir} ({reason})")
+        with _BUILD_LOCK:
+            manifest = load_manifest(artifacts_dir, split)
+            if _stale_reason(artifacts_dir, split, manifest, run_id) is not None:
+                print(f"[features] building the {split} feature store ({reason})")
+                manifest = build(artifacts_dir, split, run_id=run_id)
+
+    stat = (directory / MANIFEST_FILE).stat()
+    key = (str(directory.resolve()), stat.st_mtime_ns, stat.st_size)
+    with _CACHE_LOCK:
+        matrix = _CACHE.get(key)
+        if matrix is None:
+            for stale in [k for k in _CACHE if k[0] == key[0]]:
+                del _CACHE[stale]
+            while len(_CACHE) >= _CACHE_MAX:
+                del _CACHE[next(iter(_CACHE))]
+            matrix = _CACHE[key] = _open(directory, manifest)
+    return matrix
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# Stage 3 的產品群數（categ_0..categ_4）
+N_CATEGORIES = 5
+CATEG_COLUMNS = [f"categ_{i}" for i in range(N_CATEGORIES)]
+# 分類器的輸入欄位（Stage 5 訓練、Stage 6/7 評估與線上評分共用同一順序）
+FEATURE_COLUMNS = ["mean"] + CATEG_COLUMNS
+AGGREGATE_COLUMNS = ["count", "min", "max", "mean", "sum"] + CATEG_COLUMNS
+# Stage 6/7 以 kmeans_clients 貼標籤時的輸入欄位
+LABEL_COLUMNS = ["count", "min", "max", "mean"] + CATEG_COLUMNS
+# test 期的購買次數 ×5 對齊訓練期（與筆記一致）
+TEST_COUNT_SCALE = 5
+# Stage 4 沒有給群編號的客戶歸到 Standard
+DEFAULT_CLUSTER = 7
+
+PRODUCT_MAP_FILE = "stage3_desc_to_prod_cluster.csv"
+INVOICE_COLUMNS = ["CustomerID", "InvoiceNo", "Description", "Quantity", "UnitPrice"]
+
+
+def load_product_categories(artifacts_dir: Path) -> Dict[str, int]:
+    """Description -> Stage 3 product cluster, from ``stage3_desc_to_prod_cluster.csv``."""
+    path = Path(artifacts_dir) / PRODUCT_MAP_FILE
+    if not path.exists():
+        raise FileNotFoundError(f"missing {PRODUCT_MAP_FILE} in {artifacts_dir}; run Stage 3 first")
+    mapping = pd.read_csv(path, index_col=0, names=["categ_product"])
+    return mapping["categ_product"].to_dict()
+
+
+def basket_prices(lines: pd.DataFrame, product_categories: Dict[str, int]) -> pd.DataFrame:
+    """Invoice lines -> one row per (CustomerID, InvoiceNo) with ``Basket Price`` and ``categ_i`` spend.
+
+    Same rules as Stage 4: ``TotalPrice = UnitPrice * (Quantity - QuantityCanceled)``,
+    category spend is clipped at 0 and baskets whose total is not positive are dropped.
+    """
+    missing = [c for c in INVOICE_COLUMNS if c not in lines.columns]
+    if missing:
+        raise ValueError(f"invoice lines are missing columns: {missing}")
+    df = lines.copy()
+    df["CustomerID"] = df["CustomerID"].astype(str)
+    df["categ_product"] = df["Description"].map(product_categories).fillna(-1).astype(int)
+    canceled = df["QuantityCanceled"].fillna(0) if "QuantityCanceled" in df.columns else 0.0
+    df["TotalPrice"] = df["UnitPrice"].astype(float) * (df["Quantity"].astype(float) - canceled)
+    for i, col in enumerate(CATEG_COLUMNS):
+        df[col] = df["TotalPrice"].clip(lower=0).where(df["categ_product"].eq(i), 0.0)
+
+    baskets = df.groupby(["CustomerID", "InvoiceNo"], as_index=False)[["TotalPrice"] + CATEG_COLUMNS].sum()
+    baskets = baskets.rename(columns={"TotalPrice": "Basket Price"})
+    return baskets[baskets["Basket Price"] > 0].reset_index(drop=True)
+
+
+def customer_aggregates(baskets: pd.DataFrame, count_scale: Optional[float] = None) -> pd.DataFrame:
+    """Basket rows -> one row per customer (Stage 6 logic): ``count/min/max/mean/sum`` of
+    ``Basket Price`` and ``categ_i`` as percent of the customer's spend.
+
+    ``count_scale`` stretches ``count`` (and ``sum``) of a short period to the
+    training period, as Stage 6 does for the test months.
+    """
+    grouped = baskets.groupby(by=["CustomerID"])
+    per_user = grouped["Basket Price"].agg(["count", "min", "max", "mean", "sum"])
+    for col in CATEG_COLUMNS:
+        per_user.loc[:, col] = grouped[col].sum() / per_user["sum"] * 100
+    per_user.reset_index(drop=False, inplace=True)
+    if count_scale is not None:
+        per_user["count"] = count_scale * per_user["count"]
+        per_user["sum"] = per_user["count"] * per_user["mean"]
+    return per_user
+
+
+def customer_ids(values: pd.Series) -> pd.Series:
+    """CustomerID as int64 when every value is a whole number (``"12346"``, ``12346.0``), otherwise as text."""
+    numeric = pd.to_numeric(values, errors="coerce")
+    if len(values) and numeric.notna().all() and (numeric % 1 == 0).all():
+        return numeric.astype(np.int64)
+    return values.astype(str)
+
+
+def test_customer_features(set_test: pd.DataFrame) -> pd.DataFrame:
+    """Stage 4 test-period baskets -> one row per customer, as Stage 6/7 evaluate them.
+
+    Aggregates with ``count`` stretched by ``TEST_COUNT_SCALE``, plus ``cluster``:
+    the customer's most frequent Stage 4 cluster (smallest on ties,
+    ``DEFAULT_CLUSTER`` when there is none).
+    """
+    baskets = set_test.assign(CustomerID=customer_ids(set_test["CustomerID"]))
+    per_user = customer_aggregates(baskets, count_scale=TEST_COUNT_SCALE)
+    if "cluster" in baskets.columns:
+        counts = baskets.groupby(["CustomerID", "cluster"]).size().reset_index(name="n")
+        counts = counts.sort_values(["CustomerID", "n", "cluster"], ascending=[True, False, True])
+        mode = counts.drop_duplicates("CustomerID").set_index("CustomerID")["cluster"]
+        per_user["cluster"] = per_user["CustomerID"].map(mode).fillna(DEFAULT_CLUSTER).astype(int).to_numpy()
+    return per_user
+
+
+def feature_frame(rows: pd.DataFrame) -> pd.DataFrame:
+    """Classifier input in ``FEATURE_COLUMNS`` order; raises ``ValueError`` on missing or non-finite values."""
+    missing = [c for c in FEATURE_COLUMNS if c not in rows.columns]
+    if missing:
+        raise ValueError(f"customer rows are missing feature columns: {missing}")
+    X = rows[FEATURE_COLUMNS].astype(float)
+    if not np.isfinite(X.to_numpy()).all():
+        raise ValueError("customer features must be finite numbers")
+    return X
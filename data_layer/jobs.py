@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .progress import PROGRESS_BUS
+
+DATA_LAYER_DIR = Path(__file__).resolve().parent
+JOBS_DIR = DATA_LAYER_DIR / "jobs"
+
+# Number of pipelines allowed to run at the same time on this node
+PIPELINE_MAX_CONCURRENT = max(1, int(os.environ.get("PIPELINE_MAX_CONCURRENT", "1")))
+# Finished job folders kept on disk (oldest are pruned first)
+PIPELINE_MAX_JOB_HISTORY = int(os.environ.get("PIPELINE_MAX_JOB_HISTORY", "20"))
+
+UPLOAD_FILENAME = "data.csv"
+JOB_FILENAME = "job.json"
+
+FINISHED_STATES = ("done", "failed", "cancelled")
+
+
+@dataclass
+class Job:
+    job_id: str
+    job_dir: Path
+    priority: int = 0
+    status: str = "created"
+    submitted_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    meta: Dict = field(default_factory=dict)
+    artifacts_dir: Optional[Path] = None
+    # set by JobManager.cancel(); the pipeline polls it between and during stages
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.artifacts_dir is None:
+            self.artifacts_dir = self.job_dir / "artifacts"
+
+    @property
+    def upload_file(self) -> Path:
+        return self.job_dir / "uploads" / UPLOAD_FILENAME
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def as_dict(self, include_result: bool = False) -> Dict:
+        payload = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "priority": self.priority,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "artifacts_dir": str(self.artifacts_dir),
+            "meta": self.meta,
+        }
+        if include_result:
+            payload["result"] = self.result
+        return payload
+
+    @classmethod
+    def from_dict(cls, data: Dict, job_dir: Path) -> "Job":
+        return cls(
+            job_id=data["job_id"],
+            job_dir=job_dir,
+            priority=int(data.get("priority", 0)),
+            status=data.get("status", "failed"),
+            submitted_at=data.get("submitted_at"),
+            started_at=data.get("started_at"),
+            finished_at=data.get("finished_at"),
+            result=data.get("result"),
+            error=data.get("error"),
+            meta=data.get("meta") or {},
+            artifacts_dir=Path(data["artifacts_dir"]) if data.get("artifacts_dir") else None,
+        )
+
+
+class JobManager:
+    """Priority/FIFO queue of pipeline jobs drained by a bounded pool of worker threads.
+
+    Each job owns ``jobs/<job_id>/uploads/data.csv`` and ``jobs/<job_id>/artifacts/``
+    so concurrent runs never touch each other's files. Higher ``priority`` runs
+    first; equal priorities run in submission order. ``job.json`` mirrors every
+    state change so status and results survive a server restart.
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[Job], Dict],
+        *,
+        jobs_dir: Path = JOBS_DIR,
+        max_concurrent: int = PIPELINE_MAX_CONCURRENT,
+        max_history: int = PIPELINE_MAX_JOB_HISTORY,
+        on_finished: Optional[Callable[[Job, str], None]] = None,
+    ):
+        self.runner = runner
+        self.jobs_dir = Path(jobs_dir)
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_history = max_history
+        # on_finished(job, final_status) runs while the job still reads as running; the final status is set after it
+        self.on_finished = on_finished
+        self._jobs: Dict[str, Job] = {}
+        self._queue: List = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+
+    # ---- lifecycle ----
+    def _ensure_workers(self) -> None:
+        while len(self._workers) < self.max_concurrent:
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"pipeline-worker-{len(self._workers)}", daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def _persist(self, job: Job) -> None:
+        """Write ``job.json`` and announce the new state to progress listeners."""
+        PROGRESS_BUS.publish(job.job_id, "job", job.as_dict())
+        try:
+            job.job_dir.mkdir(parents=True, exist_ok=True)
+            path = job.job_dir / JOB_FILENAME
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job.as_dict(include_result=True), f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Warning: failed to persist job {job.job_id}: {e}")
+
+    # ---- public API ----
+    def create(self, *, priority: int = 0, meta: Optional[Dict] = None) -> Job:
+        """Allocate a job id and its private folders; the caller fills ``job.upload_file``."""
+        job_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        job = Job(job_id=job_id, job_dir=self.jobs_dir / job_id, priority=priority, meta=dict(meta or {}))
+        job.upload_file.parent.mkdir(parents=True, exist_ok=True)
+        job.artifacts_dir.mkdir(parents=True, exist_ok=True)
+        with self._cond:
+            self._jobs[job_id] = job
+        return job
+
+    def submit(self, job: Job) -> Job:
+        with self._cond:
+            job.status = "queued"
+            job.submitted_at = time.time()
+            heapq.heappush(self._queue, (-job.priority, next(self._seq), job.job_id))
+            self._persist(job)
+            self._ensure_workers()
+            self._cond.notify()
+        return job
+
+    def complete(self, job: Job, *, status: str, result: Optional[Dict] = None, error: Optional[str] = None) -> Job:
+        """Mark a job finished without running it (e.g. served from the run cache)."""
+        with self._cond:
+            now = time.time()
+            job.submitted_at = job.submitted_at or now
+            job.started_at = job.started_at or now
+            job.finished_at = now
+            job.status = status
+            job.result = result
+            job.error = error
+            self._persist(job)
+        self.prune()
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancel a queued job immediately, or ask a running job to stop.
+
+        A running job is marked ``cancelled`` by its worker once the pipeline has
+        killed the current stage. Returns None for unknown jobs.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.cancel_event.set()
+            if job.status in ("created", "queued"):
+                self._queue = [entry for entry in self._queue if entry[2] != job_id]
+                heapq.heapify(self._queue)
+                now = time.time()
+                job.status = "cancelled"
+                job.error = "Cancelled before the pipeline started"
+                job.started_at = job.started_at or now
+                job.finished_at = now
+                self._persist(job)
+        return job
+
+    def discard(self, job: Job) -> None:
+        """Forget a job that was created but never submitted (e.g. failed upload)."""
+        with self._cond:
+            self._jobs.pop(job.job_id, None)
+        shutil.rmtree(job.job_dir, ignore_errors=True)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        # jobs from a previous server process are only known through job.json
+        job_dir = self.jobs_dir / job_id
+        path = job_dir / JOB_FILENAME
+        if not path.exists() or job_dir.parent != self.jobs_dir:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                job = Job.from_dict(json.load(f), job_dir)
+        except Exception as e:
+            print(f"Warning: failed to read job {job_id}: {e}")
+            return None
+        if not job.finished:
+            # the process that owned the queue is gone; the job will never run
+            job.status = "failed"
+            job.error = job.error or "Server restarted before the job finished"
+        return job
+
+    def list(self) -> List[Job]:
+        with self._cond:
+            return sorted(self._jobs.values(), key=lambda j: j.submitted_at or 0, reverse=True)
+
+    def latest(self) -> Optional[Job]:
+        jobs = [j for j in self.list() if j.submitted_at is not None]
+        return jobs[0] if jobs else None
+
+    def find_active(self, predicate: Callable[[Job], bool]) -> Optional[Job]:
+        """Return a queued/running job matching ``predicate`` (used to coalesce duplicate uploads)."""
+        with self._cond:
+            for job in self._jobs.values():
+                if job.status in ("queued", "running") and predicate(job):
+                    return job
+        return None
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """1-based position among queued jobs, or None if the job is not waiting."""
+        with self._cond:
+            order = [entry[2] for entry in sorted(self._queue)]
+        return order.index(job_id) + 1 if job_id in order else None
+
+    def running_count(self) -> int:
+        with self._cond:
+            return sum(1 for j in self._jobs.values() if j.status == "running")
+
+    def prune(self) -> List[str]:
+        """Delete the folders of the oldest finished jobs beyond ``max_history``."""
+        if self.max_history <= 0:
+            return []
+        with self._cond:
+            finished = sorted(
+                (j for j in self._jobs.values() if j.finished),
+                key=lambda j: j.finished_at or 0,
+                reverse=True,
+            )
+            stale = finished[self.max_history:]
+            for job in stale:
+                self._jobs.pop(job.job_id, None)
+        for job in stale:
+            shutil.rmtree(job.job_dir, ignore_errors=True)
+        return [job.job_id for job in stale]
+
+    # ---- worker ----
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, job_id = heapq.heappop(self._queue)
+                job = self._jobs.get(job_id)
+                if job is None or job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started_at = time.time()
+                self._persist(job)
+
+            # 最終狀態先算好，但 job 維持 running，直到完成 hook 發布 artifacts 並換好 artifacts_dir；
+            # 否則客戶端可能看到 done，卻還讀到上一次的 artifacts（或正被搬進快取的資料夾）
+            try:
+                result = self.runner(job)
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"Pipeline job {job.job_id} failed: {exc}")
+                result, status, error = None, "failed", str(exc)
+            else:
+                # Stage 1–7 decide success; a Stage 8 (DB import) failure is reported in the result only
+                if (result or {}).get("cancelled"):
+                    status, error = "cancelled", result.get("cancel_reason") or "Cancelled"
+                elif (result or {}).get("primary_stages_ok"):
+                    status, error = "done", None
+                else:
+                    failed = [r.get("stage") for r in (result or {}).get("stages", []) if r.get("status") != "ok"]
+                    status, error = "failed", f"Pipeline finished with errors: {', '.join(failed) or 'incomplete'}"
+
+            job.result = result
+            if error is not None:
+                job.error = error
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(job, status)
+                except Exception as exc:  # pylint: disable=broad-except
+                    print(f"Warning: job {job.job_id} completion hook failed: {exc}")
+            with self._cond:
+                job.status = status
+                job.finished_at = time.time()
+                self._persist(job)
+            self.prune()
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import copy
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# float32 矩陣乘法找候選鄰居：auto = 建索引時量測，比 KD/Ball tree 快才用；1 = 一律用；0 = 一律走 tree
+KNN_FLOAT32 = os.environ.get("RFM_KNN_FLOAT32", "auto").strip().lower()
+# 快取幾列查詢的鄰居結果（0 = 不快取）
+KNN_CACHE_ROWS = max(0, int(os.environ.get("RFM_KNN_CACHE_ROWS", "20000")))
+# 特徵數不超過這個值用 KD tree，否則 Ball tree（與 scikit-learn 的 auto 規則相同）
+KD_TREE_MAX_FEATURES = 15
+# float32 多取幾個候選，再以 float64 距離重排取前 k 個
+CANDIDATE_MARGIN = 8
+BLOCK_ROWS = 256
+CALIBRATION_ROWS = 256
+
+# 以 knn 本身為弱參照 key：模型（例如被新 bundle 取代的舊 bundle）釋放時，索引與快取一起釋放
+_INDEXED: "weakref.WeakKeyDictionary[object, Optional[IndexedKNN]]" = weakref.WeakKeyDictionary()
+_INDEXED_LOCK = threading.Lock()
+
+
+def _tree_class(n_features: int):
+    if n_features <= KD_TREE_MAX_FEATURES:
+        from sklearn.neighbors import KDTree
+
+        return "kd_tree", KDTree
+    from sklearn.neighbors import BallTree
+
+    return "ball_tree", BallTree
+
+
+class IndexedKNN(object):
+    """Drop-in ``predict``/``predict_proba`` for a fitted ``KNeighborsClassifier``.
+
+    Queries go to a prebuilt KD/Ball tree (the same search as scikit-learn) or,
+    when it measures faster (the usual case for a few thousand customers), to a
+    float32 block search: one BLAS product per block of rows for candidate
+    neighbours, re-ranked by exact float64 distances. Duplicate rows of a batch
+    are searched once and neighbour lists of recent rows are kept in a bounded
+    LRU cache, so scoring KNN and the voting model over the same rows searches
+    once. Votes are tallied exactly as scikit-learn does.
+    """
+
+    def __init__(self, knn, float32: str = KNN_FLOAT32, cache_rows: int = KNN_CACHE_ROWS):
+        metric = knn.effective_metric_
+        if getattr(knn, "outputs_2d_", False) or metric not in ("euclidean", "minkowski"):
+            raise ValueError(f"unsupported KNN configuration: metric={metric!r}")
+        if metric == "minkowski" and knn.effective_metric_params_.get("p", 2) != 2:
+            raise ValueError("only the euclidean metric is supported")
+        self.classes_ = knn.classes_
+        self.n_features_in_ = knn.n_features_in_
+        self.n_neighbors = knn.n_neighbors
+        self.weights = knn.weights
+        self._fit_X = np.ascontiguousarray(knn._fit_X, dtype=np.float64)
+        self._y = np.asarray(knn._y)
+        self.algorithm, tree_class = _tree_class(self.n_features_in_)
+        self.index = tree_class(self._fit_X, leaf_size=knn.leaf_size)
+        # float32 區塊搜尋：|x - f|^2 = |x|^2 - 2 x·f + |f|^2，|x|^2 對同一列是常數可省略
+        self._fit_T32 = np.ascontiguousarray(self._fit_X.T, dtype=np.float32)
+        self._fit_norm32 = (self._fit_X.astype(np.float32) ** 2).sum(axis=1)
+        self.n_candidates = min(len(self._fit_X), self.n_neighbors + CANDIDATE_MARGIN)
+        if float32 in ("0", "false", "no"):
+            self.block_search = False
+        elif float32 in ("1", "true", "yes"):
+            self.block_search = True
+        else:
+            self.block_search = self._calibrate()
+        self.cache_rows = cache_rows
+        self._cache: "OrderedDict[bytes, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _block_search(self, Xq: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        k, c = self.n_neighbors, self.n_candidates
+        dist = np.empty((len(Xq), k), dtype=np.float64)
+        ind = np.empty((len(Xq), k), dtype=np.intp)
+        for start in range(0, len(Xq), BLOCK_ROWS):
+            q = Xq[start:start + BLOCK_ROWS]
+            d32 = q.astype(np.float32) @ self._fit_T32
+            d32 *= -2
+            d32 += self._fit_norm32
+            cand = np.argpartition(d32, c - 1, axis=1)[:, :c] if c < d32.shape[1] else np.argsort(d32, axis=1)
+            d64 = ((self._fit_X[cand] - q[:, None, :]) ** 2).sum(axis=2)
+            order = np.argsort(d64, axis=1, kind="stable")[:, :k]
+            dist[start:start + BLOCK_ROWS] = np.sqrt(np.take_along_axis(d64, order, axis=1))
+            ind[start:start + BLOCK_ROWS] = np.take_along_axis(cand, order, axis=1)
+        return dist, ind
+
+    def _tree_search(self, Xq: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        dist, ind = self.index.query(Xq, k=self.n_neighbors, return_distance=True)
+        return np.asarray(dist), np.asarray(ind)
+
+    def _calibrate(self, repeat: int = 3) -> bool:
+        """True when the block search beats the tree on ``CALIBRATION_ROWS`` training rows."""
+        Xq = np.ascontiguousarray(np.resize(self._fit_X, (CALIBRATION_ROWS, self.n_features_in_)))
+        best = []
+        for fn in (self._tree_search, self._block_search):
+            fn(Xq)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                fn(Xq)
+                timings.append(time.perf_counter() - started)
+            best.append(min(timings))
+        return best[1] < best[0]
+
+    def _query(self, Xq: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self._block_search(Xq) if self.block_search else self._tree_search(Xq)
+
+    def kneighbors(self, X) -> Tuple[np.ndarray, np.ndarray]:
+        """Distances and training-row indices of the ``n_neighbors`` nearest customers, nearest first."""
+        Xq = np.ascontiguousarray(np.asarray(X, dtype=np.float64))
+        if Xq.ndim != 2 or Xq.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {Xq.shape[-1]} features, expected {self.n_features_in_}")
+        uniq, inverse = np.unique(Xq, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if not self.cache_rows:
+            dist, ind = self._query(uniq)
+            return dist[inverse], ind[inverse]
+
+        keys = [row.tobytes() for row in uniq]
+        dist = np.empty((len(uniq), self.n_neighbors), dtype=np.float64)
+        ind = np.empty((len(uniq), self.n_neighbors), dtype=np.intp)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                hit = self._cache.get(key)
+                if hit is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    dist[i], ind[i] = hit
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            d, n = self._query(uniq[missing])
+            dist[missing], ind[missing] = d, n
+            with self._lock:
+                for j, i in enumerate(missing):
+                    self._cache[keys[i]] = (d[j], n[j])
+                while len(self._cache) > self.cache_rows:
+                    self._cache.popitem(last=False)
+        return dist[inverse], ind[inverse]
+
+    def predict_proba(self, X) -> np.ndarray:
+        dist, ind = self.kneighbors(X)
+        if self.weights == "uniform":
+            weights = np.ones_like(ind)
+        elif self.weights == "distance":
+            with np.errstate(divide="ignore"):
+                weights = 1.0 / dist
+            exact = np.isinf(weights).any(axis=1)
+            weights[exact] = np.isinf(weights[exact]).astype(float)
+        else:
+            weights = self.weights(dist)
+        labels = self._y[ind]
+        proba = np.zeros((len(ind), len(self.classes_)))
+        rows = np.arange(len(ind))
+        for i, idx in enumerate(labels.T):  # 與 KNeighborsClassifier.predict_proba 相同的累加
+            proba[rows, idx] += weights[:, i]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba /= normalizer
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def cache_info(self) -> Dict:
+        with self._lock:
+            return {
+                "search": "float32_block" if self.block_search else self.algorithm,
+                "rows": len(self._cache),
+                "max_rows": self.cache_rows,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def indexed(knn) -> Optional[IndexedKNN]:
+    """Cached ``IndexedKNN`` for ``knn`` per process (None for anything that is not a supported KNN)."""
+    from sklearn.neighbors import KNeighborsClassifier
+
+    if not isinstance(knn, KNeighborsClassifier):
+        return None
+    with _INDEXED_LOCK:
+        if knn in _INDEXED:
+            return _INDEXED[knn]
+    try:
+        result = IndexedKNN(knn)  # 不持有 knn 本身，否則弱參照 key 永遠不會被釋放
+    except (ValueError, AttributeError):
+        result = None
+    with _INDEXED_LOCK:
+        _INDEXED[knn] = result
+    return result
+
+
+def accelerate(models: Dict[str, object]) -> Dict[str, object]:
+    """``models`` with every KNN — standalone or inside a voting ensemble — replaced by its ``IndexedKNN``.
+
+    Ensembles are shallow-copied, so the loaded (cached) bundle stays untouched;
+    a KNN shared by reference keeps sharing one index and one neighbour cache.
+    """
+    out = {}
+    for name, est in models.items():
+        fast = indexed(est)
+        if fast is not None:
+            out[name] = fast
+            continue
+        members = getattr(est, "estimators_", None)
+        if isinstance(members, list) and any(indexed(m) is not None for m in members):
+            est = copy.copy(est)
+            est.estimators_ = [indexed(m) or m for m in members]
+        out[name] = est
+    return out
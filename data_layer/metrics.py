@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .progress import write_json_atomic
+
+DATA_LAYER_DIR = Path(__file__).resolve().parent
+STATE_DIR = DATA_LAYER_DIR / "state"
+METRICS_FILE = STATE_DIR / "pipeline_metrics.json"
+
+# Number of pipeline runs kept in pipeline_metrics.json
+PIPELINE_METRICS_HISTORY = int(os.environ.get("PIPELINE_METRICS_HISTORY", "200"))
+# How often a running stage's process tree is sampled
+METRICS_SAMPLE_INTERVAL_SEC = float(os.environ.get("METRICS_SAMPLE_INTERVAL_SEC", "0.5"))
+
+# Bookkeeping files that every stage touches
+_ARTIFACT_EXCLUDE = {"pipeline_logs.txt", "pipeline_status.json"}
+
+_HISTORY_LOCK = threading.Lock()
+
+try:
+    _CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):  # non-POSIX
+    _CLOCK_TICKS = 100
+    _PAGE_SIZE = 4096
+
+# (cpu_user_sec, cpu_system_sec, rss_bytes, read_bytes, write_bytes)
+Usage = Tuple[float, float, int, int, int]
+
+
+# ---------------------------------------------------------------------------
+# Process sampling
+# ---------------------------------------------------------------------------
+def _read_proc_io(path: str) -> Tuple[int, int]:
+    """Bytes read/written through syscalls (``rchar``/``wchar``), so page-cache hits count too."""
+    values = {}
+    try:
+        with open(path, "r", encoding="ascii") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                values[key] = int(value)
+    except (OSError, ValueError):
+        return 0, 0
+    return values.get("rchar", 0), values.get("wchar", 0)
+
+
+def _tree_usage_psutil(root_pid: int, recursive: bool) -> Dict[int, Usage]:
+    import psutil  # type: ignore
+
+    try:
+        root = psutil.Process(root_pid)
+        procs = [root] + (root.children(recursive=True) if recursive else [])
+    except psutil.NoSuchProcess:
+        return {}
+    usage: Dict[int, Usage] = {}
+    for proc in procs:
+        try:
+            with proc.oneshot():
+                cpu = proc.cpu_times()
+                rss = proc.memory_info().rss
+                try:
+                    io = proc.io_counters()
+                    read = getattr(io, "read_chars", io.read_bytes)
+                    write = getattr(io, "write_chars", io.write_bytes)
+                except (AttributeError, psutil.AccessDenied):
+                    read = write = 0
+            usage[proc.pid] = (cpu.user, cpu.system, rss, read, write)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    return usage
+
+
+def _tree_usage_proc(root_pid: int, recursive: bool) -> Dict[int, Usage]:
+    stats: Dict[int, List[str]] = {}
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r", encoding="ascii", errors="replace") as f:
+                raw = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces, fields start after the closing parenthesis
+        fields = raw[raw.rfind(")") + 2:].split()
+        pid = int(entry)
+        stats[pid] = fields
+        children.setdefault(int(fields[1]), []).append(pid)
+
+    usage: Dict[int, Usage] = {}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        fields = stats.get(pid)
+        if fields is None:
+            continue
+        read, write = _read_proc_io(f"/proc/{pid}/io")
+        usage[pid] = (
+            int(fields[11]) / _CLOCK_TICKS,
+            int(fields[12]) / _CLOCK_TICKS,
+            int(fields[21]) * _PAGE_SIZE,
+            read,
+            write,
+        )
+        if recursive:
+            pending.extend(children.get(pid, []))
+    return usage
+
+
+def process_tree_usage(root_pid: int, recursive: bool = True) -> Dict[int, Usage]:
+    """Cumulative usage of ``root_pid`` and (``recursive``) its descendants, via psutil or /proc on Linux."""
+    try:
+        import psutil  # type: ignore  # noqa: F401
+
+        return _tree_usage_psutil(root_pid, recursive)
+    except ImportError:
+        pass
+    if os.path.isdir("/proc"):
+        return _tree_usage_proc(root_pid, recursive)
+    return {}
+
+
+class ProcessTreeSampler:
+    """Polls a stage process tree (script + joblib workers) while the stage runs.
+
+    Counters are taken relative to the first sample, so a long-lived worker only
+    reports what the current stage used. Peak RSS is the largest summed RSS seen.
+    """
+
+    def __init__(self, interval: float = METRICS_SAMPLE_INTERVAL_SEC, *, recursive: bool = True):
+        self.interval = interval
+        self.recursive = recursive
+        self.pid: Optional[int] = None
+        self._baseline: Dict[int, Usage] = {}
+        self._last: Dict[int, Usage] = {}
+        self._peak_rss = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, pid: int) -> None:
+        self.pid = pid
+        self._baseline = process_tree_usage(pid, self.recursive)
+        self._record(self._baseline)
+        self._thread = threading.Thread(target=self._loop, name=f"metrics-{pid}", daemon=True)
+        self._thread.start()
+
+    def _record(self, snapshot: Dict[int, Usage]) -> None:
+        if not snapshot:
+            return
+        self._last.update(snapshot)
+        self._peak_rss = max(self._peak_rss, sum(u[2] for u in snapshot.values()))
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self._record(process_tree_usage(self.pid, self.recursive))
+            except Exception:
+                pass
+
+    def stop(self) -> Optional[Dict]:
+        if self.pid is None:
+            return None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._record(process_tree_usage(self.pid, self.recursive))
+        if not self._last:
+            return None
+        totals = [0.0, 0.0, 0, 0, 0]
+        for pid, last in self._last.items():
+            base = self._baseline.get(pid, (0.0, 0.0, 0, 0, 0))
+            for idx in (0, 1, 3, 4):
+                totals[idx] += max(0, last[idx] - base[idx])
+        return _usage_dict(totals[0], totals[1], self._peak_rss, totals[3], totals[4], scope="process_tree")
+
+
+class ThreadUsage:
+    """CPU and I/O of the calling thread, for stages that run inside the server (Stage 1 and 8).
+
+    Peak RSS can only be observed for the whole server process.
+    """
+
+    def __init__(self):
+        self._start: Optional[Tuple[float, float, int, int]] = None
+        # the server's own process only; its children are the stage workers
+        self._sampler = ProcessTreeSampler(recursive=False)
+        self.result: Optional[Dict] = None
+
+    @staticmethod
+    def _now() -> Tuple[float, float, int, int]:
+        try:
+            import resource
+
+            who = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+            ru = resource.getrusage(who)
+            user, system = ru.ru_utime, ru.ru_stime
+        except ImportError:  # Windows
+            times = os.times()
+            user, system = times.user, times.system
+        read, write = _read_proc_io("/proc/thread-self/io") if os.path.exists("/proc/thread-self/io") else (0, 0)
+        return user, system, read, write
+
+    def __enter__(self) -> "ThreadUsage":
+        self._start = self._now()
+        self._sampler.start(os.getpid())
+        return self
+
+    def __exit__(self, *exc) -> None:
+        end = self._now()
+        process = self._sampler.stop() or {}
+        self.result = _usage_dict(
+            end[0] - self._start[0],
+            end[1] - self._start[1],
+            int((process.get("peak_rss_mb") or 0) * 1024 * 1024),
+            end[2] - self._start[2],
+            end[3] - self._start[3],
+            scope="thread",
+        )
+
+
+def _usage_dict(cpu_user: float, cpu_system: float, peak_rss: int, read: int, write: int, *, scope: str) -> Dict:
+    return {
+        "cpu_user_sec": round(cpu_user, 3),
+        "cpu_system_sec": round(cpu_system, 3),
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+        "read_bytes": int(read),
+        "write_bytes": int(write),
+        "scope": scope,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Artifacts
+# ---------------------------------------------------------------------------
+def snapshot_artifacts(artifacts_dir: Path) -> Dict[str, Tuple[int, int]]:
+    """``{relative path: (mtime_ns, size)}`` for every file under ``artifacts_dir``."""
+    snapshot = {}
+    if not artifacts_dir.exists():
+        return snapshot
+    for path in artifacts_dir.rglob("*"):
+        if path.is_file() and path.name not in _ARTIFACT_EXCLUDE:
+            st = path.stat()
+            snapshot[path.relative_to(artifacts_dir).as_posix()] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def _count_rows(path: Path) -> Optional[int]:
+    suffix = path.suffix.lower()
+    try:
+        if suffix == ".csv":
+            lines = 0
+            last = b"\n"
+            with open(path, "rb") as f:
+                while True:
+                    block = f.read(1 << 20)
+                    if not block:
+                        break
+                    lines += block.count(b"\n")
+                    last = block[-1:]
+            if last != b"\n":
+                lines += 1
+            return max(0, lines - 1)  # header
+        if suffix == ".npy":
+            import numpy as np
+
+            return int(np.load(path, mmap_mode="r", allow_pickle=False).shape[0])
+    except Exception:
+        return None
+    return None
+
+
+def artifact_changes(artifacts_dir: Path, before: Dict[str, Tuple[int, int]]) -> List[Dict]:
+    """Files created or rewritten since ``before`` with their size and row count (CSV/NPY)."""
+    changes = []
+    for name, stamp in sorted(snapshot_artifacts(artifacts_dir).items()):
+        if before.get(name) == stamp:
+            continue
+        changes.append({"name": name, "bytes": stamp[1], "rows": _count_rows(artifacts_dir / name)})
+    return changes
+
+
+# ---------------------------------------------------------------------------
+# History
+# ---------------------------------------------------------------------------
+def load_history(path: Path = METRICS_FILE) -> List[Dict]:
+    if not path.exists():
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"Warning: failed to read pipeline metrics: {e}")
+        return []
+    return data.get("runs", []) if isinstance(data, dict) else []
+
+
+def record_run(entry: Dict, path: Path = METRICS_FILE, max_runs: int = PIPELINE_METRICS_HISTORY) -> None:
+    """Append one pipeline run to the metrics history (oldest runs beyond ``max_runs`` are dropped)."""
+    with _HISTORY_LOCK:
+        try:
+            runs = load_history(path)
+            runs.append(entry)
+            if max_runs > 0:
+                runs = runs[-max_runs:]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_json_atomic(path, {"runs": runs})
+        except Exception as e:
+            print(f"Warning: failed to record pipeline metrics: {e}")
+
+
+def summarize(runs: List[Dict]) -> Dict[str, Dict]:
+    """Per-stage aggregates over ``runs`` (successful stage executions only)."""
+    per_stage: Dict[str, List[Dict]] = {}
+    for run in runs:
+        for stage in run.get("stages", []):
+            if stage.get("status") == "ok":
+                per_stage.setdefault(stage["stage"], []).append(stage)
+
+    def _values(items: List[Dict], key: str) -> List[float]:
+        return [float(i[key]) for i in items if i.get(key) is not None]
+
+    summary = {}
+    for name, items in per_stage.items():
+        durations = _values(items, "duration_sec")
+        cpu = [u + s for u, s in zip(_values(items, "cpu_user_sec"), _values(items, "cpu_system_sec"))]
+        rss = _values(items, "peak_rss_mb")
+        # relative ETA error of runs that had a prediction, to judge whether the estimates can be trusted
+        eta_errors = [
+            abs(i["estimated_sec"] - i["duration_sec"]) / i["duration_sec"]
+            for i in items
+            if i.get("estimated_sec") is not None and i.get("duration_sec")
+        ]
+        summary[name] = {
+            "runs": len(items),
+            "duration_sec_mean": round(statistics.fmean(durations), 3) if durations else None,
+            "duration_sec_median": round(statistics.median(durations), 3) if durations else None,
+            "duration_sec_max": round(max(durations), 3) if durations else None,
+            "cpu_sec_mean": round(statistics.fmean(cpu), 3) if cpu else None,
+            "peak_rss_mb_max": round(max(rss), 1) if rss else None,
+            "eta_error_pct_median": round(100 * statistics.median(eta_errors), 1) if eta_errors else None,
+        }
+    return summary
+
+
+def stage_metrics(usage: Optional[Dict], artifacts: Optional[List[Dict]] = None) -> Dict:
+    """Flatten a usage dict plus produced artifacts into the per-stage metrics record."""
+    metrics = dict(usage or {})
+    if artifacts is not None:
+        metrics["artifacts"] = artifacts
+        metrics["artifact_bytes"] = sum(a["bytes"] for a in artifacts)
+    return metrics
+
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from . import features
+from .scoring import Scorer
+
+# 等待湊批的最長時間（毫秒，0 = 不湊批，每個請求各自評分）與每批最多客戶數
+SCORE_BATCH_WINDOW_MS = float(os.environ.get("SCORE_BATCH_WINDOW_MS", "5"))
+SCORE_BATCH_MAX_ROWS = max(1, int(os.environ.get("SCORE_BATCH_MAX_ROWS", "1024")))
+# 延遲統計保留最近幾筆
+SCORE_BATCH_HISTORY = max(10, int(os.environ.get("SCORE_BATCH_HISTORY", "2000")))
+
+
+class _Pending:
+    __slots__ = ("rows", "models", "exact", "future", "enqueued")
+
+    def __init__(self, rows: pd.DataFrame, models: Optional[List[str]], exact: bool = False):
+        self.rows = rows
+        self.models = models
+        self.exact = exact
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+
+
+def _percentiles(values) -> Dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    arr = np.fromiter(values, dtype=float)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99]).tolist()
+    return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3), "max": round(float(arr.max()), 3)}
+
+
+class MicroBatcher:
+    """Coalesces concurrent ``Scorer.score`` calls into one vectorized call per batch.
+
+    The first queued request opens a window of ``window_ms``; requests arriving
+    within it join the batch until ``max_rows`` customers are collected. The
+    batch is scored once (one ``predict_proba`` per model over all rows) and
+    every caller gets back its own row slice. A failing batch is retried per
+    request so one bad request cannot fail its neighbours.
+    """
+
+    def __init__(self, scorer: Scorer, window_ms: float = SCORE_BATCH_WINDOW_MS, max_rows: int = SCORE_BATCH_MAX_ROWS):
+        self.scorer = scorer
+        self.window_sec = max(0.0, window_ms) / 1000.0
+        self.max_rows = max(1, int(max_rows))
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._queued_rows = 0
+        self._in_flight = 0
+        self._counts = {"requests": 0, "rows": 0, "batches": 0, "errors": 0, "batch_retries": 0}
+        self._wait_ms: deque = deque(maxlen=SCORE_BATCH_HISTORY)
+        self._total_ms: deque = deque(maxlen=SCORE_BATCH_HISTORY)
+        self._batch_ms: deque = deque(maxlen=SCORE_BATCH_HISTORY)
+        self._batch_requests: deque = deque(maxlen=SCORE_BATCH_HISTORY)
+        self._batch_rows: deque = deque(maxlen=SCORE_BATCH_HISTORY)
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_sec > 0
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="score-micro-batch", daemon=True)
+                self._thread.start()
+
+    def submit(self, rows: pd.DataFrame, models: Optional[Sequence[str]] = None, exact: bool = False) -> Future:
+        """Queue ``rows`` for the next batch; the future resolves to the same dict ``Scorer.score`` returns."""
+        # 先在呼叫端驗證，壞掉的請求不會進到批次裡
+        features.feature_frame(rows)
+        bundle = self.scorer.bundle()
+        models = list(models) if models else None
+        unknown = [n for n in (models or []) if n not in bundle]
+        if unknown:
+            raise ValueError(f"unknown models: {unknown}; available: {bundle.names()}")
+
+        item = _Pending(rows.reset_index(drop=True), models, bool(exact))
+        if not self.enabled:
+            self._run([item])
+            return item.future
+        with self._stats_lock:
+            self._queued_rows += len(rows)
+        self._ensure_thread()
+        self._queue.put(item)
+        return item.future
+
+    def score(
+        self, rows: pd.DataFrame, models: Optional[Sequence[str]] = None, exact: bool = False, timeout: Optional[float] = None
+    ) -> Dict:
+        return self.submit(rows, models, exact).result(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            n_rows = len(first.rows)
+            deadline = first.enqueued + self.window_sec
+            while n_rows < self.max_rows:
+                # 已在排隊的請求直接併入；佇列空了才等到窗口結束
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_rows += len(item.rows)
+            with self._stats_lock:
+                self._queued_rows -= n_rows
+            self._run(batch)
+
+    def _run(self, batch: List[_Pending]):
+        started = time.perf_counter()
+        n_rows = sum(len(item.rows) for item in batch)
+        with self._stats_lock:
+            self._in_flight += len(batch)
+        try:
+            try:
+                results = self._score_batch(batch)
+            except Exception:
+                if len(batch) == 1:
+                    raise
+                with self._stats_lock:
+                    self._counts["batch_retries"] += 1
+                results = []
+                for item in batch:
+                    try:
+                        results.append(self._score_batch([item])[0])
+                    except Exception as exc:
+                        results.append(exc)
+        except Exception as exc:
+            results = [exc]
+        done = time.perf_counter()
+
+        with self._stats_lock:
+            self._in_flight -= len(batch)
+            self._counts["batches"] += 1
+            self._counts["requests"] += len(batch)
+            self._counts["rows"] += n_rows
+            self._batch_ms.append((done - started) * 1000)
+            self._batch_requests.append(len(batch))
+            self._batch_rows.append(n_rows)
+            for item, result in zip(batch, results):
+                self._wait_ms.append((started - item.enqueued) * 1000)
+                self._total_ms.append((done - item.enqueued) * 1000)
+                if isinstance(result, Exception):
+                    self._counts["errors"] += 1
+        for item, result in zip(batch, results):
+            if isinstance(result, Exception):
+                item.future.set_exception(result)
+            else:
+                item.future.set_result(result)
+
+    def _score_batch(self, batch: List[_Pending]) -> List[Dict]:
+        if len(batch) == 1:
+            return [self.scorer.score(batch[0].rows, models=batch[0].models, exact=batch[0].exact)]
+        if len({item.exact for item in batch}) > 1:
+            # 要求完整投票模型的請求與可用蒸餾模型的請求分開評分
+            results = {}
+            for exact in (False, True):
+                group = [item for item in batch if item.exact == exact]
+                results.update(zip(map(id, group), self._score_batch(group)))
+            return [results[id(item)] for item in batch]
+        if any(item.models is None for item in batch):
+            names = None
+        else:
+            names = list(dict.fromkeys(n for item in batch for n in item.models))
+        rows = pd.concat([item.rows for item in batch], ignore_index=True)
+        result = self.scorer.score(rows, models=names, exact=batch[0].exact)
+
+        # 依各請求的列範圍與模型切回去
+        out, start = [], 0
+        for item in batch:
+            stop = start + len(item.rows)
+            wanted = item.models or list(result["models"])
+            out.append({
+                "classes": result["classes"],
+                "models": {
+                    name: {
+                        "label": result["models"][name]["label"],
+                        "proba": result["models"][name]["proba"][start:stop],
+                        "pred": result["models"][name]["pred"][start:stop],
+                    }
+                    for name in wanted
+                },
+                "surrogate": result["surrogate"] and "VOTE" in wanted,
+                "bundle": result["bundle"],
+            })
+            start = stop
+        return out
+
+    def stats(self) -> Dict:
+        """Queue depth, batch sizes and latency percentiles (milliseconds) of recent requests."""
+        with self._stats_lock:
+            counts = dict(self._counts)
+            return {
+                "enabled": self.enabled,
+                "window_ms": self.window_sec * 1000,
+                "max_rows": self.max_rows,
+                "queue_depth": self._queue.qsize(),
+                "queued_rows": self._queued_rows,
+                "in_flight": self._in_flight,
+                **counts,
+                "avg_requests_per_batch": round(counts["requests"] / counts["batches"], 2) if counts["batches"] else None,
+                "avg_rows_per_batch": round(counts["rows"] / counts["batches"], 2) if counts["batches"] else None,
+                "batch_requests": _percentiles(self._batch_requests),
+                "batch_rows": _percentiles(self._batch_rows),
+                "queue_wait_ms": _percentiles(self._wait_ms),
+                "batch_ms": _percentiles(self._batch_ms),
+                "latency_ms": _percentiles(self._total_ms),
+            }
+
+
+_BATCHERS: Dict[int, MicroBatcher] = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+def get_batcher(scorer: Scorer) -> MicroBatcher:
+    """One batcher (and batching thread) per ``Scorer`` and process."""
+    with _BATCHERS_LOCK:
+        batcher = _BATCHERS.get(id(scorer))
+        if batcher is None or batcher.scorer is not scorer:
+            batcher = _BATCHERS[id(scorer)] = MicroBatcher(scorer)
+        return batcher
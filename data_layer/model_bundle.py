@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import joblib
+
+from .progress import write_json_atomic
+
+BUNDLE_VERSION = 1
+BUNDLE_FILE = "model_bundle.joblib"
+MANIFEST_FILE = "model_bundle.json"
+
+# Per-model pickles written by Stage 5 before the bundle existed (older artifacts / run cache snapshots)
+LEGACY_FILES: Dict[str, str] = {
+    "SVC": "svc_best.pkl",
+    "LR": "lr_best.pkl",
+    "KNN": "knn_best.pkl",
+    "DT": "tr_best.pkl",
+    "RF": "rf_best.pkl",
+    "GB": "gb_best.pkl",
+    "VOTE": "votingC.pkl",
+}
+
+# Bundles kept loaded per process (the stage worker runs Stage 6 and 7 back to back)
+_CACHE_MAX = 4
+_CACHE: Dict[tuple, "ModelBundle"] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+class ModelBundle:
+    """Estimators of one Stage 5 training plus the manifest that describes them."""
+
+    def __init__(self, manifest: Dict, models: Dict[str, object]):
+        self.manifest = manifest
+        self.models = models
+
+    @property
+    def features(self) -> List[str]:
+        return list(self.manifest.get("features") or [])
+
+    @property
+    def classes(self) -> List:
+        return list(self.manifest.get("classes") or [])
+
+    def names(self) -> List[str]:
+        return list(self.models)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.models
+
+    def __getitem__(self, name: str):
+        return self.models[name]
+
+    def get(self, name: str, default=None):
+        return self.models.get(name, default)
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _members(models: Dict[str, object]) -> Dict[str, List[str]]:
+    """Ensemble name -> names of bundled models it holds by reference (stored once in the bundle)."""
+    by_id = {id(est): name for name, est in models.items()}
+    members = {}
+    for name, est in models.items():
+        inner = getattr(est, "estimators_", None)
+        if isinstance(inner, list) and inner and all(id(e) in by_id for e in inner):
+            members[name] = [by_id[id(e)] for e in inner]
+    return members
+
+
+def save_bundle(
+    directory: Path,
+    models: Dict[str, object],
+    features: Sequence[str],
+    classes: Iterable,
+    metadata: Optional[Dict] = None,
+) -> Dict:
+    """Write ``models`` as one uncompressed joblib file plus its manifest; returns the manifest.
+
+    The models are dumped in a single pickle, so an ensemble that holds other
+    bundled estimators references them instead of storing a second copy.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / BUNDLE_FILE
+    tmp_path = directory / f".{BUNDLE_FILE}.{os.getpid()}.tmp"
+    joblib.dump(dict(models), tmp_path, compress=0)  # raw arrays: mmap-able on load
+    os.replace(tmp_path, path)
+
+    members = _members(models)
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "file": BUNDLE_FILE,
+        "created_at": time.time(),
+        "size_bytes": path.stat().st_size,
+        "sha256": _sha256(path),
+        "features": list(features),
+        "classes": [c.item() if hasattr(c, "item") else c for c in classes],
+        "models": {
+            name: {"class": type(est).__name__, **({"members": members[name]} if name in members else {})}
+            for name, est in models.items()
+        },
+    }
+    try:
+        import sklearn
+
+        manifest["sklearn_version"] = sklearn.__version__
+    except ImportError:
+        pass
+    if metadata:
+        manifest["metadata"] = metadata
+    write_json_atomic(directory / MANIFEST_FILE, manifest)
+    return manifest
+
+
+def load_manifest(directory: Path) -> Optional[Dict]:
+    try:
+        with open(Path(directory) / MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_bundle(directory: Path, mmap_mode: Optional[str] = "r") -> ModelBundle:
+    """Load (once per process) the bundle in ``directory``.
+
+    With ``mmap_mode="r"`` plain numpy arrays (KNN training matrix, linear
+    coefficients, ensemble class arrays) are mapped from the page cache, so
+    several worker processes share one copy. Tree node arrays are still copied
+    by scikit-learn when the trees are rebuilt.
+    """
+    directory = Path(directory)
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"no model bundle in {directory}")
+    if int(manifest.get("version", 0)) > BUNDLE_VERSION:
+        raise ValueError(f"model bundle version {manifest.get('version')} is newer than supported {BUNDLE_VERSION}")
+    path = directory / manifest.get("file", BUNDLE_FILE)
+    stat = path.stat()
+    if manifest.get("size_bytes") not in (None, stat.st_size):
+        raise ValueError(f"model bundle {path} does not match its manifest")
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size, mmap_mode)
+    with _CACHE_LOCK:
+        bundle = _CACHE.get(key)
+        if bundle is None:
+            for stale in [k for k in _CACHE if k[0] == key[0]]:
+                del _CACHE[stale]
+            while len(_CACHE) >= _CACHE_MAX:
+                del _CACHE[next(iter(_CACHE))]
+            bundle = ModelBundle(manifest, joblib.load(path, mmap_mode=mmap_mode))
+            _CACHE[key] = bundle
+    return bundle
+
+
+def load_models(directories: Sequence[Path], names: Sequence[str]) -> Dict[str, object]:
+    """``names`` from the first directory holding a bundle, else from the legacy per-model pickles.
+
+    Models that cannot be found are left out; callers decide which ones are required.
+    """
+    directories = [Path(d) for d in directories]
+    for directory in directories:
+        if (directory / MANIFEST_FILE).exists():
+            bundle = load_bundle(directory)
+            return {name: bundle[name] for name in names if name in bundle}
+    models = {}
+    for name in names:
+        for directory in directories:
+            path = directory / LEGACY_FILES.get(name, f"{name.lower()}_best.pkl")
+            if path.exists():
+                models[name] = joblib.load(path)
+                break
+    return models
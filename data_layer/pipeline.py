@@ -1,18 +1,64 @@
 from __future__ import annotations
 
-import subprocess
-import sys
+import os
+import shutil
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 import time
-import json
 
-from . import stage1
+from . import cpu_budget, eta, metrics, stage1
+from .progress import PROGRESS_BUS, write_json_atomic
+from .run_cache import replace_tree
 from database.import_artifacts_to_db import import_all_artifacts_to_db
+from .stage_worker import (
+    STAGE_WORKER_ENABLED,
+    StageWorkerUnavailable,
+    get_stage_worker_pool,
+    run_script_subprocess,
+)
 
 DATA_LAYER_DIR = Path(__file__).resolve().parent
 ARTIFACTS_DIR = DATA_LAYER_DIR / "artifacts"
 
+# Last output lines per stream kept in the stage result (the full output is in pipeline_logs.txt)
+STAGE_OUTPUT_TAIL_LINES = int(os.environ.get("STAGE_OUTPUT_TAIL_LINES", "200"))
+
+# Wall-clock limit per stage script in seconds (0 = unlimited). PIPELINE_STAGE_TIMEOUTS overrides
+# single stages, e.g. "Stage 5=1800,Stage 7=900".
+PIPELINE_STAGE_TIMEOUT_SEC = float(os.environ.get("PIPELINE_STAGE_TIMEOUT_SEC", "3600"))
+
+
+def _parse_stage_timeouts(spec: str) -> Dict[str, float]:
+    timeouts: Dict[str, float] = {}
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if not sep:
+            continue
+        try:
+            timeouts[name.strip()] = float(value)
+        except ValueError:
+            print(f"Warning: ignoring invalid stage timeout {item!r}")
+    return timeouts
+
+
+STAGE_TIMEOUTS = _parse_stage_timeouts(os.environ.get("PIPELINE_STAGE_TIMEOUTS", ""))
+
+
+def _stage_timeout(stage_name: str) -> Optional[float]:
+    timeout = STAGE_TIMEOUTS.get(stage_name, PIPELINE_STAGE_TIMEOUT_SEC)
+    return timeout if timeout > 0 else None
+
+
+# Stage 8 rebuilds shared MySQL tables, so concurrent pipelines import one at a time
+_DB_IMPORT_LOCK = threading.Lock()
+
+# Stage 5 漂移參考：各 run 寫在自己的 artifacts 裡，成功的 run 才換成下次比較的參考
+STAGE5_REFERENCE_DIR = Path(os.environ.get("STAGE5_REFERENCE_DIR") or DATA_LAYER_DIR / "state" / "stage5_reference")
+STAGE5_PENDING_REFERENCE = "stage5_reference"
+_REFERENCE_LOCK = threading.Lock()
+
 STAGE_SCRIPTS = [
     ("Stage 2", DATA_LAYER_DIR / "stage2_explore_data.py"),
     ("Stage 3", DATA_LAYER_DIR / "stage3.py"),
@@ -22,21 +68,105 @@ STAGE_SCRIPTS = [
     ("Stage 7", DATA_LAYER_DIR / "stage7.py"),
 ]
 
-# Estimated seconds per stage (used to compute remaining time on server-side)
-STAGE_ESTIMATES: Dict[str, int] = {
-    "Stage 1": 5,
-    "Stage 2": 8,
-    "Stage 3": 12,
-    "Stage 4": 15,
-    "Stage 5": 18,
-    "Stage 6": 10,
-    "Stage 7": 12,
-    "Stage 8 - Import to DB": 6,
-}
-
-
-def _run_script(stage_name: str, script_path: Path) -> Dict:
-    """Execute a stage script and capture stdout/stderr for logging."""
+PIPELINE_STAGES = ["Stage 1"] + [name for name, _ in STAGE_SCRIPTS] + ["Stage 8 - Import to DB"]
+
+# How often percent/remaining time are re-published while a stage is running
+PIPELINE_STATUS_INTERVAL_SEC = float(os.environ.get("PIPELINE_STATUS_INTERVAL_SEC", "5"))
+
+
+class _StageOutput:
+    """Sink for a running stage's output lines.
+
+    Every line is appended (timestamped) to ``pipeline_logs.txt`` and published
+    on the progress bus as soon as it arrives; only the last
+    ``STAGE_OUTPUT_TAIL_LINES`` lines per stream are kept in memory for the
+    stage result.
+    """
+
+    def __init__(self, stage_name: str, artifacts_dir: Path, job_id: str | None = None):
+        self.stage_name = stage_name
+        self.job_id = job_id
+        self.tails = {"stdout": deque(maxlen=STAGE_OUTPUT_TAIL_LINES), "stderr": deque(maxlen=STAGE_OUTPUT_TAIL_LINES)}
+        self.counts = {"stdout": 0, "stderr": 0}
+        self._lock = threading.Lock()
+        self._log = None
+        try:
+            artifacts_dir.mkdir(parents=True, exist_ok=True)
+            self._log = open(artifacts_dir / "pipeline_logs.txt", "a", encoding="utf-8", buffering=1)
+        except Exception as e:
+            print(f"Warning: failed to open pipeline log: {e}")
+
+    def write(self, stream: str, line: str) -> None:
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        entry = f"[{ts}] {self.stage_name} {stream}: {line}"
+        with self._lock:
+            self.tails[stream].append(line)
+            self.counts[stream] += 1
+            if self._log is not None:
+                try:
+                    self._log.write(entry + "\n")
+                except Exception:
+                    pass
+        PROGRESS_BUS.publish(self.job_id, "log", {"line": entry, "stage": self.stage_name, "stream": stream})
+
+    def text(self, stream: str) -> str:
+        with self._lock:
+            lines = list(self.tails[stream])
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+class _StatusTicker:
+    """Re-publish the running stage's status periodically so the ETA counts down mid-stage."""
+
+    def __init__(self, artifacts_dir: Path, progress: "eta.RunProgress", stage_name: str, job_id: str | None):
+        self.artifacts_dir = artifacts_dir
+        self.progress = progress
+        self.stage_name = stage_name
+        self.job_id = job_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"status-{stage_name}", daemon=True)
+
+    def _loop(self) -> None:
+        while not self._stop.wait(PIPELINE_STATUS_INTERVAL_SEC):
+            _write_pipeline_status(
+                self.artifacts_dir,
+                job_id=self.job_id,
+                status="running",
+                current_stage=self.stage_name,
+                message=f"Running {self.stage_name}",
+                **self.progress.snapshot(),
+            )
+
+    def __enter__(self) -> "_StatusTicker":
+        if PIPELINE_STATUS_INTERVAL_SEC > 0:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def _run_script(
+    stage_name: str,
+    script_path: Path,
+    artifacts_dir: Path = ARTIFACTS_DIR,
+    job_id: str | None = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> Dict:
+    """Execute a stage script, streaming its stdout/stderr into the pipeline log as it runs.
+
+    The script reads and writes ``artifacts_dir`` (passed as ``RFM_ARTIFACTS_DIR``).
+    Setting ``cancel_event`` or exceeding the stage timeout kills the script and
+    its worker processes; the result status is then ``cancelled`` or ``timeout``.
+    """
     result = {
         "stage": stage_name,
         "script": str(script_path),
@@ -46,19 +176,55 @@ def _run_script(stage_name: str, script_path: Path) -> Dict:
         "returncode": None,
     }
 
+    timeout_sec = _stage_timeout(stage_name)
+    output = _StageOutput(stage_name, artifacts_dir, job_id)
+    sampler = metrics.ProcessTreeSampler()
+    artifacts_before = metrics.snapshot_artifacts(artifacts_dir)
+    # processes x threads for this stage out of the pipeline's share of the CPU budget
+    cpu_plan = cpu_budget.stage_plan(stage_name)
+    result["cpu_plan"] = cpu_plan
+    run_kwargs = {
+        "env": {
+            "RFM_ARTIFACTS_DIR": str(artifacts_dir),
+            # feature store 等跨 Stage 產出以 job id 標記屬於哪一次執行
+            **({"RFM_RUN_ID": job_id} if job_id else {}),
+            **cpu_budget.stage_env(cpu_plan),
+        },
+        "cwd": DATA_LAYER_DIR,
+        "on_output": output.write,
+        "cancel_event": cancel_event,
+        "timeout_sec": timeout_sec,
+        "on_start": sampler.start,
+    }
     start = time.perf_counter()
-    completed = subprocess.run(  # noqa: PLW1510 - intentional blocking call
-        [sys.executable, str(script_path)],
-        cwd=str(DATA_LAYER_DIR),
-        capture_output=True,
-        text=True,
-    )
+    try:
+        outcome = None
+        if STAGE_WORKER_ENABLED:
+            # warm interpreter with pandas/sklearn/nltk/shap already imported
+            try:
+                outcome = get_stage_worker_pool().run(script_path, **run_kwargs)
+                result["runner"] = "worker"
+            except StageWorkerUnavailable as e:
+                print(f"Warning: {e}; running {stage_name} in a fresh interpreter")
+        if outcome is None:
+            outcome = run_script_subprocess(script_path, **run_kwargs)
+            result["runner"] = "subprocess"
+    finally:
+        output.close()
+        usage = sampler.stop()
 
-    result["returncode"] = completed.returncode
-    result["stdout"] = completed.stdout
-    result["stderr"] = completed.stderr
-    result["status"] = "ok" if completed.returncode == 0 else "error"
+    returncode = outcome["returncode"]
+    result["returncode"] = returncode
+    result["stdout"] = output.text("stdout")
+    result["stderr"] = output.text("stderr")
+    result["output_lines"] = dict(output.counts)
+    result["status"] = outcome.get("stopped") or ("ok" if returncode == 0 else "error")
+    if result["status"] == "timeout":
+        result["error"] = f"{stage_name} exceeded its {timeout_sec:g}s time limit"
+    elif result["status"] == "cancelled":
+        result["error"] = f"{stage_name} was cancelled"
     result["duration_sec"] = round(time.perf_counter() - start, 3)
+    result["metrics"] = metrics.stage_metrics(usage, metrics.artifact_changes(artifacts_dir, artifacts_before))
     return result
 
 
@@ -70,7 +236,9 @@ def _write_pipeline_status(
     completed_est_sec: float | None = None,
     total_est_sec: float | None = None,
     message: str | None = None,
+    job_id: str | None = None,
 ):
+    """Publish progress to listeners and keep ``pipeline_status.json`` as the durable snapshot."""
     try:
         artifacts_dir.mkdir(parents=True, exist_ok=True)
         status_path = artifacts_dir / "pipeline_status.json"
@@ -85,29 +253,53 @@ def _write_pipeline_status(
             "status": status,
             "current_stage": current_stage,
             "percent": percent,
-            "estimated_total_sec": int(total_est_sec) if total_est_sec is not None else None,
+            "estimated_total_sec": int(round(total_est_sec)) if total_est_sec is not None else None,
             "estimated_remaining_sec": remaining,
             "message": message,
             "timestamp": time.time(),
             "logs": "/artifacts/pipeline_logs.txt",
         }
-        with open(status_path, "w", encoding="utf-8") as sf:
-            json.dump(payload, sf)
+        PROGRESS_BUS.publish(job_id, "status", payload)
+        write_json_atomic(status_path, payload)
     except Exception as e:
         print(f"Warning: failed to write pipeline status: {e}")
 
 
-def _append_pipeline_log(artifacts_dir: Path, entry: str):
+def _append_pipeline_log(artifacts_dir: Path, entry: str, job_id: str | None = None):
     try:
         artifacts_dir.mkdir(parents=True, exist_ok=True)
         log_path = artifacts_dir / "pipeline_logs.txt"
         ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        PROGRESS_BUS.publish(job_id, "log", {"line": f"[{ts}] {entry}"})
         with open(log_path, "a", encoding="utf-8") as lf:
             lf.write(f"[{ts}] {entry}\n")
     except Exception as e:
         print(f"Warning: failed to append pipeline log: {e}")
 
 
+def _publish_stage(job_id: str | None, stage_name: str, state: str, res: Dict | None = None):
+    data = {"stage": stage_name, "state": state}
+    if res is not None:
+        data.update(status=res.get("status"), duration_sec=res.get("duration_sec"), returncode=res.get("returncode"))
+    PROGRESS_BUS.publish(job_id, "stage", data)
+
+
+def _settle_stage5_reference(artifacts_dir: Path, promote: bool, job_id: Optional[str]) -> None:
+    """Promote the reference Stage 5 left in ``artifacts_dir`` (or drop it) so it is never published or cached."""
+    pending = Path(artifacts_dir) / STAGE5_PENDING_REFERENCE
+    if not pending.is_dir():
+        return
+    try:
+        if promote:
+            with _REFERENCE_LOCK:
+                replace_tree(pending, STAGE5_REFERENCE_DIR)
+            _append_pipeline_log(artifacts_dir, "Stage 5 drift reference updated", job_id=job_id)
+    except Exception as exc:  # pylint: disable=broad-except
+        _append_pipeline_log(artifacts_dir, f"Warning: failed to update the Stage 5 drift reference: {exc}", job_id=job_id)
+    finally:
+        shutil.rmtree(pending, ignore_errors=True)
+
+
 def _primary_stages_completed(results: List[Dict], num_stages: int = 7) -> bool:
     expected = {f"Stage {idx}" for idx in range(1, num_stages + 1)}
     completed = {
@@ -120,34 +312,95 @@ def _primary_stages_completed(results: List[Dict], num_stages: int = 7) -> bool:
     return all(res.get("status") == "ok" for res in completed.values())
 
 
-def run_all_stages(stop_on_error: bool = False) -> Dict[str, Union[List[Dict], float]]:
-    """Run Stage 1 (function) followed by Stage 2–7 scripts."""
+def _record_run_metrics(
+    job_id: Optional[str], upload_file: Optional[Path], results: List[Dict], status: str, started_at: float
+) -> None:
+    """Append this run's per-stage measurements to the metrics history (state/pipeline_metrics.json)."""
+    upload_file = Path(upload_file) if upload_file is not None else stage1.UPLOAD_FILE
+    stage1_summary = next((r.get("summary") for r in results if r.get("stage") == "Stage 1"), None) or {}
+    stages = []
+    for res in results:
+        entry = {"stage": res.get("stage"), "status": res.get("status"), "duration_sec": res.get("duration_sec")}
+        if res.get("estimated_sec") is not None:
+            entry.update(estimated_sec=res["estimated_sec"], estimate_basis=res.get("estimate_basis"))
+        entry.update(res.get("metrics") or {})
+        if res.get("cpu_plan"):
+            entry["cpu_plan"] = res["cpu_plan"]
+        stages.append(entry)
+    metrics.record_run(
+        {
+            "job_id": job_id,
+            "started_at": started_at,
+            "finished_at": time.time(),
+            "status": status,
+            "input": {
+                "bytes": upload_file.stat().st_size if upload_file.exists() else None,
+                "rows": stage1_summary.get("rows"),
+                "customers": stage1_summary.get("customers"),
+                "products": stage1_summary.get("products"),
+            },
+            # cores this run was allowed to use (ETA feature), not the host's CPU count
+            "cpu_count": cpu_budget.pipeline_cores(),
+            "cpu_budget": cpu_budget.describe(),
+            "stages": stages,
+        }
+    )
+
+
+def run_all_stages(
+    stop_on_error: bool = False,
+    *,
+    upload_file: Optional[Path] = None,
+    artifacts_dir: Optional[Path] = None,
+    job_id: Optional[str] = None,
+    cancel_event: Optional[threading.Event] = None,
+    import_to_db: bool = True,
+) -> Dict[str, Union[List[Dict], float]]:
+    """Run Stage 1 (function) followed by Stage 2–7 scripts.
+
+    ``upload_file``/``artifacts_dir`` default to ``uploads/data.csv`` and
+    ``artifacts/``; jobs pass their own folders so runs never share files.
+    Progress is published on ``PROGRESS_BUS`` under ``job_id``. Setting
+    ``cancel_event`` (or a stage hitting its timeout) stops the run; the
+    result then carries ``cancelled=True`` and the reason. ``import_to_db=False``
+    skips Stage 8 (benchmarks without MySQL).
+    """
+    artifacts_dir = Path(artifacts_dir) if artifacts_dir is not None else ARTIFACTS_DIR
+    run_started_at = time.time()
     results: List[Dict] = []
     total_duration = 0.0
 
-    # Prepare progress tracking (use estimated seconds for better remaining-time accuracy)
-    total_est_seconds = 0
-    total_est_seconds += STAGE_ESTIMATES.get("Stage 1", 0)
-    for name, _ in STAGE_SCRIPTS:
-        total_est_seconds += STAGE_ESTIMATES.get(name, 0)
-    total_est_seconds += STAGE_ESTIMATES.get("Stage 8 - Import to DB", 0)
-
-    completed_steps = 0
-    completed_est_seconds = 0
+    # Progress/ETA: per-stage durations predicted from past runs of similar size
+    upload_path = Path(upload_file) if upload_file is not None else stage1.UPLOAD_FILE
+    run_features = {
+        "bytes": upload_path.stat().st_size if upload_path.exists() else None,
+        "cores": cpu_budget.pipeline_cores(),
+    }
+    eta_model = eta.EtaModel.from_history()
+    progress = eta.RunProgress(
+        PIPELINE_STAGES if import_to_db else PIPELINE_STAGES[:-1],
+        eta_model,
+        {k: run_features[k] for k in eta.START_FEATURES if run_features.get(k)},
+    )
 
     # mark started (no progress yet)
     _write_pipeline_status(
-        ARTIFACTS_DIR,
+        artifacts_dir,
+        job_id=job_id,
         status="running",
         current_stage="initializing",
-        completed_est_sec=completed_est_seconds,
-        total_est_sec=total_est_seconds,
+        **progress.snapshot(),
         message="Pipeline started",
     )
 
     stage1_start = time.perf_counter()
+    progress.start_stage("Stage 1")
+    _publish_stage(job_id, "Stage 1", "started")
+    stage1_usage = metrics.ThreadUsage()
+    artifacts_before = metrics.snapshot_artifacts(artifacts_dir)
     try:
-        summary = stage1.run_stage()
+        with stage1_usage:
+            summary = stage1.run_stage(upload_file, artifacts_dir)
     except Exception as exc:  # pylint: disable=broad-except
         duration = time.perf_counter() - stage1_start
         results.append(
@@ -156,19 +409,24 @@ def run_all_stages(stop_on_error: bool = False) -> Dict[str, Union[List[Dict], f
                 "status": "error",
                 "error": str(exc),
                 "duration_sec": round(duration, 3),
+                "metrics": metrics.stage_metrics(stage1_usage.result),
+                **(progress.estimate_for("Stage 1") or {}),
             }
         )
         total_duration += duration
-        _append_pipeline_log(ARTIFACTS_DIR, f"Stage 1 failed: {exc}")
+        progress.finish_stage("Stage 1", duration, ok=False)
+        _publish_stage(job_id, "Stage 1", "finished", results[-1])
+        _append_pipeline_log(artifacts_dir, f"Stage 1 failed: {exc}", job_id=job_id)
         _write_pipeline_status(
-            ARTIFACTS_DIR,
+            artifacts_dir,
+            job_id=job_id,
             status="failed",
             current_stage="Stage 1",
-            completed_est_sec=completed_est_seconds,
-            total_est_sec=total_est_seconds,
+            **progress.snapshot(),
             message=str(exc),
         )
         if stop_on_error:
+            _record_run_metrics(job_id, upload_file, results, "failed", run_started_at)
             return {"stages": results, "total_duration_sec": round(total_duration, 3)}
     else:
         duration = time.perf_counter() - stage1_start
@@ -178,61 +436,84 @@ def run_all_stages(stop_on_error: bool = False) -> Dict[str, Union[List[Dict], f
                 "status": "ok",
                 "summary": summary.as_dict(),
                 "duration_sec": round(duration, 3),
+                "metrics": metrics.stage_metrics(
+                    stage1_usage.result, metrics.artifact_changes(artifacts_dir, artifacts_before)
+                ),
+                **(progress.estimate_for("Stage 1") or {}),
             }
         )
         total_duration += duration
-        completed_steps += 1
-        # add estimated seconds for Stage 1
-        completed_est_seconds += STAGE_ESTIMATES.get("Stage 1", 0)
-        _append_pipeline_log(ARTIFACTS_DIR, "Stage 1 completed")
+        _publish_stage(job_id, "Stage 1", "finished", results[-1])
+        progress.finish_stage("Stage 1", duration)
+        # the cleaned data shape predicts the later stages much better than the upload size
+        data_features = {"rows": summary.rows, "customers": summary.customers, "products": summary.products}
+        data_features["cores"] = run_features["cores"]
+        progress.update_features({k: data_features[k] for k in eta.DATA_FEATURES if data_features.get(k)})
+        _append_pipeline_log(artifacts_dir, "Stage 1 completed", job_id=job_id)
         _write_pipeline_status(
-            ARTIFACTS_DIR,
+            artifacts_dir,
+            job_id=job_id,
             status="running",
             current_stage="Stage 1",
-            completed_est_sec=completed_est_seconds,
-            total_est_sec=total_est_seconds,
+            **progress.snapshot(),
             message="Stage 1 completed",
         )
 
+    cancel_reason: Optional[str] = None
     for stage_name, script_path in STAGE_SCRIPTS:
+        if cancel_event is not None and cancel_event.is_set():
+            cancel_reason = f"Cancelled before {stage_name}"
+            break
         # announce stage start
         _write_pipeline_status(
-            ARTIFACTS_DIR,
+            artifacts_dir,
+            job_id=job_id,
             status="running",
             current_stage=stage_name,
-            completed_est_sec=completed_est_seconds,
-            total_est_sec=total_est_seconds,
+            **progress.snapshot(),
             message=f"Starting {stage_name}",
         )
-        _append_pipeline_log(ARTIFACTS_DIR, f"Starting {stage_name} ({script_path})")
+        _append_pipeline_log(artifacts_dir, f"Starting {stage_name} ({script_path})", job_id=job_id)
+        _publish_stage(job_id, stage_name, "started")
+        progress.start_stage(stage_name)
 
-        res = _run_script(stage_name, script_path)
-        # save stdout/stderr to log for visibility
-        if res.get("stdout"):
-            _append_pipeline_log(ARTIFACTS_DIR, f"{stage_name} stdout:\n{res.get('stdout')}")
-        if res.get("stderr"):
-            _append_pipeline_log(ARTIFACTS_DIR, f"{stage_name} stderr:\n{res.get('stderr')}")
+        # stdout/stderr lines are written to the log while the stage runs
+        with _StatusTicker(artifacts_dir, progress, stage_name, job_id):
+            res = _run_script(stage_name, script_path, artifacts_dir, job_id, cancel_event)
+        res.update(progress.estimate_for(stage_name) or {})
+        _append_pipeline_log(
+            artifacts_dir, f"{stage_name} exited with code {res.get('returncode')} ({res.get('status')})", job_id=job_id
+        )
 
         results.append(res)
+        _publish_stage(job_id, stage_name, "finished", res)
         total_duration += res.get("duration_sec", 0.0)
-        completed_steps += 1
-        # increment estimated seconds only when stage finished (treat error as finished for progress)
-        completed_est_seconds += STAGE_ESTIMATES.get(stage_name, 0)
+        # error counts as finished for progress
+        progress.finish_stage(stage_name, res.get("duration_sec", 0.0), ok=res["status"] == "ok")
         _write_pipeline_status(
-            ARTIFACTS_DIR,
+            artifacts_dir,
+            job_id=job_id,
             status="running",
             current_stage=stage_name,
-            completed_est_sec=completed_est_seconds,
-            total_est_sec=total_est_seconds,
+            **progress.snapshot(),
             message=f"{stage_name} finished: {res.get('status')}",
         )
+        if res["status"] in ("cancelled", "timeout"):
+            cancel_reason = res.get("error")
+            break
         if stop_on_error and res["status"] == "error":
             break
 
-    if _primary_stages_completed(results):
+    if cancel_reason is None and cancel_event is not None and cancel_event.is_set():
+        cancel_reason = "Cancelled before Stage 8 - Import to DB"
+    if import_to_db and cancel_reason is None and _primary_stages_completed(results):
         import_start = time.perf_counter()
+        progress.start_stage("Stage 8 - Import to DB")
+        _publish_stage(job_id, "Stage 8 - Import to DB", "started")
+        import_usage = metrics.ThreadUsage()
         try:
-            tables = import_all_artifacts_to_db(str(ARTIFACTS_DIR))
+            with _DB_IMPORT_LOCK, import_usage:
+                tables = import_all_artifacts_to_db(str(artifacts_dir))
         except Exception as exc:  # pylint: disable=broad-except
             duration = time.perf_counter() - import_start
             results.append(
@@ -241,18 +522,20 @@ def run_all_stages(stop_on_error: bool = False) -> Dict[str, Union[List[Dict], f
                     "status": "error",
                     "error": str(exc),
                     "duration_sec": round(duration, 3),
+                    "metrics": metrics.stage_metrics(import_usage.result),
+                    **(progress.estimate_for("Stage 8 - Import to DB") or {}),
                 }
             )
             total_duration += duration
-            completed_steps += 1
-            completed_est_seconds += STAGE_ESTIMATES.get("Stage 8 - Import to DB", 0)
-            _append_pipeline_log(ARTIFACTS_DIR, f"Stage 8 import failed: {exc}")
+            _publish_stage(job_id, "Stage 8 - Import to DB", "finished", results[-1])
+            progress.finish_stage("Stage 8 - Import to DB", duration, ok=False)
+            _append_pipeline_log(artifacts_dir, f"Stage 8 import failed: {exc}", job_id=job_id)
             _write_pipeline_status(
-                ARTIFACTS_DIR,
+                artifacts_dir,
+                job_id=job_id,
                 status="failed",
                 current_stage="Stage 8 - Import to DB",
-                completed_est_sec=completed_est_seconds,
-                total_est_sec=total_est_seconds,
+                **progress.snapshot(),
                 message=str(exc),
             )
         else:
@@ -263,31 +546,50 @@ def run_all_stages(stop_on_error: bool = False) -> Dict[str, Union[List[Dict], f
                     "status": "ok",
                     "imported_tables": tables,
                     "duration_sec": round(duration, 3),
+                    "metrics": metrics.stage_metrics(import_usage.result),
+                    **(progress.estimate_for("Stage 8 - Import to DB") or {}),
                 }
             )
             total_duration += duration
-            completed_steps += 1
-            completed_est_seconds += STAGE_ESTIMATES.get("Stage 8 - Import to DB", 0)
-            _append_pipeline_log(ARTIFACTS_DIR, f"Stage 8 import ok: imported {len(tables)} tables")
+            _publish_stage(job_id, "Stage 8 - Import to DB", "finished", results[-1])
+            progress.finish_stage("Stage 8 - Import to DB", duration)
+            _append_pipeline_log(artifacts_dir, f"Stage 8 import ok: imported {len(tables)} tables", job_id=job_id)
             _write_pipeline_status(
-                ARTIFACTS_DIR,
+                artifacts_dir,
+                job_id=job_id,
                 status="running",
                 current_stage="Stage 8 - Import to DB",
-                completed_est_sec=completed_est_seconds,
-                total_est_sec=total_est_seconds,
+                **progress.snapshot(),
                 message="Import completed",
             )
 
     # final status: check overall success
-    overall_ok = all((r.get("status") == "ok") for r in results if r.get("stage"))
-    final_status = "done" if overall_ok else "failed"
+    progress.skip_remaining()
+    _settle_stage5_reference(
+        artifacts_dir, cancel_reason is None and _primary_stages_completed(results), job_id
+    )
+    overall_ok = cancel_reason is None and all((r.get("status") == "ok") for r in results if r.get("stage"))
+    if cancel_reason is not None:
+        final_status, final_message = "cancelled", cancel_reason
+        _append_pipeline_log(artifacts_dir, f"Pipeline cancelled: {cancel_reason}", job_id=job_id)
+    elif overall_ok:
+        final_status, final_message = "done", "Pipeline finished"
+    else:
+        final_status, final_message = "failed", "Pipeline finished with errors"
     _write_pipeline_status(
-        ARTIFACTS_DIR,
+        artifacts_dir,
+        job_id=job_id,
         status=final_status,
         current_stage=None,
-        completed_est_sec=total_est_seconds if overall_ok else completed_est_seconds,
-        total_est_sec=total_est_seconds,
-        message="Pipeline finished" if overall_ok else "Pipeline finished with errors",
+        **progress.snapshot(),
+        message=final_message,
     )
+    _record_run_metrics(job_id, upload_file, results, final_status, run_started_at)
 
-    return {"stages": results, "total_duration_sec": round(total_duration, 3)}
+    return {
+        "stages": results,
+        "total_duration_sec": round(total_duration, 3),
+        "cancelled": cancel_reason is not None,
+        "cancel_reason": cancel_reason,
+        "primary_stages_ok": cancel_reason is None and _primary_stages_completed(results),
+    }
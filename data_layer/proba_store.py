@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .feature_store import current_run_id
+
+STORE_VERSION = 1
+# 每個 Stage 的機率檔，以及舊版長格式 CSV 的索引欄名稱
+STAGES: Dict[str, Dict[str, str]] = {
+    "stage5": {"file": "stage5_proba.npz", "index": "row_index"},
+    "stage6": {"file": "stage6_proba.npz", "index": "CustomerID"},
+}
+# 舊版長格式 CSV（DB 匯入的資料表名稱也沿用），1 = 另外照舊輸出 CSV
+LEGACY_TABLES: Dict[str, Tuple[str, ...]] = {
+    "stage5": ("stage5_pred_proba",),
+    "stage6": ("stage6_pred_proba", "stage6_predictions"),
+}
+LEGACY_CSV = os.environ.get("RFM_PROBA_CSV", "0").strip().lower() in ("1", "true", "yes")
+
+_CACHE_MAX = 8
+_CACHE: Dict[tuple, "ProbaStore"] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+class ProbaStore:
+    """Per-model class probabilities and predictions of one stage's test customers.
+
+    One ``.npz`` holds a shared customer index and ``y_true``, one float32
+    probability matrix (columns follow ``classes``) and one prediction vector
+    per model, and the metadata (model names in output order, class labels, run
+    id). Replaces the long-format CSVs that repeated the model name and id on
+    every row.
+    """
+
+    def __init__(self, meta: Dict, arrays: Dict[str, np.ndarray]):
+        self.meta = meta
+        self.arrays = arrays
+
+    @property
+    def stage(self) -> str:
+        return self.meta["stage"]
+
+    @property
+    def run_id(self) -> Optional[str]:
+        return self.meta.get("run_id")
+
+    @property
+    def classes(self) -> List:
+        return list(self.meta["classes"])
+
+    @property
+    def models(self) -> List[str]:
+        return [m["name"] for m in self.meta["models"]]
+
+    @property
+    def index_name(self) -> str:
+        return self.meta["index_name"]
+
+    @property
+    def index(self) -> np.ndarray:
+        return self.arrays["index"]
+
+    @property
+    def y_true(self) -> Optional[np.ndarray]:
+        return self.arrays.get("y_true")
+
+    def __len__(self) -> int:
+        return int(self.meta["rows"])
+
+    def _key(self, model: str) -> str:
+        for i, spec in enumerate(self.meta["models"]):
+            if spec["name"] == model:
+                return str(i)
+        raise KeyError(f"unknown model {model!r}; available: {self.models}")
+
+    def proba(self, model: str) -> np.ndarray:
+        """float32 (rows × classes) probabilities of ``model``."""
+        return self.arrays[f"proba_{self._key(model)}"]
+
+    def pred(self, model: str) -> np.ndarray:
+        return self.arrays[f"pred_{self._key(model)}"]
+
+    def positions(self, customer_ids: Sequence) -> np.ndarray:
+        """Row positions of ``customer_ids`` in request order; unknown ids are left out."""
+        ids = pd.Series(list(customer_ids), dtype=object)
+        if self.index.dtype.kind in "iu":
+            ids = pd.to_numeric(ids, errors="coerce")
+        else:
+            ids = ids.astype(str)
+        positions = pd.Index(self.index).get_indexer(ids)
+        return positions[positions >= 0]
+
+    def frame(self, models: Optional[Sequence[str]] = None, rows=None) -> pd.DataFrame:
+        """The old ``*_pred_proba.csv`` layout: one row per (model, customer) with ``p_<class>`` columns."""
+        rows = slice(None) if rows is None else rows
+        frames = []
+        for model in models or self.models:
+            dfp = pd.DataFrame(
+                self.proba(model)[rows].astype(np.float64), columns=[f"p_{int(c)}" for c in self.classes]
+            )
+            dfp.insert(0, "model", model)
+            dfp.insert(1, self.index_name, self.index[rows])
+            if self.y_true is not None:
+                dfp.insert(2, "y_true", self.y_true[rows])
+            dfp.insert(len(dfp.columns) - len(self.classes), "y_pred", self.pred(model)[rows])
+            frames.append(dfp)
+        return pd.concat(frames, ignore_index=True)
+
+    def predictions_frame(self, models: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """The old ``stage6_predictions.csv`` layout (model, id, y_true, y_pred)."""
+        frames = []
+        for model in models or self.models:
+            columns = {"model": model, self.index_name: self.index}
+            if self.y_true is not None:
+                columns["y_true"] = self.y_true
+            columns["y_pred"] = self.pred(model)
+            frames.append(pd.DataFrame(columns))
+        return pd.concat(frames, ignore_index=True)
+
+    def tables(self) -> Dict[str, pd.DataFrame]:
+        """Long-format frames under the table names the CSVs used to have (for the DB import)."""
+        names = LEGACY_TABLES[self.stage]
+        out = {names[0]: self.frame()}
+        if len(names) > 1:
+            out[names[1]] = self.predictions_frame()
+        return out
+
+
+def path_for(artifacts_dir: Path, stage: str) -> Path:
+    if stage not in STAGES:
+        raise ValueError(f"unknown stage {stage!r}; expected one of {tuple(STAGES)}")
+    return Path(artifacts_dir) / STAGES[stage]["file"]
+
+
+def write(
+    artifacts_dir: Path,
+    stage: str,
+    index: Sequence,
+    classes: Sequence,
+    models: Sequence[Tuple[str, np.ndarray, np.ndarray]],
+    y_true: Optional[Sequence] = None,
+    run_id: Optional[str] = None,
+) -> Path:
+    """Save ``models`` — ``(name, probabilities aligned to classes, predictions)`` in output order.
+
+    Written to a temporary file and renamed over the previous one; with
+    ``RFM_PROBA_CSV=1`` the legacy long-format CSVs are written as well.
+    """
+    path = path_for(artifacts_dir, stage)
+    index = np.asarray(index)
+    if index.dtype.kind not in "biuf":
+        index = index.astype(str)  # 文字 id 存成定長 unicode，不需要 pickle
+    arrays = {"index": index}
+    if y_true is not None:
+        arrays["y_true"] = np.asarray(y_true)
+    specs = []
+    for i, (name, proba, pred) in enumerate(models):
+        proba = np.asarray(proba, dtype=np.float32)
+        if proba.shape != (len(index), len(classes)):
+            raise ValueError(f"{name}: probabilities of shape {proba.shape}, expected {(len(index), len(classes))}")
+        arrays[f"proba_{i}"] = proba
+        arrays[f"pred_{i}"] = np.asarray(pred)
+        specs.append({"name": str(name)})
+    meta = {
+        "version": STORE_VERSION,
+        "stage": stage,
+        "run_id": run_id or current_run_id(),
+        "created_at": time.time(),
+        "rows": int(len(index)),
+        "index_name": STAGES[stage]["index"],
+        "classes": [c.item() if hasattr(c, "item") else c for c in classes],
+        "models": specs,
+    }
+    arrays["meta"] = np.array(json.dumps(meta, ensure_ascii=False))
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(buffer.getvalue())
+    os.replace(tmp, path)
+
+    if LEGACY_CSV:
+        for table, frame in load(artifacts_dir, stage).tables().items():
+            frame.to_csv(Path(artifacts_dir) / f"{table}.csv", index=False)
+    return path
+
+
+def read(path: Path) -> ProbaStore:
+    """Open one probability file (any stage)."""
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    meta = json.loads(str(arrays.pop("meta")))
+    if int(meta.get("version", 0)) != STORE_VERSION:
+        raise ValueError(f"{path.name}: probability store version {meta.get('version')}, expected {STORE_VERSION}")
+    return ProbaStore(meta, arrays)
+
+
+def load(artifacts_dir: Path, stage: str) -> ProbaStore:
+    """The ``stage`` probabilities in ``artifacts_dir`` (cached per process until the file changes)."""
+    path = path_for(artifacts_dir, stage)
+    if not path.exists():
+        raise FileNotFoundError(f"missing {path.name} in {artifacts_dir}; run {stage.replace('stage', 'Stage ')} first")
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+    with _CACHE_LOCK:
+        store = _CACHE.get(key)
+        if store is None:
+            for stale in [k for k in _CACHE if k[0] == key[0]]:
+                del _CACHE[stale]
+            while len(_CACHE) >= _CACHE_MAX:
+                del _CACHE[next(iter(_CACHE))]
+            try:
+                store = _CACHE[key] = read(path)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as exc:
+                raise FileNotFoundError(f"unreadable {path.name} in {artifacts_dir}: {exc}") from exc
+    return store
+
+
+def is_store(path: Path) -> bool:
+    return any(Path(path).name == spec["file"] for spec in STAGES.values())
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+
+# Events kept in memory so reconnecting SSE clients (Last-Event-ID) can catch up
+PROGRESS_HISTORY_SIZE = int(os.environ.get("PROGRESS_HISTORY_SIZE", "1000"))
+# Per-subscriber backlog; a client that falls further behind loses its oldest events
+PROGRESS_QUEUE_SIZE = int(os.environ.get("PROGRESS_QUEUE_SIZE", "1000"))
+# Channels (jobs) whose last status is remembered for late subscribers
+_MAX_STATUS_CHANNELS = 256
+
+
+def write_json_atomic(path: Path, payload: Dict) -> None:
+    """Write JSON next to ``path`` and rename it into place so readers never see a torn file."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+
+class Subscription:
+    """One listener on the bus; events are handed over to its asyncio loop thread-safely."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, channel: Optional[str], maxsize: int):
+        self.loop = loop
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def matches(self, event: Dict) -> bool:
+        return self.channel is None or event.get("channel") == self.channel
+
+    def _put(self, event: Dict) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def deliver(self, event: Dict) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # loop already closed; the bus drops us on unsubscribe
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Next event, or None when ``timeout`` elapses (used for SSE keep-alives)."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ProgressBus:
+    """In-process fan-out of pipeline progress (status, stage and log events).
+
+    Publishers are the pipeline/job threads; subscribers are SSE handlers running
+    on the event loop. Every event gets a monotonically increasing ``id`` and a
+    ``channel`` (the job id, or None for global events). The last status per
+    channel is kept so new listeners start from the current state.
+    """
+
+    def __init__(self, history_size: int = PROGRESS_HISTORY_SIZE, queue_size: int = PROGRESS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._history: Deque[Dict] = collections.deque(maxlen=max(0, history_size))
+        self._latest_status: "collections.OrderedDict[Optional[str], Dict]" = collections.OrderedDict()
+        self._subscribers: List[Subscription] = []
+
+    def publish(self, channel: Optional[str], event_type: str, data: Optional[Dict] = None) -> Dict:
+        with self._lock:
+            event = {"id": next(self._seq), "type": event_type, "channel": channel, "timestamp": time.time()}
+            event["data"] = dict(data or {})
+            self._history.append(event)
+            if event_type == "status":
+                self._latest_status[channel] = event
+                self._latest_status.move_to_end(channel)
+                while len(self._latest_status) > _MAX_STATUS_CHANNELS:
+                    self._latest_status.popitem(last=False)
+            subscribers = [s for s in self._subscribers if s.matches(event)]
+        for sub in subscribers:
+            sub.deliver(event)
+        return event
+
+    def subscribe(self, channel: Optional[str] = None, *, after_id: Optional[int] = None) -> Subscription:
+        """Register a listener on the running event loop, replaying history newer than ``after_id``."""
+        sub = Subscription(asyncio.get_running_loop(), channel, self.queue_size)
+        with self._lock:
+            if after_id is not None:
+                for event in self._history:
+                    if event["id"] > after_id and sub.matches(event):
+                        sub._put(event)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def latest_status(self, channel: Optional[str]) -> Optional[Dict]:
+        with self._lock:
+            return self._latest_status.get(channel)
+
+
+PROGRESS_BUS = ProgressBus()
@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+DATA_LAYER_DIR = Path(__file__).resolve().parent
+RUNS_DIR = DATA_LAYER_DIR / "runs"
+INDEX_FILENAME = "index.json"
+
+# Retention policy (0 disables the corresponding limit; RUN_CACHE_MAX_RUNS=0 disables caching)
+RUN_CACHE_MAX_RUNS = int(os.environ.get("RUN_CACHE_MAX_RUNS", "5"))
+RUN_CACHE_MAX_AGE_HOURS = float(os.environ.get("RUN_CACHE_MAX_AGE_HOURS", "0"))
+
+# Files that describe a single execution rather than its results
+_SNAPSHOT_EXCLUDE = ("pipeline_status.json",)
+
+
+def replace_tree(source: Path, target: Path, ignore: Iterable[str] = ()) -> None:
+    """Make ``target`` an exact copy of ``source``: copy into a sibling folder, then swap it in.
+
+    Unlike ``copytree(..., dirs_exist_ok=True)`` nothing of the previous
+    contents survives, and readers never see a half-copied folder.
+    """
+    target = Path(target)
+    tag = f"{os.getpid()}.{threading.get_ident()}"
+    tmp = target.with_name(f".{target.name}.{tag}.tmp")
+    old = target.with_name(f".{target.name}.{tag}.old")
+    shutil.rmtree(tmp, ignore_errors=True)
+    shutil.copytree(source, tmp, ignore=shutil.ignore_patterns(*ignore) if ignore else None)
+    if target.exists():
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=1)
+def pipeline_version() -> str:
+    """Fingerprint of the code that produced a run: the data_layer sources plus the library versions.
+
+    A snapshot made by other stage scripts or another scikit-learn would not be
+    what a fresh run produces now, so lookups treat a different version as a miss.
+    """
+    hasher = hashlib.sha256()
+    for path in sorted(DATA_LAYER_DIR.glob("*.py")):
+        hasher.update(path.name.encode())
+        hasher.update(path.read_bytes())
+    for module in ("numpy", "pandas", "sklearn"):
+        try:
+            version = __import__(module).__version__
+        except ImportError:
+            version = "missing"
+        hasher.update(f"{module}={version}".encode())
+    return hasher.hexdigest()[:16]
+
+
+def new_hasher():
+    """Return the hash object used to fingerprint uploads while they stream in."""
+    return hashlib.sha256()
+
+
+class RunCache:
+    """Completed pipeline runs keyed by the SHA-256 of the uploaded file.
+
+    After a successful run the artifacts folder is snapshotted under
+    ``runs/<digest>/``; an identical upload is then served by restoring the
+    snapshot instead of rerunning Stage 1–8. ``index.json`` keeps one entry per
+    digest plus the digest whose artifacts are currently live.
+    """
+
+    def __init__(
+        self,
+        runs_dir: Path = RUNS_DIR,
+        *,
+        max_runs: int = RUN_CACHE_MAX_RUNS,
+        max_age_hours: float = RUN_CACHE_MAX_AGE_HOURS,
+        in_use: Optional[Callable[[], Iterable[Path]]] = None,
+        version: Optional[str] = None,
+    ):
+        self.runs_dir = Path(runs_dir)
+        # entries stored under another pipeline version are misses (None = pipeline_version())
+        self._version = version
+        # folders still read by someone else (retained jobs point into their snapshot); never deleted
+        self.in_use = in_use
+        self.max_runs = max_runs
+        self.max_age_hours = max_age_hours
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_runs > 0
+
+    @property
+    def version(self) -> str:
+        if self._version is None:
+            self._version = pipeline_version()
+        return self._version
+
+    def _pinned(self, path: Path) -> bool:
+        if self.in_use is None:
+            return False
+        try:
+            used = {Path(p).resolve() for p in self.in_use()}
+        except Exception:
+            return False
+        return Path(path).resolve() in used
+
+    # ---- index persistence ----
+    def _index_path(self) -> Path:
+        return self.runs_dir / INDEX_FILENAME
+
+    def _load_index(self) -> Dict:
+        path = self._index_path()
+        if not path.exists():
+            return {"current": None, "runs": {}}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Warning: failed to read run cache index: {e}")
+            return {"current": None, "runs": {}}
+        data.setdefault("current", None)
+        data.setdefault("runs", {})
+        return data
+
+    def _save_index(self, index: Dict) -> None:
+        self.runs_dir.mkdir(parents=True, exist_ok=True)
+        path = self._index_path()
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _snapshot_dir(self, digest: str) -> Path:
+        return self.runs_dir / digest / "artifacts"
+
+    # ---- public API ----
+    def lookup(self, digest: str) -> Optional[Dict]:
+        """Return the cache entry for ``digest`` (refreshing its LRU stamp) or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            index = self._load_index()
+            entry = index["runs"].get(digest)
+            if entry is None:
+                return None
+            if entry.get("pipeline_version") != self.version:
+                # made by other code or libraries; a snapshot retained jobs still read stays until they are pruned
+                if not self._pinned(self._snapshot_dir(digest)):
+                    index["runs"].pop(digest, None)
+                    shutil.rmtree(self.runs_dir / digest, ignore_errors=True)
+                    if index.get("current") == digest:
+                        index["current"] = None
+                    self._save_index(index)
+                return None
+            if not self._snapshot_dir(digest).exists():
+                index["runs"].pop(digest, None)
+                self._save_index(index)
+                return None
+            entry["last_used"] = time.time()
+            entry["hits"] = int(entry.get("hits", 0)) + 1
+            entry["path"] = str(self._snapshot_dir(digest))
+            self._save_index(index)
+            return dict(entry, digest=digest)
+
+    def is_current(self, digest: str) -> bool:
+        with self._lock:
+            return self._load_index().get("current") == digest
+
+    def set_current(self, digest: Optional[str]) -> None:
+        """Record which digest the live artifacts folder belongs to (None = unknown/in progress)."""
+        with self._lock:
+            index = self._load_index()
+            index["current"] = digest
+            self._save_index(index)
+
+    def store(
+        self,
+        digest: str,
+        artifacts_dir: Path,
+        *,
+        meta: Optional[Dict] = None,
+        move: bool = False,
+    ) -> Optional[Dict]:
+        """Snapshot ``artifacts_dir`` as the result for ``digest`` and apply retention.
+
+        With ``move=True`` the folder itself becomes the snapshot (a rename instead of
+        a copy), which is how per-job artifact folders are handed over to the cache.
+        An existing snapshot of ``digest`` that a retained job still reads is kept
+        and ``artifacts_dir`` is left where it is: the existing entry is returned
+        when it has the same pipeline version (same upload, same results),
+        otherwise the run is not cached.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            target = self._snapshot_dir(digest)
+            index = self._load_index()
+            if target.exists() and digest in index["runs"] and self._pinned(target):
+                entry = index["runs"][digest]
+                if entry.get("pipeline_version") != self.version:
+                    return None
+                entry["last_used"] = time.time()
+                entry.update(meta or {})
+                index["current"] = digest
+                self._save_index(index)
+                return dict(entry, digest=digest)
+            if target.exists():
+                shutil.rmtree(target, ignore_errors=True)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if move:
+                shutil.move(str(artifacts_dir), str(target))
+            else:
+                shutil.copytree(artifacts_dir, target, ignore=shutil.ignore_patterns(*_SNAPSHOT_EXCLUDE))
+
+            now = time.time()
+            entry = {"created": now, "last_used": now, "hits": 0, "path": str(target), "pipeline_version": self.version}
+            entry.update(meta or {})
+            index = self._load_index()
+            index["runs"][digest] = entry
+            index["current"] = digest
+            self._save_index(index)
+            self.evict()
+            return dict(entry, digest=digest)
+
+    def restore(self, digest: str, artifacts_dir: Path) -> bool:
+        """Replace the live artifacts folder with the snapshot for ``digest``."""
+        with self._lock:
+            source = self._snapshot_dir(digest)
+            if not source.exists():
+                return False
+            replace_tree(source, artifacts_dir, ignore=_SNAPSHOT_EXCLUDE)
+            index = self._load_index()
+            index["current"] = digest
+            self._save_index(index)
+            return True
+
+    def evict(self) -> List[str]:
+        """Drop runs older than the age limit, then the least recently used beyond ``max_runs``."""
+        with self._lock:
+            index = self._load_index()
+            runs = index["runs"]
+            evicted: List[str] = []
+
+            if self.max_age_hours > 0:
+                cutoff = time.time() - self.max_age_hours * 3600
+                evicted.extend(d for d, e in runs.items() if e.get("last_used", 0) < cutoff)
+            # runs of an older pipeline version can never be hits again
+            evicted.extend(d for d, e in runs.items() if e.get("pipeline_version") != self.version and d not in evicted)
+
+            # snapshots that retained jobs still point at stay until those jobs are pruned
+            evicted = [d for d in evicted if not self._pinned(self._snapshot_dir(d))]
+            pinned = [d for d in runs if d not in evicted and self._pinned(self._snapshot_dir(d))]
+            remaining = sorted(
+                (d for d in runs if d not in evicted and d not in pinned),
+                key=lambda d: runs[d].get("last_used", 0),
+                reverse=True,
+            )
+            # pinned snapshots count against max_runs, but the most recent run is always kept
+            evicted.extend(remaining[max(self.max_runs - len(pinned), 1):])
+
+            for digest in evicted:
+                runs.pop(digest, None)
+                shutil.rmtree(self.runs_dir / digest, ignore_errors=True)
+                if index.get("current") == digest:
+                    index["current"] = None
+            if evicted:
+                self._save_index(index)
+            return evicted
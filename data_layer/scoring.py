@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from . import distill, features, knn_index, model_bundle, tree_compile
+
+# 模型代號 -> Stage 6 輸出用的名稱
+MODEL_LABELS: Dict[str, str] = {
+    "SVC": "Support Vector Machine",
+    "LR": "Logistic Regression",
+    "KNN": "k-Nearest Neighbors",
+    "DT": "Decision Tree",
+    "RF": "Random Forest",
+    "ADA": "AdaBoost",
+    "GB": "Gradient Boosting",
+    "VOTE": "Voting (RF+GB+KNN)",
+    distill.SURROGATE_NAME: "Voting (RF+GB+KNN), distilled",
+}
+
+_SCORERS: Dict[str, "Scorer"] = {}
+_SCORERS_LOCK = threading.Lock()
+
+
+def safe_predict_proba(est, X) -> np.ndarray:
+    """``predict_proba``; softmax of ``decision_function`` or one-hot predictions for models without it."""
+    if hasattr(est, "predict_proba"):
+        return est.predict_proba(X)
+    if hasattr(est, "decision_function"):
+        scores = np.atleast_2d(est.decision_function(X))
+        if scores.shape[1] == 1:
+            scores = np.c_[-scores, scores]
+        e = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+    preds = est.predict(X)
+    classes = getattr(est, "classes_", np.unique(preds))
+    return (np.asarray(preds)[:, None] == np.asarray(classes)[None, :]).astype(float)
+
+
+def _align(proba: np.ndarray, model_classes: Sequence, classes: Sequence) -> np.ndarray:
+    """Columns of ``proba`` reordered to ``classes`` (classes the model never saw get 0)."""
+    col = {c: j for j, c in enumerate(np.asarray(model_classes).tolist())}
+    out = np.zeros((proba.shape[0], len(classes)), dtype=float)
+    for i, c in enumerate(classes):
+        j = col.get(c)
+        if j is not None:
+            out[:, i] = proba[:, j]
+    return out
+
+
+class Scorer:
+    """Segment probabilities for customer feature rows from the Stage 5 model bundle of one artifacts folder.
+
+    The bundle is loaded once per process (``model_bundle.load_bundle`` caches it
+    and reloads only when a new Stage 5 run replaces the file); each call scores
+    the whole batch with one ``predict_proba`` per model.
+    """
+
+    def __init__(self, artifacts_dir: Path):
+        self.artifacts_dir = Path(artifacts_dir)
+        self.objects_dir = self.artifacts_dir / "objects"
+        self._categories = None
+        self._categories_key = None
+        self._lock = threading.Lock()
+
+    def bundle(self) -> model_bundle.ModelBundle:
+        if (self.objects_dir / model_bundle.MANIFEST_FILE).exists():
+            return model_bundle.load_bundle(self.objects_dir)
+        if (self.artifacts_dir / model_bundle.MANIFEST_FILE).exists():
+            return model_bundle.load_bundle(self.artifacts_dir)
+        raise FileNotFoundError(f"no model bundle under {self.artifacts_dir}; run the pipeline first")
+
+    def warm(self) -> model_bundle.ModelBundle:
+        """Load the bundle, compile its tree ensembles and index its KNN now instead of on the first request."""
+        bundle = self.bundle()
+        for name in bundle.names():
+            tree_compile.compiled(bundle[name]) or knn_index.indexed(bundle[name])
+        return bundle
+
+    def product_categories(self) -> Dict[str, int]:
+        path = self.artifacts_dir / features.PRODUCT_MAP_FILE
+        stat = path.stat() if path.exists() else None
+        key = (stat.st_mtime_ns, stat.st_size) if stat else None
+        with self._lock:
+            if self._categories is None or key != self._categories_key:
+                self._categories = features.load_product_categories(self.artifacts_dir)
+                self._categories_key = key
+            return self._categories
+
+    def features_from_invoices(self, lines: pd.DataFrame) -> pd.DataFrame:
+        """Raw invoice lines -> per-customer aggregates (Stage 4 basket rules + Stage 6 aggregation)."""
+        baskets = features.basket_prices(lines, self.product_categories())
+        if baskets.empty:
+            return pd.DataFrame(columns=["CustomerID"] + features.AGGREGATE_COLUMNS)
+        return features.customer_aggregates(baskets)
+
+    def score(self, rows: pd.DataFrame, models: Optional[Sequence[str]] = None, exact: bool = False) -> Dict:
+        """Probabilities (columns follow ``classes``) and predicted segment per requested model.
+
+        The voting model is averaged from its members' probabilities computed for
+        the batch, the same numbers ``VotingClassifier.predict_proba`` returns.
+        When Stage 5 distilled it with enough fidelity, ``VOTE`` is answered by
+        the surrogate instead (unless ``exact``); ``surrogate`` says so.
+        """
+        bundle = self.bundle()
+        names = list(models) if models else [n for n in bundle.names() if n != distill.SURROGATE_NAME]
+        unknown = [n for n in names if n not in bundle]
+        if unknown:
+            raise ValueError(f"unknown models: {unknown}; available: {bundle.names()}")
+
+        X = features.feature_frame(rows)
+        if bundle.features and list(bundle.features) != list(X.columns):
+            X = X[bundle.features]
+        values = X.to_numpy()
+        classes = bundle.classes or sorted({c for n in names for c in getattr(bundle[n], "classes_", [])})
+        members = {
+            name: spec.get("members", [])
+            for name, spec in bundle.manifest.get("models", {}).items()
+            if spec.get("members")
+        }
+
+        raw: Dict[str, np.ndarray] = {}
+        distillation = (bundle.manifest.get("metadata") or {}).get("distillation") or {}
+        surrogate = None
+        if not exact and distillation.get("use_for_scoring") and distill.SURROGATE_NAME in bundle:
+            surrogate = bundle[distill.SURROGATE_NAME]
+
+        def proba_of(name: str) -> np.ndarray:
+            if name not in raw:
+                est = bundle[name]
+                parts = members.get(name)
+                if name == "VOTE" and surrogate is not None:
+                    raw[name] = surrogate.predict_proba(values)
+                elif parts and getattr(est, "voting", None) == "soft":
+                    raw[name] = np.average(
+                        [_align(proba_of(m), bundle[m].classes_, est.classes_) for m in parts],
+                        axis=0,
+                        weights=getattr(est, "weights", None),
+                    )
+                else:
+                    # RF/GB 小批次走編譯後的陣列走訪（與 predict_proba 逐位元相同）；KNN 走預建索引
+                    fast = tree_compile.compiled(est) or knn_index.indexed(est) or est
+                    # 以 ndarray 訓練的模型（搜尋 worker 的 mmap 資料）直接吃 ndarray
+                    raw[name] = safe_predict_proba(fast, X if hasattr(est, "feature_names_in_") else values)
+            return raw[name]
+
+        out = {}
+        for name in names:
+            est = bundle[name]
+            model_classes = getattr(est, "classes_", classes)
+            proba = proba_of(name)
+            out[name] = {
+                "label": MODEL_LABELS.get(name, name),
+                "proba": _align(proba, model_classes, classes),
+                "pred": np.asarray(model_classes)[proba.argmax(axis=1)],
+            }
+        return {
+            "classes": list(classes),
+            "models": out,
+            "surrogate": surrogate is not None and "VOTE" in names,
+            "bundle": {k: bundle.manifest.get(k) for k in ("created_at", "sha256", "sklearn_version")},
+        }
+
+
+def get_scorer(artifacts_dir: Path) -> Scorer:
+    """One ``Scorer`` per artifacts folder and process."""
+    key = str(Path(artifacts_dir).resolve())
+    with _SCORERS_LOCK:
+        scorer = _SCORERS.get(key)
+        if scorer is None:
+            scorer = _SCORERS[key] = Scorer(artifacts_dir)
+        return scorer
@@ -19,6 +19,8 @@ class StageSummary:
   rows: int
   cols: int
   artifacts_file: Path
+  customers: Optional[int] = None
+  products: Optional[int] = None
 
   def as_dict(self) -> dict:
     return {
@@ -26,16 +28,20 @@ class StageSummary:
       "rows": self.rows,
       "cols": self.cols,
       "artifacts_file": str(self.artifacts_file),
+      "customers": self.customers,
+      "products": self.products,
     }
 
 
-def clean_csv(source: Optional[Path] = None) -> StageSummary:
+def clean_csv(source: Optional[Path] = None, artifacts_dir: Optional[Path] = None) -> StageSummary:
   source = source or UPLOAD_FILE
   if not source.exists():
     raise FileNotFoundError(f"找不到來源檔案：{source}")
 
-  ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
-  UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+  artifacts_dir = artifacts_dir or ARTIFACTS_DIR
+  output_file = artifacts_dir / BASE_OUTPUT_FILE.name
+  artifacts_dir.mkdir(parents=True, exist_ok=True)
+  source.parent.mkdir(parents=True, exist_ok=True)
 
   df_initial = pd.read_csv(
     source,
@@ -51,20 +57,25 @@ def clean_csv(source: Optional[Path] = None) -> StageSummary:
 
   df_initial.drop_duplicates(inplace=True)
 
-  df_initial.to_csv(BASE_OUTPUT_FILE, index=False)
+  df_initial.to_csv(output_file, index=False)
 
   rows, cols = df_initial.shape
+  # 給 ETA 模型用的資料規模
+  customers = int(df_initial["CustomerID"].nunique())
+  products = int(df_initial["StockCode"].nunique()) if "StockCode" in df_initial.columns else None
 
   return StageSummary(
     duplicate_rows=dup_count,
     rows=rows,
     cols=cols,
-    artifacts_file=BASE_OUTPUT_FILE,
+    artifacts_file=output_file,
+    customers=customers,
+    products=products,
   )
 
 
-def run_stage() -> StageSummary:
-  return clean_csv()
+def run_stage(source: Optional[Path] = None, artifacts_dir: Optional[Path] = None) -> StageSummary:
+  return clean_csv(source, artifacts_dir)
 
 
 if __name__ == "__main__":
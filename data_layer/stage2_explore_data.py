@@ -2,13 +2,14 @@
 # 功能：在不改變原始邏輯的前提下，使用向量化（merge）完成「取消訂單沖銷」，
 #       並產出 df_cleaned.csv 與 liste_produits.csv。終端機只印最後一行狀態。
 
+import os
 import pandas as pd
 import numpy as np
 from pathlib import Path
 
 # 準備輸出資料夾
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / "artifacts"
+ARTIFACTS = Path(os.environ.get("RFM_ARTIFACTS_DIR") or DATA_LAYER_DIR / "artifacts")
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 
 # 讀取 Stage 1 清洗後資料
@@ -8,6 +8,7 @@
 #   * artifacts/objects/kmeans_products.pkl（模型本體）
 #   * artifacts/objects/X_products.pkl（特徵矩陣，用於審計/再訓練）
 
+import os
 import warnings
 from pathlib import Path
 
@@ -44,7 +45,7 @@ for pkg in nltk_packages:
 # 輸入資料：df_cleaned.csv（上一階段 Stage 2 已清洗與沖銷）
 # ----------------------------------------------------
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / "artifacts"
+ARTIFACTS = Path(os.environ.get("RFM_ARTIFACTS_DIR") or DATA_LAYER_DIR / "artifacts")
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 OBJECTS = ARTIFACTS / "objects"
 OBJECTS.mkdir(parents=True, exist_ok=True)
@@ -12,7 +12,7 @@ Stage 4 — RFM分析に基づく顧客セグメント化（改良版）
 5) KMeans(9群)でクラスタリング、Silhouetteスコアを記録
 """
 
-import warnings, datetime
+import os, sys, warnings, datetime
 from pathlib import Path
 import pandas as pd
 import numpy as np
@@ -24,7 +24,10 @@ import joblib
 
 warnings.filterwarnings("ignore")
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / "artifacts"
+if str(DATA_LAYER_DIR.parent) not in sys.path:  # 直接以子行程執行時也能 import data_layer
+    sys.path.insert(0, str(DATA_LAYER_DIR.parent))
+from data_layer import feature_store, features  # noqa: E402
+ARTIFACTS = Path(os.environ.get("RFM_ARTIFACTS_DIR") or DATA_LAYER_DIR / "artifacts")
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 OBJECTS = ARTIFACTS / "objects"
 OBJECTS.mkdir(parents=True, exist_ok=True)
@@ -214,6 +217,12 @@ set_entrainement.to_csv(ARTIFACTS / "stage4_set_entrainement.csv", index=False)
 set_test.to_csv(ARTIFACTS / "stage4_set_test.csv", index=False)
 transactions_per_user.to_csv(ARTIFACTS / "stage4_selected_customers_train.csv", index=False)
 
+# 客戶特徵只在這裡算一次：train／test 矩陣寫進 feature store，Stage 5/6/7 與伺服器直接讀
+feature_store.write_splits(ARTIFACTS, {
+    "train": transactions_per_user,
+    "test": features.test_customer_features(set_test),
+})
+
 joblib.dump(scaler, ARTIFACTS / "objects/scaler.pkl")
 joblib.dump(rfm_data, ARTIFACTS / "objects/rfm_reference.pkl")
 
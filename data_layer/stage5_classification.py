@@ -3,28 +3,74 @@
 # Goal: Train all classifiers on training set; save best estimators + ensemble
 # =============================
 
-import warnings, json
+import os, sys, warnings, json, shutil, tempfile, time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import joblib
+import sklearn
 
 from sklearn import neighbors, linear_model, svm, tree, ensemble, metrics
-from sklearn.model_selection import GridSearchCV, train_test_split
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (registers HalvingGridSearchCV)
+from sklearn.model_selection import (
+    HalvingGridSearchCV, ParameterGrid, ParameterSampler, check_cv, train_test_split
+)
+from sklearn.base import clone
+from sklearn.utils import _safe_indexing
+from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
+from scipy.stats import rankdata
 from sklearn.ensemble import AdaBoostClassifier, VotingClassifier
+from sklearn.preprocessing import LabelEncoder
+from sklearn.utils import Bunch
 
 warnings.filterwarnings("ignore")
 
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / "artifacts"
+if str(DATA_LAYER_DIR.parent) not in sys.path:  # 直接以子行程執行時也能 import data_layer
+    sys.path.insert(0, str(DATA_LAYER_DIR.parent))
+from data_layer import distill, feature_store, features, model_bundle, proba_store  # noqa: E402
+from data_layer.progress import write_json_atomic  # noqa: E402
+
+ARTIFACTS = Path(os.environ.get("RFM_ARTIFACTS_DIR") or DATA_LAYER_DIR / "artifacts")
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 OBJECTS = ARTIFACTS / "objects"
 OBJECTS.mkdir(parents=True, exist_ok=True)
 
+# ---- 超參數搜尋策略：exhaustive（完整 GridSearchCV）/ randomized / halving（successive halving）----
+SEARCH_STRATEGY = os.environ.get("STAGE5_SEARCH", "exhaustive").strip().lower()
+SEARCH_N_ITER = int(os.environ.get("STAGE5_SEARCH_N_ITER", "10"))       # randomized 每個模型最多試幾組
+SEARCH_BUDGET_SEC = float(os.environ.get("STAGE5_SEARCH_BUDGET_SEC", "0"))  # 全部模型合計秒數，0 = 不限
+SEARCH_STRATEGIES = ("exhaustive", "randomized", "halving")
+if SEARCH_STRATEGY not in SEARCH_STRATEGIES:
+    print(f"[Stage 5] Unknown STAGE5_SEARCH={SEARCH_STRATEGY!r}, using exhaustive")
+    SEARCH_STRATEGY = "exhaustive"
+# n_estimators 網格改用增量評估（boosting 用 staged_predict、forest 用 warm_start）
+STAGED_ENSEMBLES = os.environ.get("STAGE5_STAGED_ENSEMBLES", "1").strip().lower() not in ("0", "false", "no")
+# 平行數由 pipeline 的 CPU 預算決定（cpu_budget.py），單獨執行時用滿所有 CPU
+N_JOBS = int(os.environ.get("RFM_N_JOBS", "-1"))
+# 跨次執行的超參數記憶：先在上次最佳參數附近搜尋，CV 分數掉超過 tolerance 才回到完整網格
+SEARCH_MEMORY = os.environ.get("STAGE5_SEARCH_MEMORY", "1").strip().lower() not in ("0", "false", "no")
+SEARCH_MEMORY_FILE = Path(os.environ.get("STAGE5_SEARCH_MEMORY_FILE") or DATA_LAYER_DIR / "state" / "stage5_search_memory.json")
+SEARCH_MEMORY_RADIUS = int(os.environ.get("STAGE5_SEARCH_MEMORY_RADIUS", "2"))          # 數值參數前後各保留幾格
+SEARCH_MEMORY_TOLERANCE = float(os.environ.get("STAGE5_SEARCH_MEMORY_TOLERANCE", "0.02"))  # 允許的 CV accuracy 下降
+# 漂移閘門：特徵與標籤分佈和上次訓練相比沒有明顯改變時，不重訓、直接沿用上次的模型做評估
+DRIFT_GATE = os.environ.get("STAGE5_DRIFT_GATE", "1").strip().lower() not in ("0", "false", "no")
+DRIFT_PSI_THRESHOLD = float(os.environ.get("STAGE5_DRIFT_PSI", "0.1"))                 # PSI < 0.1 視為沒有位移
+DRIFT_CLASS_SHIFT = float(os.environ.get("STAGE5_DRIFT_CLASS_SHIFT", "0.25"))          # 各群平均的位移（參考標準差倍數）
+DRIFT_MAX_AGE_DAYS = float(os.environ.get("STAGE5_DRIFT_MAX_AGE_DAYS", "28"))          # 模型最久沿用幾天，0 = 不限
+REFERENCE_DIR = Path(os.environ.get("STAGE5_REFERENCE_DIR") or DATA_LAYER_DIR / "state" / "stage5_reference")
+# 新的參考先寫在本次 artifacts 裡，整個 pipeline 成功後才由 pipeline.py 換成 REFERENCE_DIR
+PENDING_REFERENCE_DIR = ARTIFACTS / "stage5_reference"
+
 # ---- Load features/labels from Stage 4 ----
-selected_customers = pd.read_csv(ARTIFACTS / "stage4_selected_customers_train.csv")
-columns = ['mean', 'categ_0', 'categ_1', 'categ_2', 'categ_3', 'categ_4' ]
+# Stage 4 寫好的 feature store（舊 artifacts 則由 stage4_selected_customers_train.csv 建一次）
+selected_customers = feature_store.load(ARTIFACTS, "train", run_id=os.environ.get("RFM_RUN_ID")).frame()
+columns = features.FEATURE_COLUMNS
 X = selected_customers[columns]
 Y = selected_customers['cluster']
 
@@ -34,6 +80,397 @@ X_train, X_test, Y_train, Y_test = train_test_split(
 )
 test_ids = selected_customers.loc[X_test.index, 'CustomerID'].values  # for exporting
 
+# ---- 搜尋拆成獨立的工作單位（所有模型共用一個 executor）----
+# 單次 fit 的相對成本（約 2.4k 筆訓練資料、11 群時量到的秒數；有 n_estimators 的再乘上棵數），只用來排順序
+_FIT_COST = {
+    "LinearSVC": 0.04,
+    "LogisticRegression": 0.1,
+    "KNeighborsClassifier": 0.05,
+    "DecisionTreeClassifier": 0.04,
+    "RandomForestClassifier": 0.02,
+    "AdaBoostClassifier": 0.02,
+    "GradientBoostingClassifier": 0.13,
+}
+
+
+def _unit_cost(estimator, n_estimators=None):
+    n = n_estimators or estimator.get_params().get("n_estimators") or 1
+    return _FIT_COST.get(type(estimator).__name__, 0.05) * float(n)
+
+
+class _InMemory(object):
+    """單核 / 單獨 fit 時直接帶著陣列。"""
+
+    def __init__(self, X, y):
+        self.X, self.y = np.asarray(X), np.asarray(y)
+
+    def arrays(self):
+        return self.X, self.y
+
+
+class _Memmapped(object):
+    """X / y 只寫一次 .npy，工作單位只帶路徑，worker 以 mmap 讀（不必每個單位都序列化資料）。"""
+
+    def __init__(self, X, y, folder):
+        self.x_path, self.y_path = str(Path(folder) / "X.npy"), str(Path(folder) / "y.npy")
+        np.save(self.x_path, np.asarray(X))
+        np.save(self.y_path, np.asarray(y))
+
+    def arrays(self):
+        return np.load(self.x_path, mmap_mode="r"), np.load(self.y_path, mmap_mode="r")
+
+
+def _fold_score(estimator, params, data, train, test):
+    """一組參數、一個 fold 的 accuracy；訓練失敗記 NaN（同 GridSearchCV 的 error_score）。"""
+    X, y = data.arrays()
+    try:
+        est = clone(estimator).set_params(**params)
+        est.fit(_safe_indexing(X, train), _safe_indexing(y, train))
+        return est.score(_safe_indexing(X, test), _safe_indexing(y, test))
+    except Exception:
+        return np.nan
+
+
+def _staged_fold_scores(estimator, base_params, sizes, data, train, test):
+    """一個 fold、一組非 n_estimators 參數下，每個 n_estimators 的 accuracy。"""
+    X, y = data.arrays()
+    X_tr, X_te = _safe_indexing(X, train), _safe_indexing(X, test)
+    y_tr, y_te = _safe_indexing(y, train), _safe_indexing(y, test)
+    est = clone(estimator).set_params(**base_params)
+    scores = {}
+    if hasattr(est, "staged_predict"):
+        # boosting：只 fit 最大棵數，前 n 棵的預測就等於 n_estimators=n 的模型
+        est.set_params(n_estimators=sizes[-1]).fit(X_tr, y_tr)
+        wanted = set(sizes)
+        pred = None
+        for n, pred in enumerate(est.staged_predict(X_te), start=1):
+            if n in wanted:
+                scores[n] = metrics.accuracy_score(y_te, pred)
+        for n in sizes:  # AdaBoost 可能提前停止，之後的棵數與最後一個前綴相同
+            scores.setdefault(n, metrics.accuracy_score(y_te, pred))
+    else:
+        # forest：warm_start 逐步加樹，在每個檢查點評分
+        est.set_params(warm_start=True)
+        for n in sizes:
+            est.set_params(n_estimators=n).fit(X_tr, y_tr)
+            scores[n] = est.score(X_te, y_te)
+    return [scores[n] for n in sizes]
+
+
+def _fit_search(search, data):
+    """halving 各輪互相依賴，整個搜尋當一個單位在 worker 內依序跑。"""
+    X, y = data.arrays()
+    return search.set_params(n_jobs=1, verbose=0).fit(X, y)
+
+
+def _refit(estimator, params, X, y):
+    return clone(estimator).set_params(**params).fit(X, y)
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    with warnings.catch_warnings():  # loky worker 不會繼承本檔開頭的 filterwarnings
+        warnings.simplefilter("ignore")
+        value = fn(*args)
+    return value, time.perf_counter() - start
+
+
+class _UnitSearchCV(ABC):
+    """GridSearchCV 的替代品：搜尋拆成獨立的 (參數, fold) 單位。
+
+    units() 產生 (函式, 參數, 相對成本)，collect() 依單位編號把分數組回
+    cv_results_ / best_params_ / best_score_（沒跑到的單位記 NaN，排名最後）。
+    單獨 fit() 時用 joblib；Stage 5 由 run_searches() 把所有模型的單位放進同一個 executor。
+    """
+
+    def __init__(self, estimator, cv=5, n_jobs=N_JOBS, verbose=0):
+        self.estimator = estimator
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+
+    def _split(self, data):
+        X, y = data.arrays()
+        self.splits_ = list(check_cv(self.cv, y, classifier=True).split(X, y))
+        self.n_splits_ = len(self.splits_)
+        return self.splits_
+
+    @abstractmethod
+    def units(self, data):
+        """(函式, 參數, 相對成本) 的清單；順序即單位編號。"""
+
+    @abstractmethod
+    def collect(self, results):
+        """{單位編號: 結果} 組回 cv_results_ / best_params_ / best_score_。"""
+
+    def fit(self, X, y):
+        units = self.units(_InMemory(X, y))
+        if self.verbose:
+            print(f"Fitting {len(units)} search units ({self.n_splits_} folds)")
+        values = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(delayed(fn)(*args) for fn, args, _ in units)
+        self.collect(dict(enumerate(values)))
+        self.best_estimator_ = _refit(self.estimator, self.best_params_, X, y)
+        return self
+
+    def _set_results(self, params, split_scores):
+        split_scores = np.asarray(split_scores, dtype=float).reshape(len(params), self.n_splits_)
+        mean = split_scores.mean(axis=1)
+        # 與 GridSearchCV 相同：NaN 排最後，同分取較前面的候選
+        rank = rankdata(-np.where(np.isnan(mean), -np.inf, mean), method="min").astype(int)
+        self.cv_results_ = {"params": params, "mean_test_score": mean,
+                            "std_test_score": split_scores.std(axis=1), "rank_test_score": rank}
+        for i in range(self.n_splits_):
+            self.cv_results_[f"split{i}_test_score"] = split_scores[:, i]
+        self.best_index_ = int(rank.argmin())
+        self.best_params_ = params[self.best_index_]
+        self.best_score_ = float(mean[self.best_index_])
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+class CandidateSearchCV(_UnitSearchCV):
+    """固定候選清單的搜尋：exhaustive 用 ParameterGrid、randomized 用 ParameterSampler（與 sklearn 抽樣相同）。"""
+
+    def __init__(self, estimator, candidates, cv=5, n_jobs=N_JOBS, verbose=0):
+        super().__init__(estimator, cv=cv, n_jobs=n_jobs, verbose=verbose)
+        self.candidates = list(candidates)
+
+    def units(self, data):
+        splits = self._split(data)
+        return [
+            (_fold_score, (self.estimator, params, data, train, test), _unit_cost(self.estimator, params.get("n_estimators")))
+            for params in self.candidates
+            for train, test in splits
+        ]
+
+    def collect(self, results):
+        self.n_fits_ = len(results)
+        n = len(self.candidates) * self.n_splits_
+        self._set_results(self.candidates, [results.get(i, np.nan) for i in range(n)])
+        return self
+
+
+class StagedEnsembleSearchCV(_UnitSearchCV):
+    """專門處理含 n_estimators 的網格。
+
+    其他參數的每個組合、每個 fold 只訓練一次（boosting 以最大棵數 fit 後用 staged_predict
+    評每個前綴；forest 以 warm_start 逐步長到各檢查點），結果與 GridSearchCV 相同格式：
+    cv_results_、best_params_、best_score_、best_estimator_（以全部訓練資料 refit）。
+    """
+
+    def __init__(self, estimator, param_grid, cv=5, n_jobs=N_JOBS, verbose=0):
+        super().__init__(estimator, cv=cv, n_jobs=n_jobs, verbose=verbose)
+        self.param_grid = param_grid if isinstance(param_grid, list) else [param_grid]
+
+    @staticmethod
+    def supports(estimator, param_grid):
+        grids = param_grid if isinstance(param_grid, list) else [param_grid]
+        if not all("n_estimators" in g for g in grids):
+            return False
+        return hasattr(estimator, "staged_predict") or "warm_start" in estimator.get_params()
+
+    def units(self, data):
+        splits = self._split(data)
+        self.groups_ = []  # (其他參數, 排序後的 n_estimators)
+        for grid in self.param_grid:
+            sizes = sorted({int(n) for n in grid["n_estimators"]})
+            rest = {k: v for k, v in grid.items() if k != "n_estimators"}
+            for base in ParameterGrid(rest):
+                self.groups_.append((base, sizes))
+        return [
+            (_staged_fold_scores, (self.estimator, base, sizes, data, train, test), _unit_cost(self.estimator, sizes[-1]))
+            for base, sizes in self.groups_
+            for train, test in splits
+        ]
+
+    def collect(self, results):
+        self.n_fits_ = len(results)
+        by_candidate = {}
+        for g, (base, sizes) in enumerate(self.groups_):
+            per_fold = [results.get(g * self.n_splits_ + f) for f in range(self.n_splits_)]
+            for i, n in enumerate(sizes):
+                key = json.dumps(dict(base, n_estimators=n), sort_keys=True, default=str)
+                by_candidate[key] = [np.nan if fold is None else fold[i] for fold in per_fold]
+
+        # 候選順序與 GridSearchCV 一致（ParameterGrid），同分時取較前面的
+        params = list(ParameterGrid(self.param_grid))
+        self._set_results(params, [
+            by_candidate[json.dumps(dict(p, n_estimators=int(p["n_estimators"])), sort_keys=True, default=str)]
+            for p in params
+        ])
+        return self
+
+
+class _InlineExecutor(object):
+    """單核時直接在本行程執行，省掉 worker 啟動與序列化。"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+        return future
+
+
+def _n_workers(n_jobs):
+    return max(1, joblib.cpu_count() + 1 + n_jobs if n_jobs < 0 else n_jobs)
+
+
+def run_searches(models, X, y, n_jobs=N_JOBS, budget_sec=SEARCH_BUDGET_SEC):
+    """所有模型的搜尋放進同一個 executor，整體時間約為「總工作量 / 核心數」。
+
+    每個模型拆成 (參數, fold) 單位（halving 各輪相依，整個搜尋算一個單位），
+    依估計成本由大到小送出（LPT），小模型的單位自然補進大模型留下的空檔；
+    某個模型的單位全部完成就送出它的 refit，最佳模型邊完成邊收。
+    分數只依單位編號組回、與完成順序無關，結果和逐一執行相同。
+    超過 budget_sec 後不再送出新單位，沒跑到的候選記 NaN。
+    """
+    workers = _n_workers(n_jobs)
+    names = list(models)
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="stage5_search_", dir=ARTIFACTS) as tmp:
+        data = _Memmapped(X, y, tmp) if workers > 1 else _InMemory(X, y)
+        executor = get_reusable_executor(max_workers=workers) if workers > 1 else _InlineExecutor()
+        plans = {name: models[name].search_units(data) for name in names}
+        order = sorted(
+            ((cost, i, u) for i, name in enumerate(names) for u, (_, _, cost) in enumerate(plans[name])),
+            key=lambda t: (-t[0], t[1], t[2]),
+        )
+        queue = deque((names[i], u) for _, i, u in order)
+        results = {name: {} for name in names}
+        remaining = {name: len(plans[name]) for name in names}
+        work_sec = dict.fromkeys(names, 0.0)
+        refits = deque()
+        pending = {}
+        print(f"[Stage 5] {len(queue)} search units from {len(names)} models on {workers} worker(s)")
+
+        def unit_done(name):
+            if models[name].collect_units(results[name], data):
+                refits.append(name)
+            else:
+                finished(name)
+
+        def finished(name):
+            fit = models[name]
+            fit.search_sec = work_sec[name]
+            fit.finished_after_sec = time.perf_counter() - started
+            print(f"[Stage 5] {name} search done after {fit.finished_after_sec:.1f}s: "
+                  f"best {fit.grid.best_params_} (cv {fit.grid.best_score_:.3f})")
+
+        while queue or refits or pending:
+            while refits and len(pending) < workers * 2:
+                name = refits.popleft()
+                fn, args = models[name].refit_unit(X, y)
+                pending[executor.submit(_timed, fn, *args)] = (name, None)
+            if budget_sec > 0 and queue and time.perf_counter() - started >= budget_sec:
+                print(f"[Stage 5] Search budget {budget_sec:.0f}s used up, skipping {len(queue)} units")
+                while queue:
+                    name, _ = queue.popleft()
+                    models[name].budget_exhausted = True
+                    remaining[name] -= 1
+                    if remaining[name] == 0:
+                        unit_done(name)
+                continue
+            while queue and len(pending) < workers * 2:
+                name, u = queue.popleft()
+                fn, args, _ = plans[name][u]
+                pending[executor.submit(_timed, fn, *args)] = (name, u)
+            if not pending:
+                continue
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                name, u = pending.pop(future)
+                value, sec = future.result()
+                work_sec[name] += sec
+                if u is None:
+                    models[name].grid.best_estimator_ = value
+                    finished(name)
+                    continue
+                results[name][u] = value
+                remaining[name] -= 1
+                if remaining[name] == 0:
+                    unit_done(name)
+    return time.perf_counter() - started
+
+
+# ---- 跨次執行的超參數記憶 ----
+def _plain(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+def grid_key(parameters):
+    """網格的字串表示；網格定義改了就不沿用舊的記憶。"""
+    grids = parameters if isinstance(parameters, list) else [parameters]
+    return json.dumps([{k: [_plain(v) for v in g[k]] for k in sorted(g)} for g in grids], sort_keys=True)
+
+
+def narrow_grid(parameters, best_params, radius=SEARCH_MEMORY_RADIUS):
+    """上次最佳參數附近的子網格：數值參數保留排序後前後 radius 格，類別參數只留上次的值。"""
+    grids = parameters if isinstance(parameters, list) else [parameters]
+    narrowed = []
+    for grid in grids:
+        if set(grid) != set(best_params):
+            continue  # 最佳參數來自另一個子網格
+        sub = {}
+        for key, values in grid.items():
+            values, best = [_plain(v) for v in values], best_params[key]
+            numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values + [best])
+            if numeric:
+                ordered = sorted(values)
+                i = int(np.argmin([abs(v - best) for v in ordered]))
+                sub[key] = ordered[max(0, i - radius):i + radius + 1]
+            else:
+                sub[key] = [v for v in values if v == best] or values
+        narrowed.append(sub)
+    return narrowed or None
+
+
+def load_search_memory(path=SEARCH_MEMORY_FILE):
+    if not SEARCH_MEMORY:
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("models", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_search_memory(fits, test_scores, n_train, path=SEARCH_MEMORY_FILE):
+    """每個模型的最佳參數、CV 分數曲線與測試集 accuracy；預算用完（分數不完整）的模型保留舊記錄。"""
+    if not SEARCH_MEMORY:
+        return
+    models = load_search_memory(path)
+    for name, fit in fits.items():
+        if fit.budget_exhausted or np.isnan(fit.grid.best_score_):
+            continue
+        curve = {}
+        previous = models.get(name)
+        if previous and previous.get("grid") == grid_key(fit.full_parameters):
+            # 縮小網格只更新評估到的點，其餘沿用上次的曲線
+            for point in previous.get("curve", []):
+                point = dict(point)
+                score = point.pop("mean_test_score")
+                curve[json.dumps(point, sort_keys=True)] = score
+        cv = fit.grid.cv_results_
+        for params, score in zip(cv["params"], cv["mean_test_score"]):
+            if not np.isnan(score):  # halving 同一組參數取最後（樣本最多）那輪
+                curve[json.dumps({k: _plain(v) for k, v in params.items()}, sort_keys=True)] = float(score)
+        models[name] = {
+            "grid": grid_key(fit.full_parameters),
+            "best_params": {k: _plain(v) for k, v in fit.grid.best_params_.items()},
+            "best_cv_score": float(fit.grid.best_score_),
+            "test_accuracy": test_scores.get(name),
+            "curve": [dict(json.loads(k), mean_test_score=v) for k, v in curve.items()],
+            "narrowed": fit.narrowed and not fit.full_grid_fallback,
+            "n_train": int(n_train),
+            "updated_at": time.time(),
+        }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(path, {"version": 1, "models": models})
+
+
 # ---- Helper（沿用你的介面）----
 class Class_Fit(object):
     def __init__(self, clf, params=None):
@@ -48,25 +485,117 @@ class Class_Fit(object):
     def predict(self, x):
         return self.clf.predict(x)
 
-    def grid_search(self, parameters, Kfold):
-    # 平行用滿所有 CPU，並顯示進度
-        self.grid = GridSearchCV(
-            estimator=self.clf,
-            param_grid=parameters,
-            cv=Kfold,
-            n_jobs=-1,
-            verbose=1
-    )
-
-
-    def grid_fit(self, X, Y):
-        self.grid.fit(X, Y)
-
-    def grid_predict(self, X, Y):
-        self.predictions = self.grid.predict(X)
-        acc = float(metrics.accuracy_score(Y, self.predictions))
-        print("Precision: {:.2f} % ".format(100*acc))
-        return acc
+    def grid_search(self, parameters, Kfold, strategy=None, memory=None):
+        self.requested_strategy = strategy
+        self.full_parameters = parameters
+        self.full_grid_fallback = False
+        self.memory = memory
+        self.narrowed = False
+        if memory and memory.get("grid") == grid_key(parameters):
+            narrowed = narrow_grid(parameters, memory["best_params"])
+            if narrowed is not None:
+                parameters, self.narrowed = narrowed, True
+        self.strategy = strategy or SEARCH_STRATEGY
+        self.parameters = parameters
+        self.Kfold = Kfold
+        self.n_candidates = len(ParameterGrid(parameters))
+        self.budget_exhausted = False  # run_searches 超過預算時設為 True
+        if STAGED_ENSEMBLES and StagedEnsembleSearchCV.supports(self.clf, parameters):
+            # 完整網格，但每個 fold 只訓練一次（比 halving / randomized 更便宜且不漏組合）
+            self.strategy = "staged"
+            self.grid = StagedEnsembleSearchCV(estimator=self.clf, param_grid=parameters, cv=Kfold, verbose=1)
+        elif self.strategy == "randomized":
+            n_iter = min(SEARCH_N_ITER, self.n_candidates)
+            self.grid = CandidateSearchCV(
+                estimator=self.clf,
+                candidates=ParameterSampler(parameters, n_iter, random_state=42),
+                cv=Kfold,
+                verbose=1
+            )
+        elif self.strategy == "halving":
+            # 每輪保留前 1/3 的參數組、樣本數 x3，最後一輪用全部訓練資料
+            self.grid = HalvingGridSearchCV(
+                estimator=self.clf,
+                param_grid=parameters,
+                cv=Kfold,
+                factor=3,
+                n_jobs=N_JOBS,
+                random_state=42,
+                verbose=1
+            )
+        else:
+            self.grid = CandidateSearchCV(estimator=self.clf, candidates=ParameterGrid(parameters), cv=Kfold, verbose=1)
+
+    def needs_full_grid(self, tolerance=SEARCH_MEMORY_TOLERANCE):
+        """縮小的網格 CV 分數比上次低超過 tolerance（或沒分數）時，改搜完整網格。"""
+        if not self.narrowed:
+            return False
+        score = self.grid.best_score_
+        return np.isnan(score) or score < self.memory["best_cv_score"] - tolerance
+
+    def widen(self):
+        """改搜完整網格（保留縮小網格花掉的秒數與記憶，寫進 summary）。"""
+        self.narrowed_search_sec = self.search_sec
+        memory = self.memory
+        self.grid_search(self.full_parameters, self.Kfold, strategy=self.requested_strategy)
+        self.memory = memory
+        self.full_grid_fallback = True
+
+    def search_units(self, data):
+        """搜尋拆成的工作單位（給 run_searches）。"""
+        if isinstance(self.grid, _UnitSearchCV):
+            return self.grid.units(data)
+        return [(_fit_search, (self.grid, data), _unit_cost(self.clf) * self.n_candidates * self.Kfold)]
+
+    def collect_units(self, results, data):
+        """單位全部結束後組回結果；回傳是否還需要 refit。"""
+        if isinstance(self.grid, _UnitSearchCV):
+            self.grid.collect(results)
+            return True
+        if 0 in results:
+            self.grid = results[0]
+            return False
+        # halving 因預算沒跑到：直接用第一組參數
+        self.grid = CandidateSearchCV(self.clf, list(ParameterGrid(self.parameters))[:1], cv=self.Kfold)
+        self.grid.units(data)
+        self.grid.collect({})
+        return True
+
+    def refit_unit(self, X, Y):
+        return _refit, (self.clf, self.grid.best_params_, X, Y)
+
+    def search_summary(self):
+        """搜尋策略與分數，寫進 stage5_eval.json 的 "search"。"""
+        cv = self.grid.cv_results_
+        evaluated = {
+            json.dumps(p, sort_keys=True, default=str)
+            for p, s in zip(cv["params"], cv["mean_test_score"]) if not np.isnan(s)
+        }
+        summary = {
+            "strategy": self.strategy,
+            "candidates_total": self.n_candidates,
+            "candidates_evaluated": len(evaluated),
+            "fits": int(getattr(self.grid, "n_fits_", len(cv["params"]) * self.grid.n_splits_)),
+            "best_params": {k: (v.item() if hasattr(v, "item") else v) for k, v in self.grid.best_params_.items()},
+            "best_cv_score": None if np.isnan(self.grid.best_score_) else float(self.grid.best_score_),
+            "duration_sec": round(self.search_sec, 3),  # 所有單位的 fit 秒數合計（不是牆鐘時間）
+            "budget_exhausted": self.budget_exhausted,
+        }
+        if hasattr(self, "finished_after_sec"):
+            summary["finished_after_sec"] = round(self.finished_after_sec, 3)
+        if self.memory:
+            summary["memory"] = {
+                "narrowed": self.narrowed,
+                "full_grid_candidates": len(ParameterGrid(self.full_parameters)),
+                "full_grid_fallback": self.full_grid_fallback,
+                "previous_best_params": self.memory.get("best_params"),
+                "previous_best_cv_score": self.memory.get("best_cv_score"),
+            }
+            if self.full_grid_fallback:
+                summary["duration_sec"] = round(self.search_sec + self.narrowed_search_sec, 3)
+        if self.strategy == "halving" and hasattr(self.grid, "n_resources_"):
+            summary["resources_per_iteration"] = [int(r) for r in self.grid.n_resources_]
+        return summary
 
 # ---- 安全取得機率（LinearSVC 轉 softmax；其他用 predict_proba）----
 def _safe_predict_proba(est, X):
@@ -86,103 +615,287 @@ def _safe_predict_proba(est, X):
         proba[preds == c, i] = 1.0
     return proba
 
-def proba_dataframe(model, X, model_name, class_labels, index_values, y_true=None, y_pred=None):
-    proba = _safe_predict_proba(model, X)
+def aligned_proba(model, proba, class_labels):
+    """機率欄位對齊到全域 class_labels（模型沒見過的類別為 0）。"""
     model_classes = getattr(model, "classes_", np.arange(proba.shape[1]))
-    # 對齊到全域 class_labels
-    dfp = pd.DataFrame(0.0, index=np.arange(len(X)),
-                       columns=[f"p_{int(c)}" for c in class_labels])
+    out = np.zeros((proba.shape[0], len(class_labels)), dtype=float)
     col_map = {int(c): j for j, c in enumerate(model_classes)}
-    for c in class_labels:
+    for i, c in enumerate(class_labels):
         j = col_map.get(int(c), None)
         if j is not None:
-            dfp[f"p_{int(c)}"] = proba[:, j]
-    dfp.insert(0, "model", model_name)
-    dfp.insert(1, "row_index", index_values)
-    if y_true is not None:
-        dfp.insert(2, "y_true", y_true)
-    if y_pred is not None:
-        dfp.insert(3, "y_pred", y_pred)
-    return dfp
-
-# ---- 1) SVC（補齊你評估用到 SVC 的訓練段）----
-svc = Class_Fit(clf = svm.LinearSVC)
-svc.grid_search(parameters = [{'C':np.logspace(-2,2,10)}], Kfold = 5)
-svc.grid_fit(X_train, Y_train)
-
-# ---- 2) 其他模型（與你一致）----
-lr = Class_Fit(clf = linear_model.LogisticRegression)
-lr.grid_search(parameters = [{'C':np.logspace(-2,2,20)}], Kfold = 5)
-lr.grid_fit(X_train, Y_train)
-
-knn = Class_Fit(clf = neighbors.KNeighborsClassifier)
-knn.grid_search(parameters = [{'n_neighbors': np.arange(1,50,1)}], Kfold = 5)
-knn.grid_fit(X_train, Y_train)
-
-tr = Class_Fit(clf = tree.DecisionTreeClassifier)
-tr.grid_search(parameters = [{'criterion' : ['entropy', 'gini'], 'max_features' :['sqrt', 'log2']}], Kfold = 5)
-tr.grid_fit(X_train, Y_train)
-
-rf = Class_Fit(clf = ensemble.RandomForestClassifier)
-param_grid = {'criterion' : ['entropy', 'gini'], 'n_estimators' : [20, 40, 60, 80, 100], 'max_features' :['sqrt', 'log2']}
-rf.grid_search(parameters = param_grid, Kfold = 5)
-rf.grid_fit(X_train, Y_train)
-
-ada = Class_Fit(clf = AdaBoostClassifier)
-param_grid = {'n_estimators' : [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]}
-ada.grid_search(parameters = param_grid, Kfold = 5)
-ada.grid_fit(X_train, Y_train)
-
-gb = Class_Fit(clf = ensemble.GradientBoostingClassifier)
-param_grid = {'n_estimators' : [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]}
-gb.grid_search(parameters = param_grid, Kfold = 5)
-gb.grid_fit(X_train, Y_train)
-
-# ---- Save best estimators（與你一致）----
-joblib.dump(rf.grid.best_estimator_, ARTIFACTS/'rf_best.pkl')
-joblib.dump(gb.grid.best_estimator_, ARTIFACTS/'gb_best.pkl')
-joblib.dump(knn.grid.best_estimator_, ARTIFACTS/'knn_best.pkl')
-joblib.dump(svc.grid.best_estimator_, ARTIFACTS/'svc_best.pkl')
-joblib.dump(tr.grid.best_estimator_, ARTIFACTS/'tr_best.pkl')
-joblib.dump(lr.grid.best_estimator_, ARTIFACTS/'lr_best.pkl')
-try:
-    joblib.dump(rf.grid.best_estimator_, OBJECTS/'rf_best.pkl')
-    joblib.dump(gb.grid.best_estimator_, OBJECTS/'gb_best.pkl')
-    joblib.dump(knn.grid.best_estimator_, OBJECTS/'knn_best.pkl')
-    joblib.dump(svc.grid.best_estimator_, OBJECTS/'svc_best.pkl')
-    joblib.dump(tr.grid.best_estimator_, OBJECTS/'tr_best.pkl')
-    joblib.dump(lr.grid.best_estimator_, OBJECTS/'lr_best.pkl')
-    # Remove duplicates from artifacts root if present
-    for _name in ['rf_best.pkl','gb_best.pkl','knn_best.pkl','svc_best.pkl','tr_best.pkl','lr_best.pkl']:
-        _p = ARTIFACTS / _name
+            out[:, i] = proba[:, j]
+    return out
+
+# ---- 已 fit 模型的投票與預測快取 ----
+def prefit_voting(named_estimators, y, voting='soft', weights=None):
+    """VotingClassifier 直接包住已訓練好的模型，不再 fit 一次。
+
+    補上 fit() 會設定的屬性（le_、classes_、estimators_、named_estimators_）；
+    soft voting 只用成員的 predict_proba 平均，成員用原始標籤訓練也沒關係
+    （欄位順序同樣是排序後的 classes）。
+    """
+    vote = VotingClassifier(estimators=named_estimators, voting=voting, weights=weights)
+    vote.le_ = LabelEncoder().fit(y)
+    vote.classes_ = vote.le_.classes_
+    vote.estimators_ = [est for _, est in named_estimators]
+    vote.named_estimators_ = Bunch(**dict(named_estimators))
+    return vote
+
+
+class PredictionCache(object):
+    """同一份 X 上，每個模型的 predict / predict_proba 只算一次（以物件本身為 key）。
+
+    soft voting 的機率直接由成員的快取平均而來，不再讓每個成員重算一次。
+    """
+
+    def __init__(self, X):
+        self.X = X
+        self._pred = {}
+        self._proba = {}
+
+    @staticmethod
+    def _is_soft_vote(est):
+        return isinstance(est, VotingClassifier) and est.voting == 'soft'
+
+    def proba(self, est):
+        key = id(est)
+        if key not in self._proba:
+            if self._is_soft_vote(est):
+                value = np.average([self.proba(m) for m in est.estimators_], axis=0, weights=est.weights)
+            else:
+                value = _safe_predict_proba(est, self.X)
+            self._proba[key] = (est, value)  # 保留 est 參照，避免 id 被重複使用
+        return self._proba[key][1]
+
+    def predict(self, est):
+        key = id(est)
+        if key not in self._pred:
+            if self._is_soft_vote(est):
+                value = est.le_.inverse_transform(np.argmax(self.proba(est), axis=1))
+            else:
+                value = est.predict(self.X)
+            self._pred[key] = (est, value)
+        return self._pred[key][1]
+
+# ---- 漂移閘門：分佈穩定時沿用上次訓練的模型 ----
+REFERENCE_MODELS = ('SVC', 'LR', 'KNN', 'DT', 'RF', 'ADA', 'GB')
+_PSI_BINS = 10
+
+
+def _psi(expected, actual, eps=1e-4):
+    """Population Stability Index；空的區間以 eps 代替，避免 log(0)。"""
+    expected = np.clip(np.asarray(expected, dtype=float), eps, None)
+    actual = np.clip(np.asarray(actual, dtype=float), eps, None)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def _bin_proportions(values, edges):
+    counts = np.bincount(np.searchsorted(edges, values, side="right"), minlength=len(edges) + 1)
+    return counts / max(1, len(values))
+
+
+def distribution_profile(X, y):
+    """訓練資料的摘要：各特徵的十分位切點與區間比例、標籤比例、各群的特徵平均。"""
+    features = {}
+    for col in X.columns:
+        values = X[col].to_numpy(dtype=float)
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, _PSI_BINS + 1)[1:-1]))
+        features[col] = {
+            "edges": edges.tolist(),
+            "proportions": _bin_proportions(values, edges).tolist(),
+            "std": float(values.std()),
+        }
+    labels = pd.Series(y).value_counts(normalize=True).sort_index()
+    class_means = X.groupby(np.asarray(y)).mean()
+    return {
+        "n_rows": int(len(X)),
+        "columns": list(X.columns),
+        "features": features,
+        "labels": {str(k): float(v) for k, v in labels.items()},
+        "class_means": {str(k): row.tolist() for k, row in class_means.iterrows()},
+    }
+
+
+def check_drift(X, y, reference_dir=REFERENCE_DIR):
+    """和上次訓練的分佈比較，回傳 retrain 與原因；任何一項超過門檻（或沒有參考）就重訓。"""
+    report = {"retrain": True, "reasons": [], "psi": {}, "class_shift": None}
+    ref_path = reference_dir / "reference.json"
+    try:
+        with open(ref_path, "r", encoding="utf-8") as f:
+            reference = json.load(f)
+    except (OSError, ValueError):
+        report["reasons"].append("no reference from a previous training")
+        return report
+    report["reference_trained_at"] = reference.get("trained_at")
+    manifest = model_bundle.load_manifest(reference_dir) or {}
+    missing = [n for n in REFERENCE_MODELS if n not in manifest.get("models", {})]
+    if missing:
+        report["reasons"].append(f"reference models missing: {', '.join(missing)}")
+    if manifest.get("sklearn_version") != sklearn.__version__:
+        report["reasons"].append(
+            f"sklearn version changed ({manifest.get('sklearn_version') or 'unknown'} -> {sklearn.__version__})"
+        )
+    if DRIFT_MAX_AGE_DAYS > 0 and time.time() - reference.get("trained_at", 0) > DRIFT_MAX_AGE_DAYS * 86400:
+        report["reasons"].append(f"reference older than {DRIFT_MAX_AGE_DAYS:g} days")
+    if reference.get("columns") != list(X.columns):
+        report["reasons"].append("feature columns changed")
+        return report
+
+    for col, ref in reference["features"].items():
+        current = _bin_proportions(X[col].to_numpy(dtype=float), np.asarray(ref["edges"]))
+        report["psi"][col] = round(_psi(ref["proportions"], current), 4)
+    current_labels = {str(k): float(v) for k, v in pd.Series(y).value_counts(normalize=True).items()}
+    if set(current_labels) != set(reference["labels"]):
+        report["reasons"].append("label set changed")
+    labels = sorted(set(current_labels) | set(reference["labels"]))
+    report["psi"]["label"] = round(_psi([reference["labels"].get(l, 0.0) for l in labels],
+                                        [current_labels.get(l, 0.0) for l in labels]), 4)
+    drifted = [k for k, v in report["psi"].items() if v >= DRIFT_PSI_THRESHOLD]
+    if drifted:
+        report["reasons"].append(f"PSI >= {DRIFT_PSI_THRESHOLD} for {', '.join(drifted)}")
+
+    # 群編號若被 Stage 4 重新排列，比例可能不變但各群平均會整個換位
+    stds = np.array([max(reference["features"][c]["std"], 1e-9) for c in X.columns])
+    current_means = X.groupby(np.asarray(y)).mean()
+    shifts = [
+        float(np.max(np.abs(row.to_numpy() - np.asarray(reference["class_means"][str(k)])) / stds))
+        for k, row in current_means.iterrows() if str(k) in reference["class_means"]
+    ]
+    if shifts:
+        report["class_shift"] = round(max(shifts), 4)
+        if report["class_shift"] >= DRIFT_CLASS_SHIFT:
+            report["reasons"].append(f"class means shifted by {report['class_shift']} std")
+    report["retrain"] = bool(report["reasons"])
+    return report
+
+
+def load_reference_models(trained_at, reference_dir=REFERENCE_DIR):
+    """上次訓練的模型；bundle 必須和 check_drift 讀到的 reference.json 是同一次訓練寫的。"""
+    bundle = model_bundle.load_bundle(reference_dir, mmap_mode=None)
+    if (bundle.manifest.get("metadata") or {}).get("trained_at") != trained_at:
+        raise ValueError("reference models do not match reference.json (replaced or left by an older version)")
+    return {name: bundle[name] for name in REFERENCE_MODELS}
+
+
+def save_reference(best, X, y, reference_dir=PENDING_REFERENCE_DIR):
+    """這次訓練的模型與分佈摘要；先寫到暫存資料夾再換上去，寫到一半失敗也不會留下不完整的參考。"""
+    tmp_dir = reference_dir.with_name(f".{reference_dir.name}.{os.getpid()}.tmp")
+    old_dir = reference_dir.with_name(f".{reference_dir.name}.{os.getpid()}.old")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    trained_at = time.time()
+    model_bundle.save_bundle(tmp_dir, {name: best[name] for name in REFERENCE_MODELS},
+                             features=list(X.columns), classes=np.sort(pd.Series(y).unique()),
+                             metadata={"trained_at": trained_at})
+    with open(tmp_dir / "reference.json", "w", encoding="utf-8") as f:
+        json.dump(dict(distribution_profile(X, y), trained_at=trained_at), f, ensure_ascii=False, indent=2)
+    if reference_dir.exists():
+        reference_dir.rename(old_dir)
+    tmp_dir.rename(reference_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+# ---- 0) 漂移閘門：分佈沒變就沿用上次的模型，直接評估 ----
+drift = check_drift(X_train, Y_train) if DRIFT_GATE else {"retrain": True, "reasons": ["STAGE5_DRIFT_GATE=0"]}
+if not drift["retrain"]:
+    # 參考檔損壞、版本不符或被別的工作換掉時，當作沒有參考、照常重訓
+    try:
+        best = load_reference_models(drift.get("reference_trained_at"))
+    except Exception as _e:
+        drift["retrain"] = True
+        drift["reasons"].append(f"reference models unreadable: {_e}")
+    else:
+        print(f"[Stage 5] No drift (PSI {drift['psi']}, class shift {drift['class_shift']}); reusing models from the last training")
+searches = {}
+if drift["retrain"]:
+    print(f"[Stage 5] Training all models: {'; '.join(drift['reasons'])}")
+    # ---- 1) SVC（補齊你評估用到 SVC 的訓練段）----
+    search_memory = load_search_memory()
+    svc = Class_Fit(clf = svm.LinearSVC)
+    svc.grid_search(parameters = [{'C':np.logspace(-2,2,10)}], Kfold = 5, memory = search_memory.get('SVC'))
+
+    # ---- 2) 其他模型（與你一致；樹模型固定 random_state，結果與排程順序無關）----
+    lr = Class_Fit(clf = linear_model.LogisticRegression)
+    lr.grid_search(parameters = [{'C':np.logspace(-2,2,20)}], Kfold = 5, memory = search_memory.get('LR'))
+
+    knn = Class_Fit(clf = neighbors.KNeighborsClassifier)
+    # 最佳 k 會隨樣本數變大，halving 在子樣本上挑 k 會偏小；KNN 的 fit 很便宜，所以一律搜完整網格
+    knn.grid_search(parameters = [{'n_neighbors': np.arange(1,50,1)}], Kfold = 5,
+                    strategy = "exhaustive" if SEARCH_STRATEGY == "halving" else None, memory = search_memory.get('KNN'))
+
+    tr = Class_Fit(clf = tree.DecisionTreeClassifier, params = {'random_state': 42})
+    tr.grid_search(parameters = [{'criterion' : ['entropy', 'gini'], 'max_features' :['sqrt', 'log2']}], Kfold = 5, memory = search_memory.get('DT'))
+
+    rf = Class_Fit(clf = ensemble.RandomForestClassifier, params = {'random_state': 42})
+    param_grid = {'criterion' : ['entropy', 'gini'], 'n_estimators' : [20, 40, 60, 80, 100], 'max_features' :['sqrt', 'log2']}
+    rf.grid_search(parameters = param_grid, Kfold = 5, memory = search_memory.get('RF'))
+
+    ada = Class_Fit(clf = AdaBoostClassifier, params = {'random_state': 42})
+    param_grid = {'n_estimators' : [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]}
+    ada.grid_search(parameters = param_grid, Kfold = 5, memory = search_memory.get('ADA'))
+
+    gb = Class_Fit(clf = ensemble.GradientBoostingClassifier, params = {'random_state': 42})
+    param_grid = {'n_estimators' : [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]}
+    gb.grid_search(parameters = param_grid, Kfold = 5, memory = search_memory.get('GB'))
+
+    # ---- 3) 全部模型的搜尋一起排進同一個 executor ----
+    searches = {'SVC': svc, 'LR': lr, 'KNN': knn, 'DT': tr, 'RF': rf, 'ADA': ada, 'GB': gb}
+    _narrowed = [f"{name} {fit.n_candidates}/{len(ParameterGrid(fit.full_parameters))}" for name, fit in searches.items() if fit.narrowed]
+    if _narrowed:
+        print(f"[Stage 5] Searching around previous optima: {', '.join(_narrowed)} candidates")
+    _wall = run_searches(searches, X_train, Y_train)
+    # 縮小的網格分數退步太多的模型，再搜一次完整網格
+    _retry = {name: fit for name, fit in searches.items() if fit.needs_full_grid()}
+    if _retry:
+        print(f"[Stage 5] CV score dropped beyond {SEARCH_MEMORY_TOLERANCE} for {', '.join(_retry)}; searching full grids")
+        for fit in _retry.values():
+            fit.widen()
+        _wall += run_searches(_retry, X_train, Y_train)
+    _work = sum(fit.search_sec + getattr(fit, "narrowed_search_sec", 0.0) for fit in searches.values())
+    print(f"[Stage 5] Hyperparameter search ({SEARCH_STRATEGY}) took {_wall:.1f}s wall, {_work:.1f}s of fits")
+
+    best = {name: fit.grid.best_estimator_ for name, fit in searches.items()}
+if DRIFT_GATE:
+    with open(ARTIFACTS/'stage5_drift.json', 'w', encoding='utf-8') as f:
+        json.dump(drift, f, indent=2, ensure_ascii=False)
+
+# ---- Voting classifier (rf+gb+knn, soft；直接用上面 refit 好的模型，不再重訓) ----
+votingC = prefit_voting(
+    [('rf', best['RF']),
+     ('gb', best['GB']),
+     ('knn', best['KNN'])],
+    Y_train,
+    voting='soft'
+)
+
+# ---- 投票模型蒸餾成單一棵多輸出樹（線上評分用；與投票結果一致率夠高才啟用）----
+distilled, distillation = None, None
+if distill.DISTILL_ENABLED:
+    try:
+        distilled, distillation = distill.distill(votingC, X_train, X_test)
+        print(f"[Stage 5] Distilled VOTE into a depth-{distillation['max_depth']} tree: "
+              f"fidelity {distillation['fidelity']:.4f}, {distillation['speedup']}x faster"
+              f"{'' if distillation['use_for_scoring'] else ' (below threshold, not used for scoring)'}")
+    except Exception as _e:
+        print(f"[Stage 5] Warning: distillation failed: {_e}")
+
+# ---- 所有模型存成一個 bundle（投票模型的成員只存一份）＋ manifest ----
+bundle_models = dict(best, VOTE=votingC)
+if distilled is not None:
+    bundle_models[distill.SURROGATE_NAME] = distilled
+model_bundle.save_bundle(
+    OBJECTS, bundle_models, features=columns, classes=np.sort(Y.unique()),
+    metadata={"distillation": distillation} if distillation else None,
+)
+# 舊版的逐模型 pickle 若還在就刪掉，避免之後讀到過期的模型
+for _name in model_bundle.LEGACY_FILES.values():
+    for _p in (ARTIFACTS / _name, OBJECTS / _name):
         try:
             if _p.exists():
                 _p.unlink()
         except Exception:
             pass
-except Exception as _e:
-    print(f"[Stage 5] Warning: failed to save best estimators to artifacts/objects/: {_e}")
-
-# ---- Voting classifier (rf+gb+knn, soft) ----
-votingC = VotingClassifier(
-    estimators=[('rf', rf.grid.best_estimator_),
-                ('gb', gb.grid.best_estimator_),
-                ('knn', knn.grid.best_estimator_)],
-    voting='soft'
-)
-votingC.fit(X_train, Y_train)
-joblib.dump(votingC, ARTIFACTS/'votingC.pkl')
-try:
-    joblib.dump(votingC, OBJECTS/'votingC.pkl')
-    # Remove duplicate from artifacts root if present
-    try:
-        _p = ARTIFACTS/'votingC.pkl'
-        if _p.exists():
-            _p.unlink()
-    except Exception:
-        pass
-except Exception as _e:
-    print(f"[Stage 5] Warning: failed to save votingC to artifacts/objects/: {_e}")
+print(f"[Stage 5] Saved model bundle to artifacts/objects/{model_bundle.BUNDLE_FILE}")
 
 # ---- Quick eval snapshot（accuracy 保留 0~1 浮點；與你一致）----
 # ...既存コード...
@@ -190,22 +903,42 @@ except Exception as _e:
 # ★【修正】results 辞書の形式を統一（accuracy と f1_weighted を含める）
 results = {}
 models_for_eval = [
-    ('SVC',  svc.grid.best_estimator_),
-    ('LR',   lr.grid.best_estimator_),
-    ('KNN',  knn.grid.best_estimator_),
-    ('DT',   tr.grid.best_estimator_),
-    ('RF',   rf.grid.best_estimator_),
-    ('ADA',  ada.grid.best_estimator_),
-    ('GB',   gb.grid.best_estimator_),
+    ('SVC',  best['SVC']),
+    ('LR',   best['LR']),
+    ('KNN',  best['KNN']),
+    ('DT',   best['DT']),
+    ('RF',   best['RF']),
+    ('ADA',  best['ADA']),
+    ('GB',   best['GB']),
     ('VOTE', votingC),
 ]
+if distilled is not None:
+    models_for_eval.append((distill.SURROGATE_NAME, distilled))
+test_predictions = PredictionCache(X_test)
 
 for name, est in models_for_eval:
-    pred = est.predict(X_test)
+    pred = test_predictions.predict(est)
     results[name] = {
         "accuracy": float(metrics.accuracy_score(Y_test, pred)),
         "f1_weighted": float(metrics.f1_score(Y_test, pred, average='weighted', zero_division=0))
     }
+    if name in searches:
+        results[name]["search"] = searches[name].search_summary()
+    elif name in best:
+        results[name]["search"] = {"strategy": "reused", "trained_at": drift.get("reference_trained_at")}
+    elif name == distill.SURROGATE_NAME:
+        results[name]["distillation"] = distillation
+
+if searches:
+    try:
+        save_search_memory(searches, {name: results[name]["accuracy"] for name in searches}, len(X_train))
+    except Exception as _e:
+        print(f"[Stage 5] Warning: failed to save the search memory: {_e}")
+    if DRIFT_GATE:
+        try:
+            save_reference(best, X_train, Y_train)
+        except Exception as _e:
+            print(f"[Stage 5] Warning: failed to save the drift reference: {_e}")
 
 # JSON 出力を確認可能に
 with open(ARTIFACTS/'stage5_eval.json','w', encoding='utf-8') as f:
@@ -215,21 +948,14 @@ print('[Stage 5] Saved evaluation results:', json.dumps(results, ensure_ascii=Fa
 
 # ---- 機率輸出（每個模型都輸出，且「含模型名稱」）----
 class_labels = np.sort(Y.unique())
-proba_frames = []
-for name, est in models_for_eval:
-    y_pred = est.predict(X_test)
-    dfp = proba_dataframe(
-        est, X_test, model_name=name,
-        class_labels=class_labels,
-        index_values=test_ids,  # 這裡放 CustomerID；也可改成 X_test.index
-        y_true=Y_test.values,
-        y_pred=y_pred
-    )
-    proba_frames.append(dfp)
-
-proba_out = pd.concat(proba_frames, axis=0, ignore_index=True)
-proba_out.to_csv(ARTIFACTS/'stage5_pred_proba.csv', index=False)
-print('[Stage 5] Saved per-sample probabilities to artifacts/stage5_pred_proba.csv')
+proba_models = [
+    (name, aligned_proba(est, test_predictions.proba(est), class_labels), test_predictions.predict(est))
+    for name, est in models_for_eval
+]
+# 每個模型一個 float32 機率矩陣，CustomerID（row_index）與 y_true 共用
+proba_store.write(ARTIFACTS, 'stage5', test_ids, class_labels, proba_models, y_true=Y_test.values,
+                  run_id=os.environ.get('RFM_RUN_ID'))
+print(f"[Stage 5] Saved per-sample probabilities to artifacts/{proba_store.STAGES['stage5']['file']}")
 
 
 try:
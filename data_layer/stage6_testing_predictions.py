@@ -4,11 +4,11 @@
 # 並輸出每筆樣本的機率（含模型名稱）
 # =============================
 
-import warnings, json
+import os, sys, warnings, json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 import joblib
 from sklearn import metrics
 
@@ -16,29 +16,20 @@ from sklearn import metrics
 warnings.filterwarnings("ignore")
 
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / "artifacts"
+if str(DATA_LAYER_DIR.parent) not in sys.path:  # 直接以子行程執行時也能 import data_layer
+    sys.path.insert(0, str(DATA_LAYER_DIR.parent))
+from data_layer import cpu_budget, feature_store, features, knn_index, model_bundle, proba_store  # noqa: E402
+
+ARTIFACTS = Path(os.environ.get("RFM_ARTIFACTS_DIR") or DATA_LAYER_DIR / "artifacts")
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 OBJECTS = ARTIFACTS / "objects"
 OBJECTS.mkdir(parents=True, exist_ok=True)
 
-# ---- 載入 Stage 4 產出的 test 資料 ----
-set_test = pd.read_csv(ARTIFACTS / "stage4_set_test.csv")
-
-# ---- 依使用者聚合，重建 test 期間的 transactions_per_user（含時間校正）----
-transactions_per_user = set_test.groupby(by=['CustomerID'])['Basket Price'].agg(['count', 'min', 'max', 'mean', 'sum'])
-for i in range(5):
-    col = f'categ_{i}'
-    transactions_per_user.loc[:, col] = (
-        set_test.groupby(by=['CustomerID'])[col].sum() / transactions_per_user['sum'] * 100
-    )
-transactions_per_user.reset_index(drop=False, inplace=True)
-
-# 時間範圍校正（與筆記一致）
-transactions_per_user['count'] = 5 * transactions_per_user['count']
-transactions_per_user['sum']   = transactions_per_user['count'] * transactions_per_user['mean']
+# ---- test 期間的 transactions_per_user（Stage 4 寫好的 feature store；購買次數已 ×5 對齊訓練期）----
+transactions_per_user = feature_store.load(ARTIFACTS, "test", run_id=os.environ.get("RFM_RUN_ID")).frame()
 
 # ---- 以 kmeans_clients 給 test 客戶貼 Y 標籤（跟 Section 4 同步）----
-list_cols = ['count','min','max','mean','categ_0','categ_1','categ_2','categ_3','categ_4']
+list_cols = features.LABEL_COLUMNS
 matrix_test = transactions_per_user[list_cols].values
 def _load_obj(name):
     path1 = OBJECTS / name
@@ -65,30 +56,28 @@ def _try_kmeans_y(mat):
 
 Y = _try_kmeans_y(matrix_test)
 if Y is None:
-    # fallback: use cluster mapping from set_test (Stage 4 saved this)
-    if 'cluster' in set_test.columns:
-        mapping = (
-            set_test.groupby('CustomerID')['cluster']
-            .agg(lambda x: x.mode().iloc[0] if not x.mode().empty else 7)
-            .to_dict()
-        )
-        Y = transactions_per_user['CustomerID'].map(mapping).fillna(7).astype(int).values
+    # fallback: 各客戶在 set_test 中最常見的 Stage 4 cluster（feature store 的 cluster 欄）
+    if 'cluster' in transactions_per_user.columns:
+        Y = transactions_per_user['cluster'].astype(int).values
     else:
         raise RuntimeError('Cannot determine Y: missing kmeans_clients and no cluster column in set_test')
 
 # ---- 分類器用的特徵（與 Section 5 一致）----
-feat_cols = ['mean', 'categ_0', 'categ_1', 'categ_2', 'categ_3', 'categ_4']
+feat_cols = features.FEATURE_COLUMNS
 X   = transactions_per_user[feat_cols].values
 ids = transactions_per_user['CustomerID'].values
 
-# ---- 載入已訓練的最佳模型 ----
-svc = _load_obj('svc_best.pkl')
-lr  = _load_obj('lr_best.pkl')
-knn = _load_obj('knn_best.pkl')
-tr  = _load_obj('tr_best.pkl')
-rf  = _load_obj('rf_best.pkl')
-gb  = _load_obj('gb_best.pkl')
-votingC = _load_obj('votingC.pkl')
+# ---- 載入已訓練的最佳模型（Stage 5 的 model bundle；舊 artifacts 退回逐模型 pickle）----
+_models = model_bundle.load_models([OBJECTS, ARTIFACTS], ['SVC', 'LR', 'KNN', 'DT', 'RF', 'GB', 'VOTE'])
+# KNN（單獨與 Voting 內的同一個）改用預建索引 + 鄰居快取，KNN 與 Voting 對同一批客戶只搜尋一次
+_models = knn_index.accelerate(_models)
+svc = _models['SVC']
+lr  = _models['LR']
+knn = _models['KNN']
+tr  = _models['DT']
+rf  = _models['RF']
+gb  = _models['GB']
+votingC = _models['VOTE']
 
 classifiers = [
     (svc, 'Support Vector Machine'),
@@ -122,69 +111,72 @@ def _safe_predict_proba(est, X):
 # 以 test 期的實際客群分佈定義統一的類別欄位順序
 classes_all = np.unique(Y)
 
-# ---- 評估 + 機率輸出（含模型名稱）----
-stage6_scores = {}
-proba_frames = []
-pred_rows = []
-
-for clf, label in classifiers:
-    pred = clf.predict(X)
-    acc = float(metrics.accuracy_score(Y, pred))
-    stage6_scores[label] = acc
-    print('_' * 30, f"\n{label}\nPrecision: {acc*100:.2f} %")
 
-    # 機率（補齊到 classes_all）
-    proba = _safe_predict_proba(clf, X)
-    model_classes = getattr(clf, 'classes_', np.unique(pred))
+def _align_proba(proba, model_classes):
+    """機率欄位補齊到 classes_all（模型沒見過的類別為 0）。"""
     col_map = {int(c): j for j, c in enumerate(model_classes)}
     proba_full = np.zeros((proba.shape[0], len(classes_all)), dtype=float)
     for idx_c, c in enumerate(classes_all):
         j = col_map.get(int(c), None)
         if j is not None:
             proba_full[:, idx_c] = proba[:, j]
+    return proba_full
+
+
+def _is_soft_vote(est):
+    return getattr(est, 'voting', None) == 'soft' and hasattr(est, 'estimators_') and hasattr(est, 'le_')
+
+
+def _evaluate(clf):
+    return clf.predict(X), _safe_predict_proba(clf, X)
+
+
+# ---- 評估：每個模型一個工作單位，送進 CPU 預算內的執行緒池 ----
+# predict / predict_proba 大多在 Cython（libsvm、樹走訪）或 BLAS 裡執行並釋放 GIL，
+# 執行緒共用同一份 X、模型與 KNN 鄰居快取，總時間約等於最慢的單一模型。
+# soft voting 不另外算：成員（與 RF/GB/KNN 是同一個物件時不重算）的機率直接平均。
+# pipeline 以 RFM_N_JOBS 傳入 CPU 預算；單獨執行時同樣由 cpu_budget 算出（不用 -1 之類的 joblib 慣例）
+N_JOBS = max(1, int(os.environ.get("RFM_N_JOBS") or cpu_budget.stage_plan("Stage 6")["processes"]))
+units = [clf for clf, _ in classifiers]
+if _is_soft_vote(votingC):
+    units += [m for m in votingC.estimators_ if all(m is not u for u in units)]
+else:
+    units.append(votingC)
+
+with ThreadPoolExecutor(max_workers=min(N_JOBS, len(units))) as pool:
+    futures = [(est, pool.submit(_evaluate, est)) for est in units]
+    results = [(est, future.result()) for est, future in futures]
+
+
+def _result(est):
+    return next(value for unit, value in results if unit is est)
+
+
+if _is_soft_vote(votingC):
+    proba_vote = np.average([_result(m)[1] for m in votingC.estimators_], axis=0, weights=votingC.weights)
+    results.append((votingC, (votingC.le_.inverse_transform(np.argmax(proba_vote, axis=1)), proba_vote)))
+
+# ---- 依原本的模型順序組回輸出（含模型名稱）----
+stage6_scores = {}
+proba_models = []
+
+for clf, label in classifiers + [(votingC, 'Voting (RF+GB+KNN)')]:
+    pred, proba = _result(clf)
+    acc = float(metrics.accuracy_score(Y, pred))
+    if clf is votingC:
+        print(f"Voting (RF+GB+KNN) Precision: {acc*100:.2f} %")
+        stage6_scores['Voting_RF_GB_KNN'] = acc
+    else:
+        print('_' * 30, f"\n{label}\nPrecision: {acc*100:.2f} %")
+        stage6_scores[label] = acc
 
-    dfp = pd.DataFrame(proba_full, columns=[f"p_{int(c)}" for c in classes_all])
-    dfp.insert(0, 'model', label)
-    dfp.insert(1, 'CustomerID', ids)
-    dfp.insert(2, 'y_true', Y)
-    dfp.insert(3, 'y_pred', pred)
-    proba_frames.append(dfp)
-
-    pred_rows.append(pd.DataFrame({
-        'model': label, 'CustomerID': ids, 'y_true': Y, 'y_pred': pred
-    }))
-
-# ---- Voting (RF+GB+KNN, soft) ----
-pred_vote = votingC.predict(X)
-vote_acc  = float(metrics.accuracy_score(Y, pred_vote))
-print(f"Voting (RF+GB+KNN) Precision: {vote_acc*100:.2f} %")
-stage6_scores['Voting_RF_GB_KNN'] = vote_acc
-
-proba_vote = _safe_predict_proba(votingC, X)
-model_classes = getattr(votingC, 'classes_', np.unique(pred_vote))
-col_map = {int(c): j for j, c in enumerate(model_classes)}
-proba_full = np.zeros((proba_vote.shape[0], len(classes_all)), dtype=float)
-for idx_c, c in enumerate(classes_all):
-    j = col_map.get(int(c), None)
-    if j is not None:
-        proba_full[:, idx_c] = proba_vote[:, j]
-
-dfp = pd.DataFrame(proba_full, columns=[f"p_{int(c)}" for c in classes_all])
-dfp.insert(0, 'model', 'Voting (RF+GB+KNN)')
-dfp.insert(1, 'CustomerID', ids)
-dfp.insert(2, 'y_true', Y)
-dfp.insert(3, 'y_pred', pred_vote)
-proba_frames.append(dfp)
-
-pred_rows.append(pd.DataFrame({
-    'model': 'Voting (RF+GB+KNN)', 'CustomerID': ids, 'y_true': Y, 'y_pred': pred_vote
-}))
+    proba_models.append((label, _align_proba(proba, getattr(clf, 'classes_', np.unique(pred))), pred))
 
 # ---- 存檔 ----
 with open(ARTIFACTS / 'stage6_eval.json', 'w', encoding='utf-8') as f:
     json.dump(stage6_scores, f, indent=2, ensure_ascii=False)
 
-pd.concat(proba_frames, ignore_index=True).to_csv(ARTIFACTS / 'stage6_pred_proba.csv', index=False)
-pd.concat(pred_rows,  ignore_index=True).to_csv(ARTIFACTS / 'stage6_predictions.csv', index=False)
+# 每個模型一個 float32 機率矩陣 + 預測，CustomerID / y_true 共用（取代 stage6_pred_proba.csv 與 stage6_predictions.csv）
+proba_store.write(ARTIFACTS, 'stage6', ids, classes_all, proba_models, y_true=Y, run_id=os.environ.get('RFM_RUN_ID'))
 
-print('[Stage 6] Saved: stage6_eval.json, stage6_pred_proba.csv, stage6_predictions.csv in artifacts/')
+print(f"[Stage 6] Saved: stage6_eval.json, {proba_store.STAGES['stage6']['file']} in artifacts/")
@@ -8,6 +8,8 @@
 # - 輸出特徵重要度（CSV）與摘要圖（PNG）到 artifacts/
 # =============================
 
+import os
+import sys
 import warnings
 from pathlib import Path
 import json
@@ -19,9 +21,12 @@ import joblib
 warnings.filterwarnings("ignore")
 
 DATA_LAYER_DIR = Path(__file__).resolve().parent
-ARTIFACTS = DATA_LAYER_DIR / 'artifacts'
+if str(DATA_LAYER_DIR.parent) not in sys.path:  # 直接以子行程執行時也能 import data_layer
+    sys.path.insert(0, str(DATA_LAYER_DIR.parent))
+from data_layer import feature_store, features, knn_index, model_bundle  # noqa: E402
+
+ARTIFACTS = Path(os.environ.get('RFM_ARTIFACTS_DIR') or DATA_LAYER_DIR / 'artifacts')
 OBJECTS = ARTIFACTS / 'objects'
-SET_TEST_PATH = ARTIFACTS / 'stage4_set_test.csv'
 ARTIFACTS.mkdir(parents=True, exist_ok=True)
 OBJECTS.mkdir(parents=True, exist_ok=True)
 
@@ -35,28 +40,10 @@ def _load_obj(name: str):
 
 
 def _rebuild_test_features():
-    """重建與 Stage 6 一致的測試特徵。"""
-    set_test = pd.read_csv(SET_TEST_PATH)
-
-    transactions_per_user = set_test.groupby(by=['CustomerID'])['Basket Price'].agg(
-        ['count', 'min', 'max', 'mean', 'sum']
-    )
-    for i in range(5):
-        col = f'categ_{i}'
-        transactions_per_user.loc[:, col] = (
-            set_test.groupby(by=['CustomerID'])[col].sum()
-            / transactions_per_user['sum'] * 100
-        )
-    transactions_per_user.reset_index(drop=False, inplace=True)
-
-    # 與 Stage 6 一致的小幅正規化／縮放處理
-    transactions_per_user['count'] = 5 * transactions_per_user['count']
-    transactions_per_user['sum'] = transactions_per_user['count'] * transactions_per_user['mean']
-
-    feat_cols = ['mean', 'categ_0', 'categ_1', 'categ_2', 'categ_3', 'categ_4']
-    X = transactions_per_user[feat_cols].values
-    ids = transactions_per_user['CustomerID'].values
-    return X, feat_cols, ids
+    """與 Stage 6 相同的測試特徵（讀 feature store，不再重新彙總 stage4_set_test.csv）。"""
+    store = feature_store.load(ARTIFACTS, 'test', run_id=os.environ.get('RFM_RUN_ID'))
+    feat_cols = list(features.FEATURE_COLUMNS)
+    return store.matrix(feat_cols), feat_cols, np.array(store.index), store
 
 
 def _pick_background(X: np.ndarray, max_bg: int = 200, seed: int = 42):
@@ -202,7 +189,7 @@ def main():
 
     # 準備特徵
     try:
-        X, feat_cols, ids = _rebuild_test_features()
+        X, feat_cols, ids, store = _rebuild_test_features()
     except Exception as e:
         print(f"[Stage 7] 重建測試特徵失敗：{e}")
         return
@@ -224,44 +211,22 @@ def main():
             return None
 
     try:
-        set_test = pd.read_csv(SET_TEST_PATH)
-        list_cols = ['count','min','max','mean','categ_0','categ_1','categ_2','categ_3','categ_4']
-        matrix_test = set_test.groupby(by=['CustomerID'])['Basket Price'].agg(
-            ['count', 'min', 'max', 'mean', 'sum']
-        )
-        for i in range(5):
-            col = f'categ_{i}'
-            matrix_test.loc[:, col] = (
-                set_test.groupby(by=['CustomerID'])[col].sum() / matrix_test['sum'] * 100
-            )
-        matrix_test['count'] = 5 * matrix_test['count']
-        matrix_test['sum'] = matrix_test['count'] * matrix_test['mean']
-        matrix_test = matrix_test[list_cols].values
-        y_true = _try_kmeans_y(matrix_test)
+        y_true = _try_kmeans_y(store.matrix(features.LABEL_COLUMNS))
     except Exception:
         # 何か問題あれば y_true は None のまま（後続は推定できるモデルがあれば継続）
         y_true = None
 
-    # 載入已訓練模型（優先選擇解釋較快者）
-    models = []
-    try:
-        models.append(('Random_Forest', _load_obj('rf_best.pkl')))
-    except Exception:
-        pass
-    try:
-        models.append(('Gradient_Boosting', _load_obj('gb_best.pkl')))
-    except Exception:
-        pass
-    # 線性／羅吉斯（LinearExplainer）
+    # 載入已訓練模型（優先選擇解釋較快者；線性／羅吉斯用 LinearExplainer，Voting 可能較耗時）
+    wanted = [('RF', 'Random_Forest'), ('GB', 'Gradient_Boosting'),
+              ('LR', 'Logistic_Regression'), ('VOTE', 'Voting_RF_GB_KNN')]
     try:
-        models.append(('Logistic_Regression', _load_obj('lr_best.pkl')))
-    except Exception:
-        pass
-    # Voting 可能較耗時；視需要包含
-    try:
-        models.append(('Voting_RF_GB_KNN', _load_obj('votingC.pkl')))
-    except Exception:
-        pass
+        loaded = model_bundle.load_models([OBJECTS, ARTIFACTS], [key for key, _ in wanted])
+        # Voting 以 KernelExplainer 解釋，每位客戶要評分上萬列合成樣本；其中的 KNN 改走索引搜尋
+        loaded = knn_index.accelerate(loaded)
+    except Exception as e:
+        print(f"[Stage 7] 載入模型失敗：{e}")
+        loaded = {}
+    models = [(name, loaded[key]) for key, name in wanted if key in loaded]
 
     if not models:
         print("[Stage 7] 找不到可解釋的模型，請先完成 Stage 5。")
@@ -0,0 +1,545 @@
+from __future__ import annotations
+
+import atexit
+import contextlib
+import gc
+import io
+import os
+import queue
+import runpy
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import multiprocessing as mp
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+DATA_LAYER_DIR = Path(__file__).resolve().parent
+REPO_ROOT = DATA_LAYER_DIR.parent
+
+# Set STAGE_WORKER_ENABLED=0 to fall back to one fresh interpreter per stage
+STAGE_WORKER_ENABLED = os.environ.get("STAGE_WORKER_ENABLED", "1") != "0"
+STAGE_WORKER_POOL_SIZE = max(
+    1, int(os.environ.get("STAGE_WORKER_POOL_SIZE", os.environ.get("PIPELINE_MAX_CONCURRENT", "1")))
+)
+# Recycle a worker after this many stage tasks or once its resident memory exceeds the limit
+STAGE_WORKER_MAX_TASKS = int(os.environ.get("STAGE_WORKER_MAX_TASKS", "20"))
+STAGE_WORKER_MAX_RSS_MB = float(os.environ.get("STAGE_WORKER_MAX_RSS_MB", "2048"))
+STAGE_WORKER_START_TIMEOUT_SEC = float(os.environ.get("STAGE_WORKER_START_TIMEOUT_SEC", "300"))
+# Longer lines (e.g. progress bars without newlines) are split into chunks of this size
+STAGE_OUTPUT_MAX_LINE_CHARS = 8192
+
+# How often a running stage checks its cancel flag and deadline
+_POLL_INTERVAL_SEC = 0.2
+# Time given to a stopped stage to exit after SIGTERM before it is killed
+STAGE_KILL_GRACE_SEC = 5.0
+
+# on_output(stream_name, line) with stream_name "stdout" or "stderr"
+OutputCallback = Callable[[str, str], None]
+
+
+def kill_process_tree(
+    pid: int, *, wait: Optional[Callable[[float], object]] = None, grace_sec: float = STAGE_KILL_GRACE_SEC
+) -> None:
+    """Terminate ``pid`` and everything it started (joblib/loky workers), escalating to SIGKILL.
+
+    ``wait(timeout)`` should block until ``pid`` itself has exited (and reap it).
+    Without psutil the whole process group is signalled; stage processes run in
+    their own session on POSIX, so their group id is their pid.
+    """
+    if os.name != "posix":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)], capture_output=True)  # noqa: PLW1510
+        return
+
+    try:
+        import psutil  # type: ignore
+    except ImportError:
+        psutil = None
+
+    descendants = []
+    if psutil is not None:
+        try:
+            descendants = psutil.Process(pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            pass
+
+    def send(sig) -> None:
+        if psutil is None:
+            try:
+                os.killpg(pid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+            return
+        for target in [pid] + [proc.pid for proc in descendants]:
+            try:
+                os.kill(target, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+    send(signal.SIGTERM)
+    if wait is not None:
+        try:
+            wait(grace_sec)
+        except Exception:
+            pass
+    if descendants:
+        psutil.wait_procs(descendants, timeout=grace_sec)
+    send(signal.SIGKILL)
+
+
+def _stop_reason(cancel_event: Optional[threading.Event], deadline: Optional[float]) -> Optional[str]:
+    if cancel_event is not None and cancel_event.is_set():
+        return "cancelled"
+    if deadline is not None and time.monotonic() >= deadline:
+        return "timeout"
+    return None
+
+# Heavy imports paid once per worker instead of once per stage
+PRELOAD_MODULES = (
+    "numpy",
+    "pandas",
+    "joblib",
+    "sklearn.cluster",
+    "sklearn.ensemble",
+    "sklearn.linear_model",
+    "sklearn.metrics",
+    "sklearn.model_selection",
+    "sklearn.neighbors",
+    "sklearn.preprocessing",
+    "sklearn.svm",
+    "sklearn.tree",
+    "nltk",
+    "matplotlib.pyplot",
+    "shap",
+)
+
+
+def _current_rss_mb() -> Optional[float]:
+    """Resident memory of this process in MB (psutil when installed, /proc or getrusage otherwise)."""
+    try:
+        import psutil  # type: ignore
+
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except Exception:
+        pass
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)
+    except Exception:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Worker process side
+# ---------------------------------------------------------------------------
+def _preload() -> Dict[str, str]:
+    import matplotlib
+
+    matplotlib.use("Agg")  # headless, must happen before pyplot is imported
+    failed = {}
+    for name in PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except Exception as e:  # optional parts of the stack may be missing
+            failed[name] = str(e)
+    return failed
+
+
+class _OutputForwarder:
+    """Route this worker's fd 1/2 through pipes and forward each line to the parent.
+
+    Redirecting at the file-descriptor level also captures output of C extensions
+    and of joblib/loky child processes (e.g. GridSearchCV ``verbose`` lines),
+    which inherit the descriptors. Lines written between tasks go to the
+    original console instead.
+    """
+
+    _END_MARKER = "\x00rfm-task-end\x00"
+
+    def __init__(self, send):
+        self._send = send
+        self.active = False
+        self._console: Dict[str, int] = {}
+        self._drained: Dict[str, threading.Event] = {}
+
+    def install(self) -> None:
+        for name, fd in (("stdout", 1), ("stderr", 2)):
+            self._console[name] = os.dup(fd)
+            read_fd, write_fd = os.pipe()
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+            self._drained[name] = threading.Event()
+            threading.Thread(target=self._pump, args=(name, read_fd), name=f"rfm-{name}-pump", daemon=True).start()
+        sys.stdout = io.TextIOWrapper(io.FileIO(1, "w", closefd=False), encoding="utf-8", errors="replace", line_buffering=True)
+        sys.stderr = io.TextIOWrapper(io.FileIO(2, "w", closefd=False), encoding="utf-8", errors="replace", line_buffering=True)
+
+    def _pump(self, name: str, read_fd: int) -> None:
+        with io.open(read_fd, "r", encoding="utf-8", errors="replace") as pipe:
+            for line in iter(lambda: pipe.readline(STAGE_OUTPUT_MAX_LINE_CHARS), ""):
+                drained = self._END_MARKER in line
+                if drained:
+                    line = line.replace(self._END_MARKER, "")
+                text = line.rstrip("\n")
+                if text or not drained:
+                    if self.active:
+                        self._send(("line", name, text))
+                    else:
+                        os.write(self._console[name], line.encode("utf-8", "replace"))
+                if drained:
+                    self._drained[name].set()
+
+    def begin(self) -> None:
+        self.active = True
+
+    def end(self) -> None:
+        """Wait until everything the task wrote has been forwarded, then stop forwarding."""
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        for name, fd in (("stdout", 1), ("stderr", 2)):
+            self._drained[name].clear()
+            os.write(fd, (self._END_MARKER + "\n").encode("utf-8"))
+        for event in self._drained.values():
+            event.wait(timeout=5)
+        self.active = False
+
+
+def _thread_limits(threads: Optional[str]):
+    """Cap BLAS/OpenMP pools already loaded in this process (OMP_NUM_THREADS only applies at import)."""
+    if not threads:
+        return contextlib.nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return contextlib.nullcontext()
+    return threadpool_limits(limits=int(threads))
+
+
+def _run_task(task: Dict, forwarder: _OutputForwarder) -> Dict:
+    """Execute one stage script as ``__main__`` inside this (warm) interpreter."""
+    script = task["script"]
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_argv = sys.argv
+    returncode = 0
+    forwarder.begin()
+    try:
+        os.environ.update(task.get("env") or {})
+        os.chdir(task.get("cwd") or DATA_LAYER_DIR)
+        sys.argv = [script]
+        try:
+            with _thread_limits(os.environ.get("RFM_THREADS")):
+                runpy.run_path(script, run_name="__main__")
+        except SystemExit as exc:
+            code = exc.code
+            returncode = code if isinstance(code, int) else (0 if code is None else 1)
+            if code is not None and not isinstance(code, int):
+                print(code, file=sys.stderr)
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc(file=sys.stderr)
+            returncode = 1
+    finally:
+        forwarder.end()
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        try:
+            import matplotlib.pyplot as plt
+
+            plt.close("all")
+        except Exception:
+            pass
+        gc.collect()
+    return {"returncode": returncode, "rss_mb": _current_rss_mb()}
+
+
+def _worker_main(conn) -> None:
+    # The parent marks us daemonic so we die with the server, but joblib/loky refuse to
+    # start their own workers (GridSearchCV n_jobs) from a daemonic process.
+    mp.current_process().daemon = False
+    if hasattr(os, "setsid"):
+        os.setsid()  # own process group, so a cancelled stage can be killed together with its children
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+    send_lock = threading.Lock()
+
+    def send(message) -> None:
+        with send_lock:
+            conn.send(message)
+
+    forwarder = _OutputForwarder(send)
+    forwarder.install()
+    started = time.perf_counter()
+    failed = _preload()
+    send(("ready", {"preload_sec": round(time.perf_counter() - started, 3), "preload_failed": failed}))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        send(("done", _run_task(task, forwarder)))
+
+
+def run_script_subprocess(
+    script_path: Path,
+    *,
+    env: Optional[Dict[str, str]] = None,
+    cwd: Optional[Path] = None,
+    on_output: Optional[OutputCallback] = None,
+    cancel_event: Optional[threading.Event] = None,
+    timeout_sec: Optional[float] = None,
+    on_start: Optional[Callable[[int], None]] = None,
+) -> Dict:
+    """Run ``script_path`` in a fresh interpreter, handing each output line to ``on_output`` as it arrives.
+
+    The process tree is killed when ``cancel_event`` is set or ``timeout_sec``
+    elapses; ``stopped`` in the result is then ``"cancelled"`` or ``"timeout"``.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, str(script_path)],
+        cwd=str(cwd or DATA_LAYER_DIR),
+        env={**os.environ, **(env or {}), "PYTHONUNBUFFERED": "1"},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        start_new_session=os.name == "posix",
+    )
+    if on_start is not None:
+        on_start(proc.pid)
+
+    def pump(name: str, pipe) -> None:
+        with pipe:
+            for line in iter(lambda: pipe.readline(STAGE_OUTPUT_MAX_LINE_CHARS), ""):
+                if on_output is not None:
+                    on_output(name, line.rstrip("\n"))
+
+    readers = [
+        threading.Thread(target=pump, args=("stdout", proc.stdout), daemon=True),
+        threading.Thread(target=pump, args=("stderr", proc.stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    deadline = time.monotonic() + timeout_sec if timeout_sec else None
+    stopped = None
+    while True:
+        try:
+            returncode = proc.wait(timeout=_POLL_INTERVAL_SEC)
+            break
+        except subprocess.TimeoutExpired:
+            stopped = _stop_reason(cancel_event, deadline)
+            if stopped is not None:
+                kill_process_tree(proc.pid, wait=lambda t: proc.wait(timeout=t))
+                returncode = proc.wait()
+                break
+    for reader in readers:
+        reader.join(timeout=STAGE_KILL_GRACE_SEC)
+    return {"returncode": returncode, "stopped": stopped}
+
+
+# ---------------------------------------------------------------------------
+# Parent (pipeline) side
+# ---------------------------------------------------------------------------
+class StageWorkerUnavailable(RuntimeError):
+    """The worker could not be started; callers fall back to a plain subprocess."""
+
+
+class StageWorker:
+    """One warm interpreter that runs stage scripts sent over a pipe.
+
+    A crash only takes down the worker: the running stage is reported as failed
+    and a fresh worker is spawned for the next task.
+    """
+
+    def __init__(self, *, max_tasks: int = STAGE_WORKER_MAX_TASKS, max_rss_mb: float = STAGE_WORKER_MAX_RSS_MB):
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.process = None
+        self.conn = None
+        self.tasks_done = 0
+        self.preload_sec: Optional[float] = None
+        self._ready = False
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self) -> None:
+        if self.alive:
+            return
+        ctx = mp.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), name="rfm-stage-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.tasks_done = 0
+        self._ready = False
+
+    def _wait_ready(self) -> None:
+        if self._ready:
+            return
+        try:
+            if not self.conn.poll(STAGE_WORKER_START_TIMEOUT_SEC):
+                raise StageWorkerUnavailable("stage worker did not finish preloading in time")
+            _, info = self.conn.recv()
+        except (EOFError, OSError) as exc:
+            self.stop()
+            raise StageWorkerUnavailable(f"stage worker exited during startup: {exc!r}") from exc
+        except StageWorkerUnavailable:
+            self.stop()
+            raise
+        self.preload_sec = info.get("preload_sec")
+        for name, reason in (info.get("preload_failed") or {}).items():
+            print(f"Warning: stage worker could not preload {name}: {reason}")
+        self._ready = True
+
+    def stop(self) -> None:
+        if self.conn is not None:
+            try:
+                if self.alive:
+                    self.conn.send(None)
+            except Exception:
+                pass
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(timeout=5)
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+        self._ready = False
+
+    def run(
+        self,
+        script_path: Path,
+        *,
+        env: Optional[Dict[str, str]] = None,
+        cwd: Optional[Path] = None,
+        on_output: Optional[OutputCallback] = None,
+        cancel_event: Optional[threading.Event] = None,
+        timeout_sec: Optional[float] = None,
+        on_start: Optional[Callable[[int], None]] = None,
+    ) -> Dict:
+        """Run ``script_path`` as ``__main__``; raises StageWorkerUnavailable if no worker can start.
+
+        ``on_start(pid)`` is called with the worker pid before the script starts
+        and output lines are passed to ``on_output`` while it runs. On cancel
+        or timeout the worker and its children are killed (a fresh worker is
+        spawned for the next task) and ``stopped`` names the reason.
+        """
+        self.start()
+        self._wait_ready()
+        task = {"script": str(script_path), "env": env or {}, "cwd": str(cwd or DATA_LAYER_DIR)}
+        deadline = time.monotonic() + timeout_sec if timeout_sec else None
+        if on_start is not None:
+            on_start(self.process.pid)
+        try:
+            self.conn.send(task)
+            while True:
+                if not self.conn.poll(_POLL_INTERVAL_SEC):
+                    stopped = _stop_reason(cancel_event, deadline)
+                    if stopped is not None:
+                        kill_process_tree(self.process.pid, wait=self.process.join)
+                        self.stop()
+                        return {"returncode": -int(signal.SIGTERM), "stopped": stopped}
+                    continue
+                message = self.conn.recv()
+                if message[0] == "line":
+                    if on_output is not None:
+                        on_output(message[1], message[2])
+                    continue
+                outcome = message[1]
+                break
+        except (EOFError, OSError):
+            exitcode = self.process.exitcode if self.process is not None else None
+            self.stop()
+            if on_output is not None:
+                on_output("stderr", f"stage worker exited unexpectedly (exit code {exitcode})")
+            return {"returncode": exitcode if exitcode not in (None, 0) else -1, "stopped": None}
+
+        self.tasks_done += 1
+        outcome["stopped"] = None
+        rss = outcome.pop("rss_mb", None)
+        if self.tasks_done >= self.max_tasks > 0 or (rss is not None and self.max_rss_mb > 0 and rss > self.max_rss_mb):
+            self.stop()
+        return outcome
+
+
+class StageWorkerPool:
+    """Fixed set of warm workers shared by concurrently running pipelines."""
+
+    def __init__(self, size: int = STAGE_WORKER_POOL_SIZE):
+        self.size = max(1, size)
+        self._idle: "queue.Queue[StageWorker]" = queue.Queue()
+        self._all: List[StageWorker] = []
+        for _ in range(self.size):
+            worker = StageWorker()
+            self._all.append(worker)
+            self._idle.put(worker)
+
+    def warm(self) -> None:
+        """Spawn every worker now so the first upload does not pay the import cost."""
+        for worker in self._all:
+            worker.start()
+
+    def run(
+        self,
+        script_path: Path,
+        *,
+        env: Optional[Dict[str, str]] = None,
+        cwd: Optional[Path] = None,
+        on_output: Optional[OutputCallback] = None,
+        cancel_event: Optional[threading.Event] = None,
+        timeout_sec: Optional[float] = None,
+        on_start: Optional[Callable[[int], None]] = None,
+    ) -> Dict:
+        worker = self._idle.get()
+        try:
+            return worker.run(
+                script_path,
+                env=env,
+                cwd=cwd,
+                on_output=on_output,
+                cancel_event=cancel_event,
+                timeout_sec=timeout_sec,
+                on_start=on_start,
+            )
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self) -> None:
+        for worker in self._all:
+            worker.stop()
+
+
+_POOL: Optional[StageWorkerPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_stage_worker_pool() -> StageWorkerPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = StageWorkerPool()
+            atexit.register(_POOL.shutdown)
+        return _POOL
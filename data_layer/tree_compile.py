@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+import warnings
+import weakref
+from typing import List, Optional
+
+import numpy as np
+
+# 關掉後一律走 scikit-learn 的 predict_proba
+COMPILED_TREES = os.environ.get("RFM_COMPILED_TREES", "1").strip().lower() not in ("0", "false", "no")
+# 每次遍歷的（列數 × 樹數）上限；大批次切塊，暫存陣列大小固定
+CHUNK_CELLS = max(1024, int(os.environ.get("RFM_COMPILED_TREES_CHUNK", str(1 << 20))))
+# 編譯後以這麼多列探測資料比對 scikit-learn 的輸出，不完全相同就不使用
+VERIFY_ROWS = 512
+# 超過這個列數改用 scikit-learn 原本的預測（-1 = 每個模型編譯時量測交叉點）
+MAX_ROWS = int(os.environ.get("RFM_COMPILED_TREES_MAX_ROWS", "-1"))
+CALIBRATION_ROWS = (64, 1024)
+
+_LEAF = -1  # sklearn.tree._tree.TREE_LEAF
+
+# 以模型本身為弱參照 key：被新 bundle 取代的 RF/GB 釋放時，攤平的節點陣列一起釋放
+_CACHE: "weakref.WeakKeyDictionary[object, Optional[CompiledTrees]]" = weakref.WeakKeyDictionary()
+_CACHE_LOCK = threading.Lock()
+
+
+class CompiledTrees(object):
+    """The nodes of many fitted trees flattened into contiguous arrays.
+
+    ``child[2 * node + go_right]`` is the next node; a leaf points to itself
+    (threshold +inf), so every row advances one level per step for all trees at
+    once and simply stays put once it reached its leaf. Comparisons use the
+    float32 features against float64 thresholds, exactly as scikit-learn does.
+
+    The NumPy traversal wins while scikit-learn's fixed per-tree cost dominates;
+    batches above ``max_rows`` go to the original estimator (its Cython
+    traversal is faster per row), so the output is identical either way.
+    """
+
+    def __init__(self, estimator, trees: List, n_features: int):
+        self._estimator = weakref.ref(estimator)  # 不延長模型的生命週期（快取以它為弱參照 key）
+        self.classes_ = estimator.classes_
+        self.n_features_in_ = n_features
+        self.source = type(estimator).__name__
+        sizes = [t.node_count for t in trees]
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        n_nodes = int(offsets[-1])
+        index = np.int32 if 2 * n_nodes < np.iinfo(np.int32).max else np.int64
+        self.n_features = n_features
+        self.n_trees = len(trees)
+        self.roots = offsets[:-1].astype(index)
+        self.depth = max(t.max_depth for t in trees)
+        self.feature = np.zeros(n_nodes, dtype=index)
+        self.threshold = np.full(n_nodes, np.inf, dtype=np.float64)
+        self.child = np.empty(2 * n_nodes, dtype=index)
+        for t, start in zip(trees, offsets[:-1]):
+            stop = start + t.node_count
+            nodes = np.arange(start, stop)
+            leaf = t.children_left == _LEAF
+            self.feature[start:stop] = np.where(leaf, 0, t.feature)
+            self.threshold[start:stop] = np.where(leaf, np.inf, t.threshold)
+            self.child[2 * start:2 * stop:2] = np.where(leaf, nodes, t.children_left + start)
+            self.child[2 * start + 1:2 * stop:2] = np.where(leaf, nodes, t.children_right + start)
+        self.is_leaf = self.child[0::2] == np.arange(n_nodes)
+        # value[:, 0, :]（單一輸出）
+        self.value = np.concatenate([t.value[:, 0, :] for t in trees], axis=0)
+        self.max_rows: Optional[int] = None
+
+    @property
+    def estimator(self):
+        estimator = self._estimator()
+        if estimator is None:
+            raise ReferenceError(f"the {self.source} this predictor was compiled from has been released")
+        return estimator
+
+    def _chunk_rows(self) -> int:
+        return max(1, CHUNK_CELLS // max(1, self.n_trees))
+
+    def apply(self, X32: np.ndarray) -> np.ndarray:
+        """Global leaf index, shape (n_trees, n_rows); ``X32`` is C-contiguous float32."""
+        n = X32.shape[0]
+        index = self.child.dtype
+        XT = np.ascontiguousarray(X32.T).ravel()  # 特徵為主：XT[f * n + row]
+        idx = np.repeat(self.roots[:, None], n, axis=1)
+        rows = np.arange(n, dtype=index)[None, :]
+        feat = np.empty_like(idx)
+        thr = np.empty(idx.shape, dtype=np.float64)
+        x = np.empty(idx.shape, dtype=np.float32)
+        go_right = np.empty(idx.shape, dtype=bool)
+        for _ in range(self.depth):
+            np.take(self.feature, idx, out=feat)
+            feat *= n
+            feat += rows
+            np.take(XT, feat, out=x)
+            np.take(self.threshold, idx, out=thr)
+            np.greater(x, thr, out=go_right)
+            idx *= 2
+            idx += go_right
+            np.take(self.child, idx, out=idx)
+        return idx
+
+    def _rows(self, X) -> np.ndarray:
+        X32 = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+        if X32.ndim != 2 or X32.shape[1] != self.n_features:
+            raise ValueError(f"X has {X32.shape[-1]} features, expected {self.n_features}")
+        return X32
+
+    def _use_estimator(self, X) -> bool:
+        return self.max_rows is not None and len(X) > self.max_rows
+
+    def predict_proba(self, X) -> np.ndarray:
+        if self._use_estimator(X):
+            return self.estimator.predict_proba(X)
+        return self._predict_proba(self._rows(X))
+
+    def predict(self, X) -> np.ndarray:
+        if self._use_estimator(X):
+            return self.estimator.predict(X)
+        return self._predict(self._rows(X))
+
+    def calibrate(self, X: np.ndarray, sizes=CALIBRATION_ROWS, repeat: int = 3) -> Optional[int]:
+        """Set ``max_rows`` where the fitted cost lines (fixed + per-row) of both paths cross."""
+        costs = []
+        for n in sizes:
+            Xn = np.ascontiguousarray(np.resize(X, (n, X.shape[1])))
+            best = []
+            for fn in (self.estimator.predict_proba, self._predict_proba):
+                fn(Xn)
+                timings = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    fn(Xn)
+                    timings.append(time.perf_counter() - started)
+                best.append(min(timings))
+            costs.append(best)
+        (small_est, small_np), (large_est, large_np) = costs
+        n0, n1 = sizes
+        slope_est = (large_est - small_est) / (n1 - n0)
+        slope_np = (large_np - small_np) / (n1 - n0)
+        fixed_est = small_est - slope_est * n0
+        fixed_np = small_np - slope_np * n0
+        if fixed_np >= fixed_est:
+            self.max_rows = 0
+        elif slope_np <= slope_est:
+            self.max_rows = None  # NumPy 走訪在任何批次都不慢
+        else:
+            self.max_rows = int((fixed_est - fixed_np) / (slope_np - slope_est))
+        return self.max_rows
+
+
+class CompiledForest(CompiledTrees):
+    """``RandomForestClassifier.predict_proba``: leaf class fractions summed tree by tree, divided by the tree count."""
+
+    def __init__(self, forest):
+        super().__init__(forest, [e.tree_ for e in forest.estimators_], forest.n_features_in_)
+        self.value = np.ascontiguousarray(self.value[:, : len(forest.classes_)])
+
+    def _predict_proba(self, X32: np.ndarray) -> np.ndarray:
+        out = np.zeros((X32.shape[0], self.value.shape[1]), dtype=np.float64)
+        chunk = self._chunk_rows()
+        buf = np.empty((min(chunk, X32.shape[0]), self.value.shape[1]), dtype=np.float64)
+        for start in range(0, X32.shape[0], chunk):
+            leaves = self.apply(X32[start:start + chunk])
+            acc = out[start:start + chunk]
+            b = buf[: leaves.shape[1]]
+            for t in range(self.n_trees):  # 與 scikit-learn 相同的累加順序
+                np.take(self.value, leaves[t], axis=0, out=b)
+                acc += b
+        out /= self.n_trees
+        return out
+
+    def _predict(self, X32: np.ndarray) -> np.ndarray:
+        return self.classes_.take(np.argmax(self._predict_proba(X32), axis=1), axis=0)
+
+
+class CompiledGradientBoosting(CompiledTrees):
+    """``GradientBoostingClassifier``: prior raw score plus ``learning_rate × leaf value`` stage by stage, then the loss link."""
+
+    def __init__(self, gb):
+        stages, self.k = gb.estimators_.shape
+        super().__init__(gb, [e.tree_ for e in gb.estimators_.ravel()], gb.n_features_in_)
+        self.n_stages = stages
+        self.learning_rate = gb.learning_rate
+        self.loss = gb._loss
+        self.value = np.ascontiguousarray(self.value[:, 0])
+        # DummyClassifier（prior）或 "zero" 的初始分數對每一列都相同
+        self.init_raw = np.asarray(gb._raw_predict_init(np.zeros((1, self.n_features), dtype=np.float32)))[0]
+
+    def _decision_function(self, X32: np.ndarray) -> np.ndarray:
+        raw = np.empty((X32.shape[0], self.k), dtype=np.float64)
+        raw[:] = self.init_raw
+        chunk = self._chunk_rows()
+        for start in range(0, X32.shape[0], chunk):
+            leaves = self.apply(X32[start:start + chunk])
+            acc = raw[start:start + chunk]
+            for i in range(self.n_stages):  # 與 predict_stages 相同：先乘 learning_rate 再逐階段累加
+                acc += (self.learning_rate * self.value.take(leaves[i * self.k:(i + 1) * self.k])).T
+        return raw.ravel() if self.k == 1 else raw
+
+    def _predict_proba(self, X32: np.ndarray) -> np.ndarray:
+        return self.loss.predict_proba(self._decision_function(X32))
+
+    def _predict(self, X32: np.ndarray) -> np.ndarray:
+        raw = self._decision_function(X32)
+        encoded = (raw >= 0).astype(int) if raw.ndim == 1 else np.argmax(raw, axis=1)
+        return self.classes_[encoded]
+
+
+def _probe_rows(compiled: CompiledTrees, n: int, seed: int = 0) -> np.ndarray:
+    """Rows mixing random values and exact split thresholds (the ``<=`` edge) of every feature."""
+    rng = np.random.default_rng(seed)
+    X = np.empty((n, compiled.n_features), dtype=np.float32)
+    internal = ~compiled.is_leaf
+    for f in range(compiled.n_features):
+        thr = compiled.threshold[internal & (compiled.feature == f)]
+        if not len(thr):
+            X[:, f] = rng.normal(size=n)
+            continue
+        lo, hi = thr.min(), thr.max()
+        span = max(hi - lo, 1.0)
+        values = rng.uniform(lo - 0.1 * span, hi + 0.1 * span, size=n)
+        exact = rng.random(n) < 0.5
+        values[exact] = rng.choice(thr, size=int(exact.sum()))
+        X[:, f] = values
+    return X
+
+
+def compile_estimator(est, verify: bool = True, max_rows: int = MAX_ROWS) -> Optional[CompiledTrees]:
+    """Compiled predictor for a fitted RandomForest/GradientBoosting classifier, or None when not applicable.
+
+    With ``verify`` the result must match ``est.predict_proba`` bit for bit on
+    probe rows, otherwise None is returned and callers keep the original model.
+    ``max_rows < 0`` measures the batch size above which ``est`` itself is used.
+    """
+    from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+
+    try:
+        if isinstance(est, RandomForestClassifier) and np.ndim(est.classes_) == 1:
+            compiled = CompiledForest(est)
+        elif isinstance(est, GradientBoostingClassifier) and (est.init_ == "zero" or type(est.init_).__name__ == "DummyClassifier"):
+            compiled = CompiledGradientBoosting(est)
+        else:
+            return None
+    except Exception:
+        return None
+    X = _probe_rows(compiled, VERIFY_ROWS)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # 以 DataFrame 訓練的模型對 ndarray 的特徵名稱警告
+        if verify and not np.array_equal(est.predict_proba(X), compiled._predict_proba(X)):
+            return None
+        if max_rows < 0:
+            compiled.calibrate(X)
+        else:
+            compiled.max_rows = max_rows
+    return compiled
+
+
+def compiled(est) -> Optional[CompiledTrees]:
+    """Cached ``compile_estimator(est)`` per process (None when disabled or not compilable)."""
+    if not COMPILED_TREES:
+        return None
+    with _CACHE_LOCK:
+        if est in _CACHE:
+            return _CACHE[est]
+    result = compile_estimator(est)
+    with _CACHE_LOCK:
+        _CACHE[est] = result
+    return result
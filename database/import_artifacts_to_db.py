@@ -2,7 +2,7 @@ import argparse
 import re
 import sys
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -18,6 +18,11 @@ except ImportError:  # pragma: no cover - fallback when executed as script via p
         sys.path.append(str(CURRENT_DIR))
     from db_init import get_engine  # type: ignore  # noqa: E402
 
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.append(str(REPO_ROOT))
+from data_layer import proba_store  # noqa: E402
+
 SUPPORTED_EXTENSIONS = {".csv", ".xlsx", ".xls"}
 SQL_TYPE_MAP = {
     "int": "INT",
@@ -137,10 +142,30 @@ def insert_dataframe(engine: Engine, table_name: str, df: pd.DataFrame) -> None:
 
 def iter_artifacts(folder: Path) -> Iterable[Path]:
     for path in sorted(folder.rglob("*")):
-        if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS:
+        if path.is_file() and (path.suffix.lower() in SUPPORTED_EXTENSIONS or proba_store.is_store(path)):
             yield path
 
 
+def load_tables(file_path: Path) -> List[Tuple[str, pd.DataFrame]]:
+    """(table name, rows) of one artifact; a probability store expands into the long-format tables of the old CSVs."""
+    if proba_store.is_store(file_path):
+        return list(proba_store.read(file_path).tables().items())
+    return [(normalize_table_name(file_path), load_dataframe(file_path))]
+
+
+def _superseded(path: Path, artifacts: List[Path]) -> bool:
+    """A leftover ``stage*_pred_proba.csv`` next to the probability store that now provides that table."""
+    if proba_store.is_store(path):
+        return False
+    provided = {
+        table
+        for stage, spec in proba_store.STAGES.items()
+        if (path.parent / spec["file"]) in artifacts
+        for table in proba_store.LEGACY_TABLES[stage]
+    }
+    return normalize_table_name(path) in provided
+
+
 def import_all_artifacts_to_db(folder_path: str) -> List[str]:
     folder = Path(folder_path).expanduser().resolve()
     if not folder.exists():
@@ -160,15 +185,17 @@ def import_all_artifacts_to_db(folder_path: str) -> List[str]:
     imported_tables: List[str] = []
 
     for artifact_path in artifacts:
-        table_name = normalize_table_name(artifact_path)
-        print(f"Processing {artifact_path.name} → table `{table_name}`")
-        dataframe = load_dataframe(artifact_path)
-        schema = infer_schema(dataframe)
-        recreate_table(engine, table_name, schema)
-        casted_df = cast_dataframe(dataframe, schema)
-        insert_dataframe(engine, table_name, casted_df)
-        print(f"完成匯入：{table_name}")
-        imported_tables.append(table_name)
+        if _superseded(artifact_path, artifacts):
+            print(f"Skipping {artifact_path.name}（已由機率檔取代）")
+            continue
+        for table_name, dataframe in load_tables(artifact_path):
+            print(f"Processing {artifact_path.name} → table `{table_name}`")
+            schema = infer_schema(dataframe)
+            recreate_table(engine, table_name, schema)
+            casted_df = cast_dataframe(dataframe, schema)
+            insert_dataframe(engine, table_name, casted_df)
+            print(f"完成匯入：{table_name}")
+            imported_tables.append(table_name)
 
     return imported_tables
 
@@ -43,9 +43,18 @@ const parseErrorMessage = async (response) => {
 
 const POLL_INTERVAL_MS = 3000
 
+// Status/log endpoints of the job created by the last upload (falls back to the global pipeline status)
+const statusUrlFor = (jobId) => (jobId ? `${API_BASE_URL}/jobs/${jobId}` : `${API_BASE_URL}/pipeline/status`)
+const logsUrlFor = (jobId) => (jobId ? `${API_BASE_URL}/jobs/${jobId}/logs` : `${API_BASE_URL}/artifacts/pipeline_logs.txt`)
+// Server-Sent Events stream of the job (status, stage and log lines pushed as they happen)
+const eventsUrlFor = (jobId) => `${API_BASE_URL}/pipeline/events?job_id=${encodeURIComponent(jobId)}`
+const MAX_LOG_CHARS = 2000
+
 export default function Upload({ onComplete, onSkip }) {
   const inputRef = useRef(null)
   const timerRef = useRef(null)
+  const jobIdRef = useRef(null)
+  const sseActiveRef = useRef(false)
   const [loading, setLoading] = useState(false)
   const [logoSrc, setLogoSrc] = useState('/aonix.png')
   const [error, setError] = useState('')
@@ -112,8 +121,13 @@ export default function Upload({ onComplete, onSkip }) {
     let mounted = true
     let pollId = null
     const doPoll = async () => {
+      if (sseActiveRef.current) {
+        // progress arrives over SSE; keep the timer only as a fallback
+        pollId = setTimeout(doPoll, POLL_INTERVAL_MS)
+        return
+      }
       try {
-        const res = await fetch(`${API_BASE_URL}/pipeline/status`)
+        const res = await fetch(statusUrlFor(jobIdRef.current))
         if (!res.ok) return
         const d = await res.json()
         if (!mounted) return
@@ -121,7 +135,7 @@ export default function Upload({ onComplete, onSkip }) {
         // fetch logs lazily if requested
         if (showLogs) {
           try {
-            const r2 = await fetch(`${API_BASE_URL}/artifacts/pipeline_logs.txt`)
+            const r2 = await fetch(logsUrlFor(jobIdRef.current))
             if (r2.ok) {
               const text = await r2.text()
               // keep last ~2000 chars to avoid huge payloads
@@ -131,7 +145,7 @@ export default function Upload({ onComplete, onSkip }) {
             // ignore
           }
         }
-        if (d && (d.status === 'done' || d.status === 'failed')) {
+        if (d && (d.status === 'done' || d.status === 'failed' || d.status === 'cancelled')) {
           // stop polling once finished
           return
         }
@@ -147,6 +161,61 @@ export default function Upload({ onComplete, onSkip }) {
     }
   }, [loading, showLogs])
 
+  // Follow the job over SSE; rejects when the stream cannot be opened so callers fall back to polling
+  const waitForPipelineEvents = (jobId) => new Promise((resolve, reject) => {
+    if (!jobId || typeof window === 'undefined' || typeof window.EventSource === 'undefined') {
+      reject(new Error('SSE unavailable'))
+      return
+    }
+    const source = new EventSource(eventsUrlFor(jobId))
+    let received = false
+    sseActiveRef.current = true
+    const finish = (settle, value) => {
+      source.close()
+      sseActiveRef.current = false
+      settle(value)
+    }
+    const parse = (e) => {
+      received = true
+      try {
+        return JSON.parse(e.data)
+      } catch {
+        return null
+      }
+    }
+    source.addEventListener('job', (e) => {
+      const d = parse(e)
+      if (!d) return
+      setPipelineStatus((prev) => ({ ...(prev || {}), ...d }))
+      if (d.status === 'done') finish(resolve, { ok: true })
+      else if (d.status === 'failed') finish(resolve, { ok: false, message: d.message || d.error || 'Pipeline failed' })
+      else if (d.status === 'cancelled') finish(resolve, { ok: false, cancelled: true, message: d.message || d.error })
+    })
+    source.addEventListener('status', (e) => {
+      const d = parse(e)
+      // pipeline progress only; completion is decided by the job event
+      if (d) setPipelineStatus((prev) => ({ ...(prev || {}), ...d, status: prev?.status || d.status }))
+    })
+    source.addEventListener('log', (e) => {
+      const d = parse(e)
+      if (d?.line) setPipelineLogs((prev) => `${prev}${d.line}\n`.slice(-MAX_LOG_CHARS))
+    })
+    source.onerror = () => {
+      // before the first event: no SSE support on this server; afterwards EventSource reconnects by itself
+      if (!received || source.readyState === EventSource.CLOSED) finish(reject, new Error('SSE connection failed'))
+    }
+  })
+
+  const cancelPipeline = async () => {
+    const jobId = jobIdRef.current
+    if (!jobId) return
+    try {
+      await fetch(`${API_BASE_URL}/jobs/${jobId}/cancel`, { method: 'POST' })
+    } catch (e) {
+      console.warn('cancel request failed', e)
+    }
+  }
+
   const openPicker = () => inputRef.current?.click()
 
   const uploadToServer = async (file) => {
@@ -180,6 +249,7 @@ export default function Upload({ onComplete, onSkip }) {
       return
     }
 
+    jobIdRef.current = null
     setLoading(true)
     setError('')
     setActiveStageIdx(0)
@@ -189,21 +259,25 @@ export default function Upload({ onComplete, onSkip }) {
       const response = await uploadToServer(file)
       // If backend returned preview periods, keep them
       const preview_periods = response?.preview_periods || []
+      jobIdRef.current = response?.job_id || null
 
       // Wait for pipeline completion by polling `/pipeline/status`.
       // No timeout: for large files we wait until pipeline reports 'done' or 'failed'.
       const waitForPipeline = async () => {
         while (true) {
           try {
-            const r = await fetch(`${API_BASE_URL}/pipeline/status`)
+            const r = await fetch(statusUrlFor(jobIdRef.current))
             if (r.ok) {
               const d = await r.json()
               const s = d && d.status ? d.status : null
               if (s === 'done') {
                 return { ok: true }
               }
+              if (s === 'cancelled') {
+                return { ok: false, cancelled: true, message: d.message || d.error }
+              }
               if (s === 'failed') {
-                return { ok: false, message: d.message || 'Pipeline failed' }
+                return { ok: false, message: d.message || d.error || 'Pipeline failed' }
               }
             }
           } catch (err) {
@@ -215,7 +289,17 @@ export default function Upload({ onComplete, onSkip }) {
         }
       }
 
-      const pipelineResult = await waitForPipeline()
+      let pipelineResult
+      try {
+        pipelineResult = await waitForPipelineEvents(jobIdRef.current)
+      } catch (sseError) {
+        console.warn('pipeline event stream unavailable, polling instead', sseError)
+        pipelineResult = await waitForPipeline()
+      }
+      if (pipelineResult.cancelled) {
+        setError('解析已取消')
+        return
+      }
       if (!pipelineResult.ok) {
         // pipeline failed: surface the error but still navigate so user can inspect partial outputs
         console.error('Pipeline failed:', pipelineResult.message)
@@ -307,6 +391,9 @@ export default function Upload({ onComplete, onSkip }) {
                   <button type="button" className="link-btn" onClick={() => setShowLogs((s) => !s)} style={{ padding: '4px 8px' }}>
                     {showLogs ? '關閉實行記錄' : '顯示實行記錄'}
                   </button>
+                  <button type="button" className="link-btn" onClick={cancelPipeline} style={{ padding: '4px 8px', marginLeft: 8 }}>
+                    取消解析
+                  </button>
                 </div>
                 {showLogs && (
                   <pre
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+
+import pytest
+
+from data_layer.jobs import JOB_FILENAME, JobManager
+
+
+def _wait_finished(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not job.finished:
+        assert time.monotonic() < deadline, f"job stayed {job.status}"
+        time.sleep(0.01)
+    return job
+
+
+def _manager(tmp_path, runner, **kwargs):
+    return JobManager(runner, jobs_dir=tmp_path / "jobs", **kwargs)
+
+
+def test_hook_runs_before_the_final_status(tmp_path):
+    seen = []
+
+    def on_finished(job, status):
+        seen.append((job.status, status, job.finished_at))
+
+    manager = _manager(tmp_path, lambda job: {"primary_stages_ok": True}, on_finished=on_finished)
+    job = _wait_finished(manager.submit(manager.create()))
+    assert seen == [("running", "done", None)]
+    assert job.status == "done" and job.finished_at is not None and job.error is None
+    with open(job.job_dir / JOB_FILENAME, encoding="utf-8") as f:
+        assert json.load(f)["status"] == "done"
+
+
+@pytest.mark.parametrize(
+    "result, status, error",
+    [
+        ({"cancelled": True, "cancel_reason": "Cancelled before Stage 5"}, "cancelled", "Cancelled before Stage 5"),
+        ({"stages": [{"stage": "Stage 3", "status": "error"}]}, "failed", "Pipeline finished with errors: Stage 3"),
+        (RuntimeError("boom"), "failed", "boom"),
+    ],
+)
+def test_runner_outcome_sets_the_status(tmp_path, result, status, error):
+    def runner(job):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    manager = _manager(tmp_path, runner)
+    job = _wait_finished(manager.submit(manager.create()))
+    assert (job.status, job.error) == (status, error)
+
+
+def test_cancel_queued_and_running_jobs(tmp_path):
+    started, release = threading.Event(), threading.Event()
+
+    def runner(job):
+        started.set()
+        release.wait(5)
+        return {"cancelled": job.cancel_event.is_set(), "primary_stages_ok": True}
+
+    manager = _manager(tmp_path, runner, max_concurrent=1)
+    running = manager.submit(manager.create())
+    assert started.wait(5)
+    low = manager.submit(manager.create())
+    high = manager.submit(manager.create(priority=5))
+    assert manager.queue_position(high.job_id) == 1 and manager.queue_position(low.job_id) == 2
+
+    manager.cancel(low.job_id)
+    assert low.status == "cancelled" and manager.queue_position(low.job_id) is None
+
+    manager.cancel(running.job_id)
+    assert running.cancel_event.is_set() and running.status == "running"
+    release.set()
+    assert _wait_finished(running).status == "cancelled"
+    assert _wait_finished(high).status == "done"
+    assert manager.running_count() == 0
+
+
+def test_complete_prunes_the_oldest_finished_jobs(tmp_path):
+    manager = _manager(tmp_path, lambda job: {}, max_history=2)
+    jobs = []
+    for _ in range(3):
+        job = manager.create()
+        manager.complete(job, status="done", result={"cache_hit": True})
+        jobs.append(job)
+        time.sleep(0.01)
+    assert [j.job_id for j in manager.list()] == [jobs[2].job_id, jobs[1].job_id]
+    assert not jobs[0].job_dir.exists() and jobs[2].job_dir.exists()
+    assert manager.get(jobs[0].job_id) is None
+
+
+def test_discard_forgets_an_unsubmitted_job(tmp_path):
+    manager = _manager(tmp_path, lambda job: {})
+    job = manager.create()
+    assert job.upload_file.parent.is_dir()
+    manager.discard(job)
+    assert not job.job_dir.exists() and manager.list() == []
@@ -0,0 +1,99 @@
+import itertools
+
+import pytest
+
+from data_layer import run_cache
+from data_layer.run_cache import RunCache, replace_tree
+
+
+@pytest.fixture(autouse=True)
+def _clock(monkeypatch):
+    # strictly increasing timestamps, so LRU order never depends on timer resolution
+    ticks = itertools.count(1_000_000)
+    monkeypatch.setattr(run_cache.time, "time", lambda: float(next(ticks)))
+
+
+def _artifacts(path, **files):
+    path.mkdir(parents=True)
+    for name, text in files.items():
+        (path / name).write_text(text)
+    return path
+
+
+def test_store_and_lookup(tmp_path):
+    source = _artifacts(tmp_path / "run", **{"stage5_eval.json": "{}", "pipeline_status.json": "{}"})
+    cache = RunCache(tmp_path / "runs", version="v1")
+    entry = cache.store("abc", source, meta={"job_id": "j1"})
+    assert entry["pipeline_version"] == "v1" and entry["job_id"] == "j1"
+    snapshot = tmp_path / "runs" / "abc" / "artifacts"
+    assert (snapshot / "stage5_eval.json").exists() and not (snapshot / "pipeline_status.json").exists()
+    assert source.exists() and cache.is_current("abc")
+
+    hit = cache.lookup("abc")
+    assert hit["path"] == str(snapshot) and hit["hits"] == 1
+    assert cache.lookup("missing") is None
+
+
+def test_store_move_hands_over_the_folder(tmp_path):
+    source = _artifacts(tmp_path / "run", **{"a.csv": "1"})
+    entry = RunCache(tmp_path / "runs", version="v1").store("abc", source, move=True)
+    assert not source.exists()
+    assert (tmp_path / "runs" / "abc" / "artifacts" / "a.csv").read_text() == "1"
+    assert entry["path"] == str(tmp_path / "runs" / "abc" / "artifacts")
+
+
+def test_other_pipeline_version_is_a_miss(tmp_path):
+    RunCache(tmp_path / "runs", version="v1").store("abc", _artifacts(tmp_path / "run", **{"a.csv": "1"}))
+    cache = RunCache(tmp_path / "runs", version="v2")
+    assert cache.lookup("abc") is None
+    assert not (tmp_path / "runs" / "abc").exists() and not cache.is_current("abc")
+
+
+def test_evict_keeps_pinned_snapshots(tmp_path):
+    pinned = []
+    cache = RunCache(tmp_path / "runs", max_runs=2, version="v1", in_use=lambda: pinned)
+    for digest in ("a", "b"):
+        cache.store(digest, _artifacts(tmp_path / digest, **{"x.csv": digest}))
+    pinned.append(tmp_path / "runs" / "a" / "artifacts")
+
+    # "a" is oldest but pinned: it counts against max_runs, so "b" goes
+    cache.store("c", _artifacts(tmp_path / "c", **{"x.csv": "c"}))
+    assert sorted(p.name for p in (tmp_path / "runs").iterdir() if p.is_dir()) == ["a", "c"]
+
+    # once nothing reads it, "a" is the least recently used
+    pinned.clear()
+    cache.store("d", _artifacts(tmp_path / "d", **{"x.csv": "d"}))
+    assert cache.lookup("a") is None and cache.lookup("c") and cache.lookup("d")
+
+
+def test_store_keeps_a_pinned_snapshot_of_the_same_upload(tmp_path):
+    snapshot = tmp_path / "runs" / "abc" / "artifacts"
+    cache = RunCache(tmp_path / "runs", version="v1", in_use=lambda: [snapshot])
+    first = cache.store("abc", _artifacts(tmp_path / "first", **{"x.csv": "1"}), move=True)
+    second_dir = _artifacts(tmp_path / "second", **{"x.csv": "2"})
+    second = cache.store("abc", second_dir, meta={"job_id": "j2"}, move=True)
+    assert second["path"] == first["path"] and second["job_id"] == "j2"
+    assert (snapshot / "x.csv").read_text() == "1" and second_dir.exists()
+
+
+def test_restore_replaces_the_live_folder(tmp_path):
+    cache = RunCache(tmp_path / "runs", version="v1")
+    cache.store("abc", _artifacts(tmp_path / "run", **{"a.csv": "cached"}))
+    cache.set_current(None)
+    live = _artifacts(tmp_path / "live", **{"a.csv": "old", "stale.csv": "old"})
+    assert cache.restore("abc", live)
+    assert (live / "a.csv").read_text() == "cached" and not (live / "stale.csv").exists()
+    assert cache.is_current("abc")
+    assert not cache.restore("missing", live)
+
+
+def test_replace_tree_swaps_the_whole_folder(tmp_path):
+    source = _artifacts(tmp_path / "source", **{"a.csv": "new", "pipeline_status.json": "{}"})
+    (source / "objects").mkdir()
+    (source / "objects" / "model.joblib").write_text("m")
+    target = _artifacts(tmp_path / "target", **{"a.csv": "old", "stale.csv": "old"})
+    replace_tree(source, target, ignore=("pipeline_status.json",))
+    assert sorted(p.name for p in target.iterdir()) == ["a.csv", "objects"]
+    assert (target / "a.csv").read_text() == "new" and (target / "objects" / "model.joblib").exists()
+    # no temporary or previous copy is left next to the target
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["source", "target"]
@@ -0,0 +1,61 @@
+import gc
+import weakref
+
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+
+from data_layer import tree_compile
+
+
+def _data(n_classes, n=400, n_features=6, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, n_features))
+    y = (X[:, 0] * 2 + X[:, 1] - X[:, 2] + rng.normal(scale=0.5, size=n) > 0).astype(int)
+    if n_classes > 2:
+        y = np.digitize(X[:, 0] + X[:, 3], np.quantile(X[:, 0] + X[:, 3], np.linspace(0, 1, n_classes + 1)[1:-1]))
+    return X, y
+
+
+def _models(n_classes):
+    X, y = _data(n_classes)
+    return X, [
+        RandomForestClassifier(n_estimators=25, max_depth=8, random_state=0).fit(X, y),
+        GradientBoostingClassifier(n_estimators=30, max_depth=3, random_state=0).fit(X, y),
+    ]
+
+
+@pytest.mark.parametrize("n_classes", [2, 4])
+def test_compiled_matches_predict_proba_bit_for_bit(n_classes):
+    X, models = _models(n_classes)
+    for est in models:
+        compiled = tree_compile.compile_estimator(est, verify=False, max_rows=0)
+        assert compiled is not None
+        # 隨機列 + 正好落在切點上的列（<= 的邊界）
+        probe = tree_compile._probe_rows(compiled, 1000, seed=1)
+        edges = np.resize(X.astype(np.float32), (2000, compiled.n_features))
+        internal = ~compiled.is_leaf
+        for f in range(compiled.n_features):
+            thr = compiled.threshold[internal & (compiled.feature == f)]
+            if len(thr):
+                edges[:, f] = np.resize(thr, len(edges))  # 每個切點都正好落在邊界上
+        for rows in (probe, edges, X.astype(np.float32), X[:1].astype(np.float32)):
+            assert np.array_equal(compiled._predict_proba(rows), est.predict_proba(rows))
+            assert np.array_equal(compiled._predict(rows), est.predict(rows))
+
+
+def test_large_batches_go_to_the_estimator():
+    X, (forest, _) = _models(2)
+    compiled = tree_compile.compile_estimator(forest, max_rows=10)
+    assert np.array_equal(compiled.predict_proba(X), forest.predict_proba(X))
+    assert np.array_equal(compiled.predict_proba(X[:5]), forest.predict_proba(X[:5]))
+
+
+def test_cache_does_not_keep_models_alive():
+    _, (forest, _) = _models(2)
+    compiled = tree_compile.compiled(forest)
+    assert compiled is not None and tree_compile.compiled(forest) is compiled
+    forest_ref, compiled_ref = weakref.ref(forest), weakref.ref(compiled)
+    del forest, compiled
+    gc.collect()
+    assert forest_ref() is None and compiled_ref() is None